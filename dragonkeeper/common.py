@@ -11,32 +11,143 @@ import codecs
 from time import gmtime, strftime, mktime, strptime, time, daylight
 from calendar import timegm
 from os import stat, listdir
+from stat import S_ISDIR, S_ISREG
 from os.path import isfile, isdir
 from os.path import exists as path_exists
 from os.path import join as path_join
 from os.path import sep as OS_PATH_SEP
 from urllib import quote, unquote
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 CRLF = '\r\n'
 BLANK = ' '
 BUFFERSIZE = 8192
-RE_HEADER = re.compile(": *")
-RE_HEADER_LINES = re.compile(CRLF + "(?![ \t])")
 SOURCE_ROOT = os.path.dirname(os.path.abspath(__file__))
 
+MAX_REQUEST_LINE = 8192
+MAX_HEAD_SIZE = 65536
+
+class Headers(dict):
+    """A dict of header fields with case-insensitive keys.
+    The keys keep the case in which they were set first."""
+
+    def __init__(self, items=()):
+        dict.__init__(self, items)
+        self._keys = dict((key.lower(), key) for key in self)
+        if not len(self._keys) == len(self):
+            # the same field in different cases
+            items = self.items()
+            self.clear()
+            self._keys = {}
+            for key, value in items:
+                self[key] = value
+
+    def __setitem__(self, key, value):
+        key = self._keys.setdefault(key.lower(), key)
+        dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, self._keys.get(key.lower(), key))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, self._keys.pop(key.lower(), key))
+
+    def __contains__(self, key):
+        return key.lower() in self._keys
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return dict.get(self, self._keys.get(key.lower(), key), default)
+
+    def pop(self, key, *default):
+        return dict.pop(self, self._keys.pop(key.lower(), key), *default)
+
+def parse_header_fields(lines):
+    """Create a Headers object from a list of header lines.
+    Continuation lines are folded into the previous field."""
+    fields = []
+    for line in lines:
+        if line[0:1] in (BLANK, '\t') and fields:
+            fields[-1][1] += BLANK + line.strip()
+        elif line:
+            name, value = line.split(':', 1)
+            fields.append([name, value.strip()])
+    return Headers(fields)
+
 def parse_headers(buffer):
     if 2*CRLF in buffer:
         headers_raw, buffer = buffer.split(2*CRLF, 1)
-        first_line, headers = headers_raw.split(CRLF, 1)
-        headers = dict((RE_HEADER.split(line, 1) for line in RE_HEADER_LINES.split(headers)))
+        lines = headers_raw.split(CRLF)
         return (
             headers_raw + 2 * CRLF,
-            first_line,
-            headers,
+            lines[0],
+            parse_header_fields(lines[1:]),
             buffer
         )
     return None
 
+class HeaderError(Exception):
+    """Raised by HeaderParser for a request which can not be handled,
+    code and token are the status of the response"""
+
+    def __init__(self, code, token):
+        Exception.__init__(self, "%s %s" % (code, token))
+        self.code = code
+        self.token = token
+
+class HeaderParser(object):
+    """Incremental parser for the head of a HTTP request.
+
+    parse is called with the whole input buffer on each read,
+    the search for the end of the head resumes where the last call stopped.
+    The length of the request line and the size of the head are bound,
+    a HeaderError is raised if they are exceeded."""
+
+    def __init__(self, max_request_line=MAX_REQUEST_LINE,
+                       max_head_size=MAX_HEAD_SIZE):
+        self.max_request_line = max_request_line
+        self.max_head_size = max_head_size
+        self._pos = 0
+
+    def parse(self, buffer):
+        """Return the same tuple as parse_headers
+        or None if the head is not yet complete."""
+        end = buffer.find(2 * CRLF, max(0, self._pos - 3))
+        if end == -1:
+            self._pos = len(buffer)
+            self._check_request_line(buffer, self._pos)
+            if self._pos > self.max_head_size:
+                raise HeaderError(431, 'Request Header Fields Too Large')
+            return None
+        self._pos = 0
+        self._check_request_line(buffer, end)
+        if end > self.max_head_size:
+            raise HeaderError(431, 'Request Header Fields Too Large')
+        lines = buffer[0:end].split(CRLF)
+        try:
+            headers = parse_header_fields(lines[1:])
+        except ValueError:
+            raise HeaderError(400, 'Bad Request')
+        return (
+            buffer[0:end + 4],
+            lines[0],
+            headers,
+            buffer[end + 4:]
+        )
+
+    def _check_request_line(self, buffer, end):
+        if end > self.max_request_line and \
+                buffer.find(CRLF, 0, self.max_request_line + 2) == -1:
+            raise HeaderError(414, 'Request-URI Too Long')
+
 RESPONSE_BASIC = \
     'HTTP/1.1 %s %s' + CRLF + \
     'Date: %s' + CRLF + \
@@ -179,9 +290,56 @@ def URI_to_system_path(path):
     return path_join(*[unquote(part) for part in path.split('/')])
 
 
+def rotate_file(path, backup_count, suffix=""):
+    """Rotate path + suffix to path.1 + suffix, path.1 + suffix to
+    path.2 + suffix and so on, up to backup_count"""
+    for i in range(backup_count, 0, -1):
+        source = "%s%s%s" % (path, i > 1 and ".%s" % (i - 1) or "", suffix)
+        target = "%s.%s%s" % (path, i, suffix)
+        if os.path.exists(source):
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(source, target)
+
+
+def scan_dir(path):
+    """Return the sorted lists of the sub directories and the files in path.
+    The directory is read in a single pass, with scandir the entry type
+    comes with the listing, otherwise it costs one stat call per entry."""
+    dirs = []
+    files = []
+    if scandir:
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    else:
+        for name in listdir(path):
+            try:
+                mode = stat(path_join(path, name)).st_mode
+            except OSError:
+                continue
+            if S_ISDIR(mode):
+                dirs.append(name)
+            elif S_ISREG(mode):
+                files.append(name)
+    dirs.sort()
+    files.sort()
+    return dirs, files
+
+
+# (second, formatted date) of the last get_timestamp call without a path
+_date = [0, ""]
+
 def get_timestamp(path = None):
-    return strftime("%a, %d %b %Y %H:%M:%S GMT",
-                            gmtime(path and stat(path).st_mtime or None))
+    if path:
+        return strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime(stat(path).st_mtime))
+    now = int(time())
+    if not now == _date[0]:
+        _date[0] = now
+        _date[1] = strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime(now))
+    return _date[1]
 
 def get_ts_short():
     t = time()
@@ -203,6 +361,33 @@ def timestamp_to_time(stamp):
       Sun Nov  6 08:49:37 1994       ; ANSI C's asctime() format"""
     return timegm(strptime(stamp, "%a, %d %b %Y %H:%M:%S %Z"))
 
+def encode_varuint(value):
+    if value == 0:
+        return "\0"
+    out = ""
+    value = value & 0xffffffffffffffff
+    while value:
+        part = value & 0x7f
+        value >>= 7
+        if value:
+            part |= 0x80
+        out += chr(part)
+    return out
+
+def decode_varuint(data, pos):
+    """Return the value of the varuint at pos in data and the position
+    after it, or None and pos if it is not complete"""
+    value = 0
+    for shift in xrange(0, 70, 7):
+        if pos >= len(data):
+            break
+        c = ord(data[pos])
+        pos += 1
+        value |= (c & 0x7f) << shift
+        if not c & 0x80:
+            return value, pos
+    return None, pos
+
 # Singleton class taken from
 # http://book.opensourceproject.org.cn/lamp/python/pythoncook2/opensource/0596007973/pythoncook2-chp-6-sect-15.html
 
@@ -213,3 +398,57 @@ class Singleton(object):
         if '_inst' not in vars(cls):
             cls._inst = object.__new__(cls, *args, **kwargs)
         return cls._inst
+
+if __name__ == "__main__":
+    # benchmark of parse_headers as it was called on each read against
+    # the incremental HeaderParser for a typical browser request,
+    # received at once and in small segments
+    import timeit
+    RE_HEADER = re.compile(": *")
+    RE_HEADER_LINES = re.compile(CRLF + "(?![ \t])")
+    def legacy_parse_headers(buffer):
+        if 2*CRLF in buffer:
+            headers_raw, buffer = buffer.split(2*CRLF, 1)
+            first_line, headers = headers_raw.split(CRLF, 1)
+            headers = dict((RE_HEADER.split(line, 1)
+                            for line in RE_HEADER_LINES.split(headers)))
+            return (headers_raw + 2 * CRLF, first_line, headers, buffer)
+        return None
+    REQUEST = CRLF.join([
+        "GET /app/stp-1/client-en.xml HTTP/1.1",
+        "Host: localhost:8002",
+        "User-Agent: Opera/9.80 (X11; Linux x86_64; U; en) Presto/2.10.229 Version/11.60",
+        "Accept: text/html, application/xml;q=0.9, application/xhtml+xml, image/png, image/webp, image/jpeg, image/gif, image/x-xbitmap, */*;q=0.1",
+        "Accept-Language: en,en-US;q=0.9",
+        "Accept-Encoding: gzip, deflate",
+        "Referer: http://localhost:8002/app/",
+        "Cookie: session=0123456789abcdef0123456789abcdef; prefs=%7B%22a%22%3A1%7D",
+        "If-Modified-Since: Fri, 16 Nov 2007 16:09:43 GMT",
+        "Cache-Control: no-cache",
+        "Connection: Keep-Alive",
+        CRLF])
+    def legacy(segments):
+        buffer = ""
+        for segment in segments:
+            buffer += segment
+            ret = legacy_parse_headers(buffer)
+        return ret
+    def incremental(segments):
+        parser = HeaderParser()
+        buffer = ""
+        for segment in segments:
+            buffer += segment
+            ret = parser.parse(buffer)
+        return ret
+    for name, request in [("browser", REQUEST),
+                          ("32k cookie", REQUEST.replace(
+                              "Cookie: ", "Cookie: %s" % ("x" * 32768)))]:
+        for size in [len(request), 1024, 64]:
+            segments = [request[i:i + size]
+                        for i in range(0, len(request), size)]
+            for func in [legacy, incremental]:
+                count = 2000
+                t = min(timeit.repeat(lambda: func(segments),
+                                      number=count, repeat=3))
+                print "%-11s %-11s segments: %4s  %9.2f us per request" % (
+                    func.__name__, name, len(segments), t / count * 1000000)
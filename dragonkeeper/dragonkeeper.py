@@ -7,6 +7,8 @@ from httpscopeinterface import HTTPScopeInterface
 from stpconnection import ScopeConnection
 from simpleserver import SimpleServer
 from upnpsimpledevice import SimpleUPnPDevice
+from logwriter import logger, LEVELS
+from stats import stats
 
 if sys.platform == "win32":
     import msvcrt
@@ -87,6 +89,20 @@ def _parse_args():
                         default="",
                         help="""a comma separated list of services to print
                                 the command map (default: %(default)s))""")
+    parser.add_argument("--message-map-cache",
+                        default="",
+                        dest="message_map_cache",
+                        help="directory to cache the message maps of the hosts, e.g. ~/.dragonkeeper/cache (default: no cache)")
+    parser.add_argument("--host-format",
+                        choices=["json", "protobuf"],
+                        default="json",
+                        dest="host_format",
+                        help="""the format of the messages from the host. With protobuf
+                                the payloads are decoded to JSON only for the JSON clients
+                                and for the debug output, the clients of the stp-1
+                                WebSocket subprotocol get them as they are. The first
+                                connection, which gets the message map, is always JSON
+                                (default: %(default)s))""")
     parser.add_argument("--message-filter",
                         dest="message_filter",
                         default="",
@@ -96,10 +112,16 @@ def _parse_args():
                                 listed in the filter will be printed.
                                 The filter uses JSON notation like:
                                 {"<service name>": {"<message type>": [<message>*]}}",
-                                with message type one of "command", "response", "event."
-                                 '*' placeholder are accepted in <message>,
+                                with message type one of "command", "response", "event", "error".
+                                '*' placeholder are accepted in <message>,
                                 e.g. a filter to log all threads may look like:
-                                 "{'ecmascript-debugger': {'event': ['OnThread*']}}".""")
+                                '{"ecmascript-debugger": {"event": ["OnThread*"]}}'.
+                                A <message> can also be an object with a limit,
+                                {"name": <message>, "rate": <messages per second>,
+                                "sample": <ratio of the messages>}, counted for each
+                                service and command, e.g. '{"ecmascript-debugger":
+                                {"event": [{"name": "OnThread*", "rate": 10}, "*"]}}'.
+                                The suppressed messages are summarized every 5 seconds.""")
     parser.add_argument("-v", "--verbose",
                         action="store_true",
                         default=False,
@@ -110,6 +132,55 @@ def _parse_args():
                         default=False,
                         dest="cgi_enabled",
                         help="enable cgi support")
+    parser.add_argument("--h2c",
+                        action="store_true",
+                        default=False,
+                        dest="h2c_enabled",
+                        help="enable cleartext HTTP/2, needs the h2 package")
+    parser.add_argument("--ws-deflate-window-bits",
+                        type=int,
+                        choices=[0] + range(9, 16),
+                        default=0,
+                        dest="deflate_window_bits",
+                        help="window bits of the permessage-deflate compression of the STP WebSocket, 0 to disable it (default: %(default)s))")
+    parser.add_argument("--ws-deflate-min-size",
+                        type=int,
+                        default=128,
+                        dest="deflate_min_size",
+                        help="STP WebSocket messages smaller than that are not compressed (default: %(default)s))")
+    parser.add_argument("--record",
+                        default="",
+                        help="append all STP/1 messages to a binary log, see stprecorder.py")
+    parser.add_argument("--record-max-size",
+                        type=int,
+                        default=64,
+                        dest="record_max_size",
+                        help="size in MB at which the log of --record is rotated (default: %(default)s))")
+    parser.add_argument("--log-file",
+                        default="",
+                        dest="log_file",
+                        help="write the log to a file instead of stdout")
+    parser.add_argument("--log-level",
+                        choices=["debug", "info", "warning", "error"],
+                        default="debug",
+                        dest="log_level",
+                        help="the lowest level to log (default: %(default)s))")
+    parser.add_argument("--log-json",
+                        action="store_true",
+                        default=False,
+                        dest="log_json",
+                        help="write the log as one JSON object per line")
+    parser.add_argument("--log-max-size",
+                        type=int,
+                        default=16,
+                        dest="log_max_size",
+                        help="size in MB at which the file of --log-file is rotated (default: %(default)s))")
+    parser.add_argument("--log-max-pending",
+                        type=int,
+                        default=4,
+                        dest="log_max_pending",
+                        help="size in MB of the log records waiting to be written "
+                             "above which debug and info records are dropped (default: %(default)s))")
     parser.add_argument("--servername",
                         default="localhost",
                         dest="SERVER_NAME",
@@ -126,24 +197,39 @@ def _run_proxy(args, count=None):
     server = SimpleServer(args.host, args.server_port, HTTPScopeInterface, args)
     args.SERVER_ADDR, args.SERVER_PORT = server.socket.getsockname()
     SimpleServer(args.host, args.stp_port, ScopeConnection, args)
-    print "server on: http://%s:%s/" % (args.SERVER_NAME, args.SERVER_PORT)
+    logger.info("server on: http://%s:%s/" % (args.SERVER_NAME, args.SERVER_PORT))
     upnp_device = SimpleUPnPDevice(args.ip, args.server_port, args.stp_port)
     upnp_device.notify_alive()
     args.http_get_handlers["upnp_description"] = upnp_device.get_description
+    args.http_get_handlers["stats"] = stats.get_response
     args.upnp_device = upnp_device
-    asyncore.loop(timeout=args.poll_timeout, count=count)
+    stats.loop(timeout=args.poll_timeout, count=count)
 
 def main_func():
     args = _parse_args()
+    logger.open(args.log_file and os.path.abspath(args.log_file) or None,
+                level=LEVELS[args.log_level],
+                is_json=args.log_json,
+                max_size=args.log_max_size * 1024 * 1024,
+                max_pending_size=args.log_max_pending * 1024 * 1024)
     if not args.ip:
-        print "failed to get the IP of the machine"
+        logger.error("failed to get the IP of the machine")
         return
     if not os.path.isdir(args.root):
         parser.error("""Root directory "%s" does not exist""" % args.root)
         return
+    if args.h2c_enabled:
+        from h2connection import H2_AVAILABLE
+        if not H2_AVAILABLE:
+            logger.warning("h2c support needs the h2 package")
+            args.h2c_enabled = False
     if args.message_filter:
         from utils import MessageMap
         MessageMap.set_filter(args.message_filter)
+    if args.record:
+        from stprecorder import recorder
+        recorder.open(os.path.abspath(args.record),
+                      max_size=args.record_max_size * 1024 * 1024)
     os.chdir(args.root)
     try:
         _run_proxy(args)
@@ -152,6 +238,9 @@ def main_func():
         asyncore.loop(timeout=args.poll_timeout, count=6)
         for fd, obj in asyncore.socket_map.items():
             obj.close()
+        if args.record:
+            recorder.close()
+        logger.close()
         sys.exit()
 
 if __name__ == "__main__":
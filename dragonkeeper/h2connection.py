@@ -0,0 +1,352 @@
+"""Cleartext HTTP/2 (h2c) for the HTTP interface.
+
+Optional, it needs the h2 package and is enabled with --h2c.
+
+A client starts HTTP/2 either with prior knowledge, by sending the
+connection preface as the first request, or by upgrading a HTTP/1.1
+request with 'Upgrade: h2c'. HTTPConnection detects both and hands the
+socket over to a H2CConnection.
+
+Each stream is served by a new instance of the HTTP/1.1 handler class of
+the connection, e.g. HTTPScopeInterface. The handler gets a StreamSocket
+instead of a real socket. The request is fed to it as HTTP/1.1 and its
+HTTP/1.1 response is translated to HEADERS and DATA frames. That way
+static files, the GET and POST commands and the scope endpoints are all
+multiplexed over one connection, and HPACK compresses the repeated
+X-Scope-Message-* headers of /get-message.
+"""
+
+import asyncore
+import itertools
+from common import CRLF, BLANK, BUFFERSIZE, parse_headers
+
+try:
+    from h2.connection import H2Connection
+    from h2.config import H2Configuration
+    from h2.events import RequestReceived, DataReceived, StreamEnded
+    from h2.events import StreamReset, ConnectionTerminated
+    from h2.exceptions import ProtocolError, StreamClosedError
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+
+H2_PREFACE = "PRI * HTTP/2.0" + 2 * CRLF + "SM" + 2 * CRLF
+
+RESPONSE_SWITCH_H2C = CRLF.join(["HTTP/1.1 101 Switching Protocols",
+                                 "Connection: Upgrade",
+                                 "Upgrade: h2c",
+                                 CRLF])
+
+# HTTP/1.1 headers which are not allowed in HTTP/2
+CONNECTION_HEADERS = ["connection", "keep-alive", "proxy-connection",
+                      "transfer-encoding", "upgrade"]
+
+_filenos = itertools.count(1)
+
+class StreamSocket(object):
+    """A socket like object to connect a HTTP/1.1 handler to a stream"""
+
+    def __init__(self, connection, stream_id):
+        self._connection = connection
+        self._stream_id = stream_id
+        # the handler is registered in the socket map with that
+        # number until it removes itself with del_channel
+        self._fileno = -_filenos.next()
+
+    def setblocking(self, flag):
+        pass
+
+    def fileno(self):
+        return self._fileno
+
+    def getpeername(self):
+        return self._connection.addr
+
+    def recv(self, buffersize):
+        return ""
+
+    def send(self, data):
+        self._connection.write_stream(self._stream_id, str(data))
+        return len(data)
+
+    def close(self):
+        self._connection.close_stream(self._stream_id)
+
+class H2Stream(object):
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.request_headers = []
+        self.request_body = []
+        # HTTP/1.1 output of the handler which is not yet translated
+        self.out = ""
+        # remaining body of the response, None before the head is parsed
+        self.content_length = None
+        # response body waiting for the flow control window
+        self.data = ""
+        self.data_pos = 0
+
+class H2CConnection(asyncore.dispatcher):
+    """A HTTP/2 connection with prior knowledge or after an upgrade.
+    data is already received input, out_buffer already queued output,
+    upgrade is a (HTTP2-Settings, request head) tuple of the upgraded
+    HTTP/1.1 request."""
+
+    def __init__(self, sock, addr, context, handler_class,
+                       data="", out_buffer="", upgrade=None):
+        asyncore.dispatcher.__init__(self, sock=sock)
+        self.addr = addr
+        self.context = context
+        self._handler_class = handler_class
+        self._conn = H2Connection(H2Configuration(client_side=False))
+        self._streams = {}
+        self._out_buffer = out_buffer
+        self._close_when_done = False
+        if upgrade:
+            settings, head = upgrade
+            self._conn.initiate_upgrade_connection(settings)
+            self._open_stream(1)
+            self._streams[1].handler.in_buffer = head
+            self._streams[1].handler.check_input()
+        else:
+            self._conn.initiate_connection()
+        self._flush()
+        if data:
+            self._receive(data)
+
+    def _open_stream(self, stream_id):
+        handler = self._handler_class(StreamSocket(self, stream_id),
+                                      self.addr,
+                                      self.context)
+        handler.del_channel()
+        handler.h2c_enabled = False
+        handler.cgi_enabled = False
+        self._streams[stream_id] = H2Stream(handler)
+
+    def _receive(self, data):
+        try:
+            events = self._conn.receive_data(data)
+        except ProtocolError:
+            self._flush()
+            self._close_when_done = True
+            return
+        for event in events:
+            if isinstance(event, RequestReceived):
+                self._open_stream(event.stream_id)
+                self._streams[event.stream_id].request_headers = event.headers
+            elif isinstance(event, DataReceived):
+                if event.stream_id in self._streams:
+                    self._streams[event.stream_id].request_body.append(event.data)
+                self._conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                if event.stream_id in self._streams:
+                    self._dispatch_request(self._streams[event.stream_id])
+            elif isinstance(event, StreamReset):
+                stream = self._streams.pop(event.stream_id, None)
+                if stream:
+                    stream.handler.handle_close()
+            elif isinstance(event, ConnectionTerminated):
+                self._close_when_done = True
+        self._flush()
+
+    def _dispatch_request(self, stream):
+        """Feed the request to the handler of the stream as HTTP/1.1"""
+        pseudo_headers = {}
+        headers = []
+        cookies = []
+        for name, value in stream.request_headers:
+            if name.startswith(':'):
+                pseudo_headers[name] = value
+            elif name == "cookie":
+                cookies.append(value)
+            elif not name == "content-length":
+                headers.append("%s: %s" % (name, value))
+        if cookies:
+            headers.append("cookie: %s" % "; ".join(cookies))
+        body = "".join(stream.request_body)
+        if body or pseudo_headers.get(":method") == "POST":
+            headers.append("content-length: %s" % len(body))
+        head = ["%s %s HTTP/1.1" % (pseudo_headers.get(":method"),
+                                    pseudo_headers.get(":path")),
+                "host: %s" % pseudo_headers.get(":authority", "")]
+        stream.request_headers = None
+        stream.request_body = None
+        stream.handler.in_buffer = CRLF.join(head + headers) + 2 * CRLF + body
+        stream.handler.check_input()
+
+    def write_stream(self, stream_id, data):
+        """Translate the HTTP/1.1 output of a handler"""
+        stream = self._streams.get(stream_id)
+        if not stream:
+            return
+        stream.out += data
+        if stream.content_length is None:
+            parsed = parse_headers(stream.out.lstrip(CRLF))
+            if not parsed:
+                return
+            raw, first_line, headers, body = parsed
+            protocol, code, token = first_line.split(BLANK, 2)
+            response_headers = [(':status', code)]
+            response_headers.extend((name.lower(), value)
+                                    for name, value in headers.items()
+                                    if not name.lower() in CONNECTION_HEADERS)
+            stream.content_length = int(headers.get("Content-Length", 0))
+            stream.out = body
+            self._conn.send_headers(stream_id,
+                                    response_headers,
+                                    end_stream=not stream.content_length)
+        if stream.content_length:
+            data = stream.out[0:stream.content_length]
+            stream.content_length -= len(data)
+            stream.data = stream.data[stream.data_pos:] + data
+            stream.data_pos = 0
+            self._send_data(stream_id, stream)
+        stream.out = ""
+        if not stream.content_length and not stream.data:
+            self._streams.pop(stream_id, None)
+        self._flush()
+
+    def _send_data(self, stream_id, stream):
+        while stream.data_pos < len(stream.data):
+            size = min(self._conn.local_flow_control_window(stream_id),
+                       self._conn.max_outbound_frame_size)
+            if size <= 0:
+                break
+            chunk = stream.data[stream.data_pos:stream.data_pos + size]
+            stream.data_pos += len(chunk)
+            is_done = not stream.content_length and \
+                      stream.data_pos == len(stream.data)
+            self._conn.send_data(stream_id, chunk, end_stream=is_done)
+        if stream.data_pos == len(stream.data):
+            stream.data = ""
+            stream.data_pos = 0
+
+    def close_stream(self, stream_id):
+        stream = self._streams.pop(stream_id, None)
+        if stream:
+            try:
+                self._conn.reset_stream(stream_id)
+            except StreamClosedError:
+                pass
+            self._flush()
+
+    def _flush(self):
+        self._out_buffer += self._conn.data_to_send()
+
+    # ============================================================
+    # Implementations of the asyncore.dispatcher class methods
+    # ============================================================
+
+    def handle_read(self):
+        data = self.recv(BUFFERSIZE)
+        if data:
+            self._receive(data)
+
+    def writable(self):
+        for stream_id, stream in self._streams.items():
+            # drives the timeouts and the io jobs of the handlers
+            while stream.handler.writable():
+                stream.handler.handle_write()
+            if stream.data and stream_id in self._streams:
+                try:
+                    self._send_data(stream_id, stream)
+                except StreamClosedError:
+                    self._streams.pop(stream_id, None)
+                if not stream.content_length and not stream.data:
+                    self._streams.pop(stream_id, None)
+        self._flush()
+        return bool(self._out_buffer)
+
+    def handle_write(self):
+        sent = self.send(self._out_buffer)
+        self._out_buffer = self._out_buffer[sent:]
+        if self._close_when_done and not self._out_buffer:
+            self.handle_close()
+
+    def handle_close(self):
+        streams = self._streams
+        self._streams = {}
+        for stream in streams.values():
+            stream.handler.handle_close()
+        self.close()
+
+if __name__ == "__main__":
+    # benchmark of a cold client load: all files below a directory of the
+    # server root are fetched with HTTP/1.1 on a few parallel connections
+    # like a browser does and with HTTP/2 on a single connection, e.g.
+    #     python h2connection.py localhost 8002 /path/to/root app/ 6
+    # the server must run with --h2c
+    import os
+    import sys
+    import socket
+    import threading
+    import httplib
+    from time import time
+    from urllib import quote
+    from h2.events import RemoteSettingsChanged
+    host, port, root, directory = sys.argv[1:5]
+    connection_count = len(sys.argv) > 5 and int(sys.argv[5]) or 6
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, directory)):
+        rel_path = os.path.relpath(dirpath, root).replace(os.path.sep, "/")
+        paths.extend("/%s/%s" % (quote(rel_path), quote(name))
+                     for name in filenames)
+    print "%s files" % len(paths)
+
+    def load_http_1(paths):
+        queue = list(paths)
+        def fetch():
+            conn = httplib.HTTPConnection(host, int(port))
+            while queue:
+                try:
+                    path = queue.pop()
+                except IndexError:
+                    break
+                conn.request("GET", path)
+                conn.getresponse().read()
+            conn.close()
+        threads = [threading.Thread(target=fetch)
+                   for i in range(connection_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def load_h2c(paths):
+        queue = list(paths)
+        conn = H2Connection(H2Configuration(client_side=True))
+        conn.initiate_connection()
+        sock = socket.create_connection((host, int(port)))
+        sock.sendall(conn.data_to_send())
+        pending = set()
+        has_settings = False
+        while queue or pending:
+            max_streams = conn.remote_settings.max_concurrent_streams
+            while has_settings and queue and len(pending) < max_streams:
+                stream_id = conn.get_next_available_stream_id()
+                conn.send_headers(stream_id, [(":method", "GET"),
+                                              (":path", queue.pop()),
+                                              (":scheme", "http"),
+                                              (":authority", host)],
+                                  end_stream=True)
+                pending.add(stream_id)
+            sock.sendall(conn.data_to_send())
+            data = sock.recv(65536)
+            if not data:
+                break
+            for event in conn.receive_data(data):
+                if isinstance(event, DataReceived):
+                    conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, (StreamEnded, StreamReset)):
+                    pending.discard(event.stream_id)
+                elif isinstance(event, RemoteSettingsChanged):
+                    has_settings = True
+        sock.close()
+
+    for name, load in [("HTTP/1.1 x %s" % connection_count, load_http_1),
+                       ("h2c x 1", load_h2c)]:
+        t = time()
+        load(paths)
+        print "%-16s %8.1f ms" % (name, (time() - t) * 1000)
@@ -1,5 +1,6 @@
 import asyncore
 import sys
+from collections import deque, OrderedDict
 import shlex
 import json
 from time import time
@@ -10,41 +11,120 @@ from os.path import join as path_join
 from mimetypes import types_map
 from common import *
 from common import __version__ as VERSION
+import response
+from requestbody import SpooledBody, MAX_PENDING_IO, save_base64_png
+from h2connection import H2CConnection, H2_AVAILABLE, RESPONSE_SWITCH_H2C
 
 types_map[".manifest"] = "text/cache-manifest"
 types_map[".ico"] = "image/x-icon"
 
+# rendered directory views, keyed by (system path, has parent link),
+# the values are (mtime of the directory, content), in the order of
+# the last use, the least recently used view is evicted first
+dir_views = OrderedDict()
+DIR_VIEW_CACHE_SIZE = 64
+# the requests of static files and directories, see stats.py,
+# a 304 response or a cached directory view is a hit
+static_stats = {"files": 0, "not_modified": 0, "dir_view_hits": 0, "dir_view_misses": 0}
+# directory views bigger than that are sent in chunks of that size
+DIR_VIEW_CHUNK_SIZE = 4 * BUFFERSIZE
+
+def get_dir_view(path, system_path):
+    """Return the html view of a directory.
+    The rendered view is cached until the mtime of the directory changes."""
+    key = (system_path, bool(path))
+    mtime = stat(system_path).st_mtime
+    if key in dir_views and dir_views[key][0] == mtime:
+        static_stats["dir_view_hits"] += 1
+        # move it to the end
+        dir_views[key] = dir_views.pop(key)
+        return dir_views[key][1]
+    static_stats["dir_view_misses"] += 1
+    items_dir, items_file = scan_dir(system_path)
+    if path:
+        items_dir.insert(0, '..')
+    markup = [ITEM_DIR % (quote(item), item) for item in items_dir]
+    markup.extend([ITEM_FILE % (quote(item), item) for item in items_file])
+    content = DIR_VIEW % ("".join(markup))
+    dir_views.pop(key, None)
+    if len(dir_views) >= DIR_VIEW_CACHE_SIZE:
+        dir_views.popitem(last=False)
+    dir_views[key] = (mtime, content)
+    return content
+
+def iter_chunks(content, size):
+    for pos in xrange(0, len(content), size):
+        yield content[pos:pos + size]
+
 class HTTPConnection(asyncore.dispatcher):
     """To provide a simple HTTP response handler.
     Special methods can be implementd by subclassing this class
     """
 
+    # POST commands which get the body as a SpooledBody in post_body
+    # instead of the raw_post_data string
+    STREAMED_COMMANDS = ["base64_2png"]
+
     def __init__(self, conn, addr, context):
         asyncore.dispatcher.__init__(self, sock=conn)
         self.addr = addr
         self.context = context
         self.in_buffer = ""
         self.out_buffer = ""
+        # iterators of pending chunks, they are appended
+        # to the out_buffer as it gets drained
+        self.out_producers = []
+        # bodies queued by write_response, they are sent before the
+        # out_buffer without being copied
+        self.out_queue = deque()
+        self.out_queue_pos = 0
         self.content_length = 0
+        self.post_body = None
+        # (IOJob, callback) tuples of the pending io pool jobs
+        self.io_jobs = []
+        self.header_parser = HeaderParser()
         self.check_input = self.read_headers
+        self.close_when_done = False
         self.query = ''
         self.raw_post_data = ""
         # Timeout acts also as flag to signal
         # a connection which still waits for a response
         self.timeout = 0
         self.cgi_enabled = context.cgi_enabled
+        self.h2c_enabled = context.h2c_enabled and H2_AVAILABLE
         self.cgi_script = ""
         self.GET_handlers = context.http_get_handlers
 
 
     def read_headers(self):
-        raw_parsed_headers = parse_headers(self.in_buffer)
+        try:
+            raw_parsed_headers = self.header_parser.parse(self.in_buffer)
+        except HeaderError, error:
+            self.reject_request(error)
+            return
         if raw_parsed_headers:
             # to dispatch any hanging timeout response
             self.flush()
             (headers_raw, first_line,
                     self.headers, self.in_buffer) = raw_parsed_headers
-            method, path, protocol = first_line.split(BLANK, 2)
+            try:
+                method, path, protocol = first_line.split(BLANK, 2)
+            except ValueError:
+                self.reject_request(HeaderError(400, 'Bad Request'))
+                return
+            if self.h2c_enabled:
+                # HTTP/2 with prior knowledge
+                if method == "PRI" and protocol == "HTTP/2.0":
+                    self.switch_to_h2c(headers_raw + self.in_buffer)
+                    return
+                if self.headers.get("Upgrade", "").lower() == "h2c" and \
+                        "HTTP2-Settings" in self.headers and \
+                        not "Content-Length" in self.headers:
+                    self.out_buffer += RESPONSE_SWITCH_H2C
+                    self.switch_to_h2c(self.in_buffer,
+                                       (self.headers["HTTP2-Settings"],
+                                        headers_raw))
+                    return
             #if path == "/app/":
             #    path = "/app/stp-1/client-en.xml"
             self.REQUEST_URI = path
@@ -69,7 +149,12 @@ class HTTPConnection(asyncore.dispatcher):
             if method == "POST":
                 if "Content-Length" in self.headers:
                     self.content_length = int(self.headers["Content-Length"])
-                    self.check_input = self.read_content
+                    if command in self.STREAMED_COMMANDS and \
+                            not self.cgi_script:
+                        self.post_body = SpooledBody()
+                        self.check_input = self.read_body
+                    else:
+                        self.check_input = self.read_content
                     self.check_input()
             # GET
             elif method == "GET":
@@ -89,22 +174,46 @@ class HTTPConnection(asyncore.dispatcher):
                         self.serve(path, path_join(SOURCE_ROOT, system_path))
                     else:
                         content = "The server cannot handle: %s" % path
-                        self.out_buffer += NOT_FOUND % (
-                            get_timestamp(),
-                            len(content),
-                            content)
+                        self.write_response(
+                            response.NOT_FOUND.render(len(content)), content)
                         self.timeout = 0
-                if self.in_buffer:
+                if self.in_buffer and self.is_idle():
                     self.check_input()
             # Not implemented method
             else:
                 content = "The server cannot handle: %s" % method
-                self.out_buffer += NOT_FOUND % (
-                    get_timestamp(),
-                    len(content),
-                    content)
+                self.write_response(response.NOT_FOUND.render(len(content)), content)
                 self.timeout = 0
 
+    def reject_request(self, error):
+        """Respond with the status of the HeaderError
+        and close the connection after the response is sent."""
+        self.flush()
+        self.out_buffer += response.ResponseHead(
+            error.code,
+            error.token,
+            'Connection: close' + 2 * CRLF).render()
+        self.in_buffer = ""
+        self.check_input = self.ignore_input
+        self.close_when_done = True
+        self.timeout = 0
+
+    def switch_to_h2c(self, data, upgrade=None):
+        """Hand the socket over to a H2CConnection,
+        the streams are served by instances of this class."""
+        self.del_channel()
+        self.timeout = 0
+        H2CConnection(self.socket,
+                      self.addr,
+                      self.context,
+                      self.__class__,
+                      data,
+                      self.out_buffer,
+                      upgrade)
+
+    def ignore_input(self):
+        self.in_buffer = ""
+
     def check_is_cgi(self, system_path, handler=".cgi"):
         # system path of the cgi script
         self.cgi_script = ""
@@ -238,15 +347,27 @@ class HTTPConnection(asyncore.dispatcher):
                 getattr(self, self.command)()
             else:
                 content = "The server cannot handle: %s" % self.path
-                self.out_buffer += NOT_FOUND % (
-                    get_timestamp(),
-                    len(content),
-                    content)
+                self.write_response(response.NOT_FOUND.render(len(content)), content)
             self.raw_post_data = ""
             self.in_buffer = self.in_buffer[self.content_length:]
             self.content_length = 0
             self.check_input = self.read_headers
-            if self.in_buffer:
+            if self.in_buffer and self.is_idle():
+                self.check_input()
+
+    def read_body(self):
+        """Hand the received part of the body to post_body"""
+        if self.in_buffer:
+            data = self.in_buffer[0:self.content_length]
+            self.in_buffer = self.in_buffer[len(data):]
+            self.content_length -= len(data)
+            self.post_body.write(data)
+            self.timeout = time() + TIMEOUT
+        if not self.content_length:
+            getattr(self, self.command)()
+            self.post_body = None
+            self.check_input = self.read_headers
+            if self.in_buffer and self.is_idle():
                 self.check_input()
 
     def serve(self, path, system_path):
@@ -257,127 +378,94 @@ class HTTPConnection(asyncore.dispatcher):
                 self.serve_dir(path, system_path)
         else:
             content = "The sever couldn't find %s" % system_path
-            self.out_buffer += NOT_FOUND % (
-                get_timestamp(),
-                len(content),
-                content)
+            self.write_response(response.NOT_FOUND.render(len(content)), content)
             self.timeout = 0
 
     def serve_file(self, path, system_path):
         if "If-Modified-Since" in self.headers and \
            timestamp_to_time(self.headers["If-Modified-Since"]) >= \
            int(stat(system_path).st_mtime):
-            self.out_buffer += NOT_MODIFIED % get_timestamp()
+            self.out_buffer += response.NOT_MODIFIED.render()
             self.timeout = 0
+            static_stats["not_modified"] += 1
         else:
+            static_stats["files"] += 1
             ending = "." in path and path[path.rfind("."):] or "no-ending"
             mime = ending in types_map and types_map[ending] or 'text/plain'
             try:
                 f = open(system_path, 'rb')
                 content = f.read()
                 f.close()
-                self.out_buffer += RESPONSE_OK_CONTENT % (
-                    get_timestamp(),
+                self.write_response(response.OK_CONTENT.render(
                     'Last-Modified: %s%s' % (
                         get_timestamp(system_path),
                         CRLF),
                     mime,
-                    len(content),
-                    content)
+                    len(content)), content)
                 self.timeout = 0
             except:
                 content = "The server cannot find %s" % system_path
-                self.out_buffer += NOT_FOUND % (
-                    get_timestamp(),
-                    len(content),
-                    content)
+                self.write_response(response.NOT_FOUND.render(len(content)), content)
                 self.timeout = 0
 
     def serve_dir(self, path, system_path):
         if path and not path.endswith('/'):
-            self.out_buffer += REDIRECT % (get_timestamp(), path + '/')
+            self.out_buffer += response.REDIRECT.render(path + '/')
             self.timeout = 0
         else:
             try:
-                items_dir = [item for item in listdir(system_path)
-                                if isdir(path_join(system_path, item))]
-                items_file = [item for item in listdir(system_path)
-                                if isfile(path_join(system_path, item))]
-                items_dir.sort()
-                items_file.sort()
-                if path:
-                    items_dir.insert(0, '..')
-                markup = [ITEM_DIR % (quote(item), item)
-                            for item in items_dir]
-                markup.extend([ITEM_FILE % (quote(item), item)
-                                    for item in items_file])
-                content = DIR_VIEW % ("".join(markup))
+                content = get_dir_view(path, system_path)
             except Exception, msg:
                 content = DIR_VIEW % """<li style="color:#f30">%s</li>""" % msg
-            self.out_buffer += RESPONSE_OK_CONTENT % (
-                get_timestamp(),
-                '',
-                "text/html",
-                len(content),
-                content)
+            head = response.OK_CONTENT.render('', "text/html", len(content))
+            if len(content) > DIR_VIEW_CHUNK_SIZE:
+                self.out_buffer += head
+                self.push_producer(iter_chunks(content, DIR_VIEW_CHUNK_SIZE))
+            else:
+                self.out_buffer += head + content
             self.timeout = 0
 
     def proxy(self):
         import urllib
         try:
-            response = urllib.urlopen(self.raw_post_data)
-            content = response.read()
-            self.out_buffer += RESPONSE_OK_CONTENT % (
-                get_timestamp(),
+            content = urllib.urlopen(self.raw_post_data).read()
+            self.write_response(response.OK_CONTENT.render(
                 '',
                 "text/html",
-                len(content),
-                content)
+                len(content)), content)
         except:
             content = "The server cannot handle: %s" % method
-            self.out_buffer += NOT_FOUND % (
-                get_timestamp(),
-                len(content),
-                content)
+            self.write_response(response.NOT_FOUND.render(len(content)), content)
             self.timeout = 0
         self.timeout = 0
 
     def base64_2png(self):
-        import json
-        import upnpsimpledevice
-        resp_msg = None
-        try:
-            """
-            message format
+        """store a png from a message like
             {
                 directory: <relative URL>,
                 data: <base64 string>
             }
-            """
-            msg = json.loads(self.raw_post_data)
-            file_name = "%s.png" % upnpsimpledevice.get_uuid()
-            sys_path = URI_to_system_path(msg.get("directory"))
-            if not path_exists(sys_path):
-                os.mkdir(sys_path)
-            path = path_join(sys_path, file_name)
-            fh = open(path, "wb")
-            fh.write(msg.get("data").decode('base64'))
-            fh.close()
+        """
+        import upnpsimpledevice
+        file_name = "%s.png" % upnpsimpledevice.get_uuid()
+        self.wait_for_io(self.post_body.finish(save_base64_png, file_name),
+                         self.return_base64_2png)
+
+    def return_base64_2png(self, job):
+        if job.error:
             resp_msg = {
-                "status": "OK",
-                "file_name": file_name
+                "status": "Error"
             }
-        except:
+        else:
             resp_msg = {
-                "status": "Error"
+                "status": "OK",
+                "file_name": job.result
             }
         content = json.dumps(resp_msg)
-        self.out_buffer += RESPONSE_OK_CONTENT % (
-            get_timestamp(),
+        self.write_response(response.OK_CONTENT.render(
             "",
             "text/plain",
-            len(content),
-            content)
+            len(content)), content)
         self.timeout = 0
 
     # ============================================================
@@ -385,19 +473,84 @@ class HTTPConnection(asyncore.dispatcher):
     # ============================================================
     def flush(self):
         pass
+
+    def write_response(self, head, body):
+        """Queue a response head and its body.
+        Small bodies are appended to the out_buffer to save a send call,
+        bigger ones are queued as they are and sent without a copy."""
+        if len(body) < BUFFERSIZE:
+            self.out_buffer += head + body
+        else:
+            self.out_queue.append(self.out_buffer + head)
+            self.out_queue.append(body)
+            self.out_buffer = ""
+
+    def is_idle(self):
+        """Further requests are only read if no response is pending"""
+        return not (self.out_producers or self.io_jobs)
+
+    def wait_for_io(self, job, callback):
+        """Call callback(job) on the loop thread when the IOJob is done"""
+        self.io_jobs.append((job, callback))
+
+    def check_io(self):
+        """Call the callbacks of the finished io jobs.
+        The connection does not time out while it waits for the io pool."""
+        while self.io_jobs and self.io_jobs[0][0].done:
+            job, callback = self.io_jobs.pop(0)
+            callback(job)
+            if self.in_buffer and self.is_idle():
+                self.check_input()
+        if self.io_jobs:
+            self.timeout = time() + TIMEOUT
+
+    def push_producer(self, producer):
+        """Queue an iterator of strings to be sent after the out_buffer.
+        Further requests are not read before all producers are drained
+        to keep the responses in order."""
+        self.out_producers.append(producer)
+        self.refill_out_buffer()
+
+    def refill_out_buffer(self):
+        while self.out_producers and len(self.out_buffer) < BUFFERSIZE:
+            try:
+                self.out_buffer += self.out_producers[0].next()
+            except StopIteration:
+                self.out_producers.pop(0)
+                if self.in_buffer and self.is_idle():
+                    self.check_input()
+
     # ============================================================
     # Implementations of the asyncore.dispatcher class methods
     # ============================================================
     def handle_read(self):
         self.in_buffer += self.recv(BUFFERSIZE)
-        self.check_input()
+        if self.post_body or self.is_idle():
+            self.check_input()
+
+    def readable(self):
+        return not (self.post_body and
+                    self.post_body.pending_size() > MAX_PENDING_IO)
 
     def writable(self):
-        return bool(self.out_buffer)
+        if self.io_jobs:
+            self.check_io()
+        return bool(self.out_buffer or self.out_queue or self.out_producers)
 
     def handle_write(self):
-        sent = self.send(self.out_buffer)
-        self.out_buffer = self.out_buffer[sent:]
+        if self.out_queue:
+            buf = self.out_queue[0]
+            self.out_queue_pos += self.send(buffer(buf, self.out_queue_pos))
+            if self.out_queue_pos >= len(buf):
+                self.out_queue.popleft()
+                self.out_queue_pos = 0
+        else:
+            sent = self.send(self.out_buffer)
+            self.out_buffer = self.out_buffer[sent:]
+            if self.out_producers:
+                self.refill_out_buffer()
+        if self.close_when_done and not self.writable():
+            self.close()
 
     def handle_close(self):
         self.close()
@@ -42,12 +42,16 @@ import re
 import httpconnection
 import os
 from time import time
-from common import CRLF, RESPONSE_BASIC, RESPONSE_OK_CONTENT
-from common import NOT_FOUND, BAD_REQUEST, get_timestamp, Singleton
+from common import CRLF, Singleton
+from response import ResponseHead, OK_CONTENT, NOT_FOUND, BAD_REQUEST
 # from common import pretty_dragonfly_snapshot
-from utils import MessageMap, pretty_print_XML, pretty_print
+from utils import MessageMap, pretty_print_XML, pretty_print, check_message
 from stpwebsocket import STPWebSocket
 from websocket13 import TestWebSocket13, TestWebSocket13HighLoad
+from requestbody import save_file, save_snapshot
+from stprecorder import recorder, DIRECTION_FROM_CLIENT, DIRECTION_TO_CLIENT
+from logwriter import logger
+from stpmessage import get_json_payload
 
 # the two queues
 connections_waiting = []
@@ -58,6 +62,8 @@ SERVICE_LIST = """<services>%s</services>"""
 SERVICE_ITEM = """<service name="%s"/>"""
 XML_PRELUDE = """<?xml version="1.0"?>%s"""
 MSG_TYPE_ERROR = 4
+# name of the encoding of a Message
+ENCODING = "http-head"
 
 class Scope(Singleton):
     """Access layer for HTTPScopeInterface instances to the scope connection"""
@@ -107,7 +113,7 @@ class Scope(Singleton):
             else:
                 http_connection.return_service_list(self._service_list)
         else:
-            print "Unsupported version in scope.return_service_list(conn)"
+            logger.error("Unsupported version in scope.return_service_list(conn)")
 
     def set_STP_version(self, version):
         """to register the STP version.
@@ -116,7 +122,7 @@ class Scope(Singleton):
             self.version = "stp-1"
             self.send_command = self._connection.send_command_STP_1
         else:
-            print "This stp version is not jet supported"
+            logger.error("This stp version is not jet supported")
 
     def get_STP_version(self):
         return self.version_map[self.version]
@@ -185,9 +191,12 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
 
     """
 
+    STREAMED_COMMANDS = httpconnection.HTTPConnection.STREAMED_COMMANDS + \
+                        ["snapshot", "savefile"]
+
     # scope specific responses
 
-    # RESPONSE_SERVICELIST % ( timestamp, content length content )
+    # RESPONSE_SERVICELIST.render(content length)
     # HTTP/1.1 200 OK
     # Date: %s
     # Server: Dragonkeeper/0.8
@@ -195,17 +204,15 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
     # Content-Type: application/xml
     # Content-Length: %s
     #
-    # %s
 
-    RESPONSE_SERVICELIST = RESPONSE_OK_CONTENT % (
-        '%s',
-        'Cache-Control: no-cache' + CRLF,
-        'application/xml',
-        '%s',
-        '%s',
-    )
+    RESPONSE_SERVICELIST = ResponseHead(
+        200,
+        'OK',
+        'Cache-Control: no-cache' + CRLF + \
+        'Content-Type: application/xml' + CRLF + \
+        'Content-Length: %s' + 2 * CRLF)
 
-    # RESPONSE_OK_OK % ( timestamp )
+    # RESPONSE_OK_OK.render()
     # HTTP/1.1 200 OK
     # Date: %s
     # Server: Dragonkeeper/0.8
@@ -215,15 +222,15 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
     #
     # <ok/>
 
-    RESPONSE_OK_OK = RESPONSE_OK_CONTENT % (
-        '%s',
-        'Cache-Control: no-cache' + CRLF,
-        'application/xml',
-        len("<ok/>"),
-        "<ok/>",
-    )
+    RESPONSE_OK_OK = ResponseHead(
+        200,
+        'OK',
+        'Cache-Control: no-cache' + CRLF + \
+        'Content-Type: application/xml' + CRLF + \
+        'Content-Length: %s' % len("<ok/>") + 2 * CRLF + \
+        '<ok/>')
 
-    # RESPONSE_TIMEOUT % ( timestamp )
+    # RESPONSE_TIMEOUT.render()
     # HTTP/1.1 200 OK
     # Date: %s
     # Server: Dragonkeeper/0.8
@@ -233,15 +240,15 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
     #
     # <timeout/>
 
-    RESPONSE_TIMEOUT = RESPONSE_OK_CONTENT % (
-        '%s',
-        'Cache-Control: no-cache' + CRLF,
-        'application/xml',
-        len('<timeout/>'),
-        '<timeout/>',
-    )
+    RESPONSE_TIMEOUT = ResponseHead(
+        200,
+        'OK',
+        'Cache-Control: no-cache' + CRLF + \
+        'Content-Type: application/xml' + CRLF + \
+        'Content-Length: %s' % len("<timeout/>") + 2 * CRLF + \
+        '<timeout/>')
 
-    # SCOPE_MESSAGE_STP_0 % ( timestamp, service, message length, message )
+    # SCOPE_MESSAGE_STP_0.render(service, message length)
     # HTTP/1.1 200 OK
     # Date: %s
     # Server: Dragonkeeper/0.8
@@ -250,19 +257,17 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
     # Content-Type: application/xml
     # Content-Length: %s
     #
-    # %s
 
-    SCOPE_MESSAGE_STP_0 = RESPONSE_OK_CONTENT % (
-        '%s',
+    SCOPE_MESSAGE_STP_0 = ResponseHead(
+        200,
+        'OK',
         'Cache-Control: no-cache' + CRLF + \
-        'X-Scope-Message-Service: %s' + CRLF,
-        'application/xml',
-        '%s',
-        '%s',
-    )
-
-    # SCOPE_MESSAGE_STP_1 % ( timestamp, service, command, status,
-    #                                           tag, message length, message )
+        'X-Scope-Message-Service: %s' + CRLF + \
+        'Content-Type: application/xml' + CRLF + \
+        'Content-Length: %s' + 2 * CRLF)
+
+    # SCOPE_MESSAGE_STP_1.render(service, command, status,
+    #                                           tag, message length)
     # HTTP/1.1 200 OK
     # Date: %s
     # Server: Dragonkeeper/0.8
@@ -274,18 +279,17 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
     # Content-Type: text/plain
     # Content-Length: %s
     #
-    # %s
-    SCOPE_MESSAGE_STP_1 = RESPONSE_OK_CONTENT % (
-        '%s',
+
+    SCOPE_MESSAGE_STP_1 = ResponseHead(
+        200,
+        'OK',
         'Cache-Control: no-cache' + CRLF + \
         'X-Scope-Message-Service: %s' + CRLF + \
         'X-Scope-Message-Command: %s' + CRLF + \
         'X-Scope-Message-Status: %s' + CRLF + \
-        'X-Scope-Message-Tag: %s' + CRLF,
-        'text/plain',
-        '%s',
-        '%s',
-    )
+        'X-Scope-Message-Tag: %s' + CRLF + \
+        'Content-Type: text/plain' + CRLF + \
+        'Content-Length: %s' + 2 * CRLF)
 
     def __init__(self, conn, addr, context):
         httpconnection.HTTPConnection.__init__(self, conn, addr, context)
@@ -306,7 +310,7 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
     def services(self):
         """to get the service list"""
         if connections_waiting:
-            print ">>> failed, connections_waiting is not empty"
+            logger.warning(">>> failed, connections_waiting is not empty")
         scope.return_service_list(self)
         self.timeout = 0
 
@@ -314,26 +318,20 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
         content = SERVICE_LIST % "".join(
             [SERVICE_ITEM % service.encode('utf-8')
             for service in serviceList])
-        self.out_buffer += self.RESPONSE_SERVICELIST % (
-            get_timestamp(),
-            len(content),
-            content)
+        self.write_response(self.RESPONSE_SERVICELIST.render(len(content)),
+                            content)
 
     def get_stp_version(self):
         content = scope.get_STP_version()
-        self.out_buffer += RESPONSE_OK_CONTENT % (
-            get_timestamp(),
-            '',
-            "text/plain",
-            len(content),
-            content)
+        self.write_response(OK_CONTENT.render('', "text/plain", len(content)),
+                            content)
         self.timeout = 0
 
     def enable(self):
         """to enable a scope service"""
         service = self.arguments[0]
         if scope.services_enabled[service]:
-            print ">>> service is already enabled", service
+            logger.warning(">>> service is already enabled %s" % service)
         else:
             scope.send_command("*enable %s" % service)
             scope.services_enabled[service] = True
@@ -341,7 +339,7 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
             if service.startswith('stp-'):
                 scope.set_STP_version(service)
 
-        self.out_buffer += self.RESPONSE_OK_OK % get_timestamp()
+        self.out_buffer += self.RESPONSE_OK_OK.render()
         self.timeout = 0
 
     def get_message(self):
@@ -367,7 +365,7 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
                          self.context,
                          scope.get_scope_connection())
         else:
-            self.out_buffer += BAD_REQUEST % get_timestamp()
+            self.out_buffer += BAD_REQUEST.render()
             self.timeout = 0
 
     def test_web_sock_13(self):
@@ -379,7 +377,7 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
                             self.in_buffer,
                             self.path)
         else:
-            self.out_buffer += BAD_REQUEST % get_timestamp()
+            self.out_buffer += BAD_REQUEST.render()
             self.timeout = 0
 
     def test_web_sock_13_high_load(self):
@@ -391,7 +389,7 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
                                     self.in_buffer,
                                     self.path)
         else:
-            self.out_buffer += BAD_REQUEST % get_timestamp()
+            self.out_buffer += BAD_REQUEST.render()
             self.timeout = 0
 
     # ============================================================
@@ -418,14 +416,17 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
             """
             if self.is_timing:
                 command_times[args[2]] = (args[0], args[1], time() * 1000)
-            scope.send_command({
-                    0: 1, # message type
-                    1: args[0],
-                    2: int(args[1]),
-                    3: 1,
-                    5: int(args[2]),
-                    8: self.raw_post_data,
-                })
+            msg = {
+                0: 1, # message type
+                1: args[0],
+                2: int(args[1]),
+                3: 1,
+                5: int(args[2]),
+                8: self.raw_post_data,
+            }
+            if recorder.is_recording:
+                recorder.record(DIRECTION_FROM_CLIENT, msg)
+            scope.send_command(msg)
             is_ok = True
         else:
             service = self.arguments[0]
@@ -437,39 +438,39 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
                 scope.send_command(msg)
                 is_ok = True
             else:
-                print "tried to send a command before %s was enabled" % service
+                logger.warning("tried to send a command before %s was enabled" % service)
         self.out_buffer += (is_ok and
                             self.RESPONSE_OK_OK or
-                            BAD_REQUEST) % get_timestamp()
+                            BAD_REQUEST).render()
         self.timeout = 0
 
     def snapshot(self):
         """store a markup snapshot"""
-        raw_data = self.raw_post_data
-        if raw_data:
-            name, data = raw_data.split(CRLF, 1)
-            f = open(name + ".xml", 'wb')
-            # f.write(pretty_dragonfly_snapshot(data))
-            data = data.replace("'=\"\"", "")
-            data = re.sub(r'<script(?:[^/>]|/[^>])*/>[ \r\n]*', '', data)
-            f.write(data.replace("'=\"\"", ""))
-            f.close()
-        self.out_buffer += self.RESPONSE_OK_OK % get_timestamp()
-        self.timeout = 0
+        if self.post_body.size:
+            self.wait_for_io(self.post_body.finish(save_snapshot),
+                             self.return_stored)
+        else:
+            self.out_buffer += self.RESPONSE_OK_OK.render()
+            self.timeout = 0
 
     def savefile(self):
         """save file"""
-        raw_data = self.raw_post_data
         file_name = self.arguments[0]
-        print file_name
-        if not os.path.exists("screenshots"):
-            os.mkdir("screenshots")
-
-        if raw_data:
-            f = open(os.path.join("screenshots", file_name), 'wb')
-            f.write(raw_data)
-            f.close()
-        self.out_buffer += self.RESPONSE_OK_OK % get_timestamp()
+        logger.info(file_name)
+        if self.post_body.size:
+            path = os.path.join("screenshots", file_name)
+            self.wait_for_io(self.post_body.finish(save_file, path),
+                             self.return_stored)
+        else:
+            self.out_buffer += self.RESPONSE_OK_OK.render()
+            self.timeout = 0
+
+    def return_stored(self, job):
+        if job.error:
+            logger.warning(">>> failed to store %s: %s" % (self.path, job.error))
+            self.out_buffer += BAD_REQUEST.render()
+        else:
+            self.out_buffer += self.RESPONSE_OK_OK.render()
         self.timeout = 0
 
     # ============================================================
@@ -480,10 +481,8 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
         service, payload = msg
         if self.debug:
             pretty_print_XML("\nsend to client: %s" % service, payload, self.debug_format)
-        self.out_buffer += self.SCOPE_MESSAGE_STP_0 % (
-            get_timestamp(),
-            service,
-            len(payload),
+        self.write_response(
+            self.SCOPE_MESSAGE_STP_0.render(service, len(payload)),
             payload)
         self.timeout = 0
         if not sender == self:
@@ -504,40 +503,49 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
             required binary payload = 8;
         }
         """
-        if not msg[8]:
+        payload = get_json_payload(msg)
+        if not payload:
             # workaround, status 204 does not work
-            msg[8] = ' '
-        if self.debug and (not self.debug_only_errors or msg[4] == MSG_TYPE_ERROR):
+            payload = msg[8] = ' '
+        if self.debug and (not self.debug_only_errors or msg[4] == MSG_TYPE_ERROR) and \
+           check_message(msg):
             pretty_print("send to client:", msg,
                                 self.debug_format, self.debug_format_payload, self.verbose_debug)
         if self.is_timing:
             tag = str(msg[5])
             if tag in command_times:
                 item = command_times.pop(tag)
-                print item[0],
-                print MessageMap.get_cmd_name(item[0], item[1]),
-                print time() * 1000 - item[2]
-        self.out_buffer += self.SCOPE_MESSAGE_STP_1 % (
-            get_timestamp(),
+                command = MessageMap.get_cmd_name(item[0], item[1])
+                duration = time() * 1000 - item[2]
+                logger.info("%s %s %s" % (item[0], command, duration),
+                            service=item[0], command=command, duration=duration)
+        if recorder.is_recording:
+            recorder.record(DIRECTION_TO_CLIENT, msg)
+        self.write_response(self.SCOPE_MESSAGE_STP_1.get_prefix() +
+                            msg.get_encoding(ENCODING, self.render_head_STP_1),
+                            payload)
+        self.timeout = 0
+        if not sender == self:
+            self.handle_write()
+
+    def render_head_STP_1(self, msg):
+        """Return the head of a message without the prefix,
+        the X-Scope-Message-* headers and the Content-Length"""
+        return self.SCOPE_MESSAGE_STP_1.render_template(
             msg[1], # service
             msg[2], # command
             msg[4], # status
             msg[5], # tag
-            len(msg[8]),
-            msg[8], # payload
-        )
-        self.timeout = 0
-        if not sender == self:
-            self.handle_write()
+            len(get_json_payload(msg)))
 
     def timeouthandler(self):
         if self in connections_waiting:
             connections_waiting.remove(self)
             if not self.command in ["get_message", "scope_message"]:
-                print ">>> failed, wrong connection type in queue"
-            self.out_buffer += self.RESPONSE_TIMEOUT % get_timestamp()
+                logger.warning(">>> failed, wrong connection type in queue")
+            self.out_buffer += self.RESPONSE_TIMEOUT.render()
         else:
-            self.out_buffer += NOT_FOUND % (get_timestamp(), 0, '')
+            self.out_buffer += NOT_FOUND.render(0)
         self.timeout = 0
 
     def flush(self):
@@ -550,9 +558,12 @@ class HTTPScopeInterface(httpconnection.HTTPConnection):
     # Implementations of the asyncore.dispatcher class methods
     # ============================================================
     def writable(self):
-        if self.timeout and time() > self.timeout and not self.out_buffer:
+        if self.io_jobs:
+            self.check_io()
+        if self.timeout and time() > self.timeout and \
+                not (self.out_buffer or self.out_queue):
             self.timeouthandler()
-        return bool(self.out_buffer)
+        return bool(self.out_buffer or self.out_queue or self.out_producers)
 
     def handle_close(self):
         if self in connections_waiting:
@@ -0,0 +1,252 @@
+"""Buffered log writer.
+
+All diagnostics of the proxy, the message dumps of --debug, the timing
+lines of --time and the warnings, go through logger, e.g.
+
+    logger.warning("failed to store %s: %s" % (path, error))
+    logger.debug(text, service=service, command=command_name)
+
+The loop thread only appends the records to a queue. The writer thread
+of the logger formats and writes them, to stdout or to --log-file, so
+that a slow terminal or pipe does not slow down the loop. It has its own
+thread, a blocked stdout does not hold up the jobs of the io pool. While
+a write is running the new records are collected and written with the
+next write.
+
+The queue is bounded, if more than --log-max-pending is waiting to be
+written the debug and info records are dropped and counted, warnings and
+errors are always kept. The count of the dropped records is written as a
+warning with the next write.
+
+With --log-json each record is written as one JSON object per line with
+the time, the level, the message and the keyword arguments of the call.
+The log file is rotated to FILE.1, FILE.2 and so on if it is bigger than
+--log-max-size.
+"""
+
+import os
+import sys
+import json
+import atexit
+import threading
+from time import time, strftime, localtime
+from collections import deque
+from common import rotate_file
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {
+    "debug": DEBUG,
+    "info": INFO,
+    "warning": WARNING,
+    "error": ERROR
+}
+LEVEL_NAMES = dict((level, name) for name, level in LEVELS.items())
+# records below WARNING are dropped if more than that waits to be written
+MAX_PENDING_SIZE = 4 * 1024 * 1024
+MAX_SIZE = 16 * 1024 * 1024
+BACKUP_COUNT = 4
+
+class LogWriter(object):
+    """Collects the records on the loop thread, the records are formatted
+    and written by the writer thread"""
+
+    def __init__(self):
+        self.level = DEBUG
+        self.path = None
+        self.is_json = False
+        self.max_size = MAX_SIZE
+        self.backup_count = BACKUP_COUNT
+        self.max_pending_size = MAX_PENDING_SIZE
+        self.record_count = 0
+        self.dropped_count = 0
+        # shared with the writer thread
+        self._lock = threading.Lock()
+        # notified if there are new records, waited for by the writer thread
+        self._has_records = threading.Condition(self._lock)
+        # notified if all records are written
+        self._written = threading.Condition(self._lock)
+        self._records = deque()
+        self._pending_size = 0
+        self._dropped = 0
+        self._is_writing = False
+        self._thread = None
+        # only touched by the writer thread, or with the lock held
+        # while the writer thread is idle
+        self._file = None
+        self._size = 0
+
+    def open(self, path=None, level=DEBUG, is_json=False, max_size=MAX_SIZE,
+             backup_count=BACKUP_COUNT, max_pending_size=MAX_PENDING_SIZE):
+        """Set the options, the records are written to path or,
+        without a path, to stdout"""
+        self.wait()
+        self.path = path
+        self.level = level
+        self.is_json = is_json
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.max_pending_size = max_pending_size
+        self._size = path and os.path.exists(path) and os.path.getsize(path) or 0
+
+    def log(self, level, message, **fields):
+        if level < self.level:
+            return
+        with self._lock:
+            if level < WARNING and self._pending_size > self.max_pending_size:
+                self._dropped += 1
+                self.dropped_count += 1
+                return
+            self._records.append((time(), level, message, fields))
+            self._pending_size += len(message)
+            self.record_count += 1
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            elif len(self._records) == 1:
+                self._has_records.notify()
+
+    def debug(self, message, **fields):
+        self.log(DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.log(INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.log(WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.log(ERROR, message, **fields)
+
+    def get_pending_size(self):
+        return self._pending_size
+
+    def wait(self):
+        """Wait until all records are written"""
+        with self._lock:
+            self._wait_written()
+
+    def close(self):
+        with self._lock:
+            self._wait_written()
+            self._close_file()
+
+    def _wait_written(self):
+        while self._records or self._is_writing:
+            self._written.wait()
+
+    # =====================================================
+    # the writer thread
+    # =====================================================
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._records:
+                    self._is_writing = False
+                    self._written.notify_all()
+                    self._has_records.wait()
+                self._is_writing = True
+                records = self._records
+                self._records = deque()
+                self._pending_size = 0
+                dropped = self._dropped
+                self._dropped = 0
+            if dropped:
+                records.append((time(), WARNING,
+                                "%s log records dropped" % dropped, {}))
+            try:
+                self._write_records(records)
+            except Exception, error:
+                try:
+                    sys.stderr.write("failed to write the log: %s\n" % error)
+                except Exception:
+                    pass
+
+    def _write_records(self, records):
+        if self.path:
+            encoding = "utf-8"
+        else:
+            encoding = getattr(sys.stdout, "encoding", None) or "utf-8"
+        lines = []
+        for timestamp, level, message, fields in records:
+            if self.is_json:
+                if isinstance(message, str):
+                    message = message.decode("utf-8", "replace")
+                record = dict(fields, time=round(timestamp, 6),
+                              level=LEVEL_NAMES.get(level, level),
+                              message=message)
+                lines.append(json.dumps(record, default=repr))
+            elif self.path:
+                if isinstance(message, unicode):
+                    message = message.encode(encoding, "replace")
+                lines.append("%s.%03d %-7s %s" % (
+                        strftime("%Y-%m-%d %H:%M:%S", localtime(timestamp)),
+                        timestamp * 1000 % 1000,
+                        LEVEL_NAMES.get(level, level),
+                        message))
+            else:
+                if isinstance(message, unicode):
+                    message = message.encode(encoding, "replace")
+                lines.append(message)
+        data = "\n".join(lines) + "\n"
+        if self.path:
+            if self._size + len(data) > self.max_size and self._size:
+                self._close_file()
+                rotate_file(self.path, self.backup_count)
+                self._size = 0
+            if not self._file:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory)
+                self._file = open(self.path, 'ab')
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+        else:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+
+    def _close_file(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+logger = LogWriter()
+atexit.register(logger.close)
+
+if __name__ == "__main__":
+    # benchmark of the time on the loop thread for a burst of debug
+    # output to a slow pipe, print against logger
+    import subprocess
+    COUNT = 2000
+    MESSAGE = "send to client:\n  message type: event\n  service: " \
+              "ecmascript-debugger\n  command: OnThreadStarted\n" * 2
+    # a reader which takes 64 KB per 10 ms
+    reader = subprocess.Popen([sys.executable, "-c",
+                               "import sys, time\n"
+                               "while sys.stdin.read(65536): time.sleep(0.01)"],
+                              stdin=subprocess.PIPE)
+    stdout = sys.stdout
+    sys.stdout = reader.stdin
+    try:
+        t = time()
+        for i in range(COUNT):
+            print MESSAGE
+        t_print = time() - t
+        logger.open(max_pending_size=256 * 1024)
+        t = time()
+        for i in range(COUNT):
+            logger.debug(MESSAGE)
+        t_logger = time() - t
+        logger.wait()
+    finally:
+        sys.stdout = stdout
+    reader.stdin.close()
+    reader.wait()
+    print "%-8s %8.1f us per record" % ("print", t_print / COUNT * 1000000)
+    print "%-8s %8.1f us per record, %s of %s dropped" % (
+        "logger", t_logger / COUNT * 1000000, logger.dropped_count, COUNT)
@@ -0,0 +1,392 @@
+"""A mock STP host to test dragonkeeper without Opera.
+
+Connects to the proxy port like Opera does, sends the service list with
+STP/0, switches to STP/1 when the proxy enables it and answers the
+commands of the scope service, Connect, HostInfo, Info, MessageInfo and
+EnumInfo, from fixture data. Any other command gets an empty response.
+Events are generated at a given rate and size, e.g.
+
+    python mockhost.py --events ecmascript-debugger:14:1000:200 localhost 7001
+
+sends 1000 events per second with a payload of 200 bytes, each payload is
+
+    [<sequence number>, <time in ms>, "<padding>"]
+
+so that a client can measure the latency through the proxy. With a rate
+of 0 the events are sent as fast as the proxy takes them. The results are
+printed as JSON.
+
+The fixture is a JSON file like DEFAULT_FIXTURE, --fixture, e.g. with
+the responses of a real host.
+
+If the proxy connects with the protobuf format the events and the
+responses of the services other than scope are encoded with the message
+definitions of the fixture, the field types are the types of protobuf.
+Messages which are already protobuf, e.g. the replayed messages of a
+recording made with --host-format protobuf, are sent as they are, or
+decoded to JSON if the proxy connects with the JSON format.
+"""
+
+import json
+import socket
+import asyncore
+import argparse
+from time import time
+from common import BLANK, BUFFERSIZE, decode_varuint
+from stprecorder import parse_stp_1_message, encode_stp_1_message
+from stprecorder import TYPE, SERVICE, COMMAND, FORMAT, STATUS, TAG, PAYLOAD
+from protobuf import encode_message, decode_message, ERROR_INFO
+from utils import compile_service
+
+MSG_TYPE_COMMAND = 1
+MSG_TYPE_RESPONSE = 2
+MSG_TYPE_EVENT = 3
+MSG_TYPE_ERROR = 4
+COMMAND_CONNECT = 3
+COMMAND_DISCONNECT = 4
+COMMAND_INFO = 7
+COMMAND_HOST_INFO = 10
+COMMAND_MESSAGE_INFO = 11
+COMMAND_ENUM_INFO = 12
+FORMAT_PROTOBUF = 0
+FORMAT_JSON = 1
+STP_1_PREFIX = "STP\x01"
+# no events are generated while more than that waits to be sent
+HIGH_WATER_MARK = 1024 * 1024
+
+DEFAULT_FIXTURE = {
+    "core_version": "2.10.1",
+    "platform": "linux",
+    "os": "Linux",
+    "user_agent": "Dragonkeeper mock host",
+    "services": {
+        "scope": {
+            "version": "1.1",
+        },
+        "console-logger": {
+            "version": "2.0",
+        },
+        "window-manager": {
+            "version": "2.0",
+        },
+        "ecmascript-debugger": {
+            "version": "6.0",
+            # Info
+            "info": [
+                [["ListRuntimes", 1, 1, 2]],
+                [["OnLoadEvent", 14, 3]]
+            ],
+            # MessageInfo
+            "message_info": [[
+                [1, "RuntimeSelection", [["runtimeIDList", 13, 1, 2],
+                                         ["create", 8, 2, 1]]],
+                [2, "RuntimeList", [["runtimeList", 11, 1, 2, 4]]],
+                [3, "LoadEvent", [["sequence", 13, 1],
+                                  ["time", 4, 2],
+                                  ["data", 9, 3]]],
+                [4, "RuntimeInfo", [["runtimeID", 13, 1],
+                                    ["htmlFramePath", 9, 2],
+                                    ["windowID", 13, 3],
+                                    ["objectID", 13, 4],
+                                    ["uri", 9, 5]]]
+            ]],
+            # EnumInfo
+            "enum_info": [[]],
+            # command number -> payload of the response
+            "responses": {
+                "1": [[[1, "_top", 1, 1, "http://localhost/"]]]
+            }
+        }
+    }
+}
+
+class Stats(object):
+
+    def __init__(self):
+        self.commands_received = 0
+        self.responses_sent = 0
+        self.events_sent = 0
+        self.events_dropped = 0
+        self.bytes_sent = 0
+
+    def report(self, duration):
+        return {"duration": round(duration, 3),
+                "commands_received": self.commands_received,
+                "responses_sent": self.responses_sent,
+                "events_sent": self.events_sent,
+                "events_per_s": round(self.events_sent / duration, 1),
+                "events_dropped": self.events_dropped,
+                "bytes_sent": self.bytes_sent,
+                "bytes_per_s": round(self.bytes_sent / duration, 1)}
+
+class EventSource(object):
+    """Generates the events of a --events argument"""
+
+    def __init__(self, spec):
+        service, command, rate, size = spec.split(":")
+        self.service = service
+        self.command = int(command)
+        self.rate = float(rate)
+        self.size = int(size)
+        self.sequence = 0
+        self.next_time = 0
+
+    def make_message(self, now):
+        self.sequence += 1
+        payload = '[%s,%s,"' % (self.sequence, int(now * 1000))
+        payload += "x" * max(0, self.size - len(payload) - 2) + '"]'
+        return {TYPE: MSG_TYPE_EVENT,
+                SERVICE: self.service,
+                COMMAND: self.command,
+                FORMAT: 1,
+                STATUS: 0,
+                TAG: 0,
+                PAYLOAD: payload}
+
+class MockHost(asyncore.dispatcher):
+
+    def __init__(self, args, fixture, stats):
+        asyncore.dispatcher.__init__(self)
+        self.args = args
+        self.fixture = fixture
+        self.stats = stats
+        self.in_buffer = ""
+        self.out_buffer = bytearray()
+        self.is_stp_1 = False
+        self.is_sending_events = False
+        self.is_closed = False
+        # the format of the Connect command
+        self.format = FORMAT_JSON
+        # service -> message map of the service, compiled from the fixture
+        self.maps = {}
+        self.event_sources = [EventSource(spec) for spec in args.events]
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((args.host, args.port))
+
+    def send_STP_0(self, msg):
+        self.out_buffer += ("%s %s" % (len(msg), msg)).encode("UTF-16BE")
+
+    def send_STP_1(self, msg):
+        format = msg.get(FORMAT, FORMAT_JSON)
+        if not msg[SERVICE] == "scope" and not format == self.format:
+            fields = self.get_fields(msg)
+            if format == FORMAT_JSON:
+                msg = dict(msg)
+                msg[FORMAT] = FORMAT_PROTOBUF
+                msg[PAYLOAD] = encode_message(json.loads(msg[PAYLOAD]), fields)
+            elif fields or not msg[PAYLOAD]:
+                msg = dict(msg)
+                msg[FORMAT] = FORMAT_JSON
+                msg[PAYLOAD] = json.dumps(decode_message(msg[PAYLOAD], fields),
+                                          separators=(',', ':'))
+        data = encode_stp_1_message(msg)
+        self.out_buffer += data
+        self.stats.bytes_sent += len(data)
+
+    def get_fields(self, msg):
+        """Return the message definition of msg, an empty list if the
+        fixture does not define it"""
+        if msg[TYPE] == MSG_TYPE_ERROR:
+            return ERROR_INFO
+        if not msg[SERVICE] in self.maps:
+            service = self.fixture["services"].get(msg[SERVICE], {})
+            self.maps[msg[SERVICE]] = "message_info" in service and \
+                compile_service(service["info"],
+                                service["message_info"],
+                                service.get("enum_info", [[]])[0]) or {}
+        command = self.maps[msg[SERVICE]].get(msg[COMMAND], {})
+        return command.get(msg[TYPE], [])
+
+    def start_events(self):
+        now = time()
+        for source in self.event_sources:
+            source.next_time = now
+        self.is_sending_events = True
+
+    def tick(self, now):
+        """Send the events which are due"""
+        if not self.is_sending_events:
+            return
+        for source in self.event_sources:
+            if source.rate:
+                while source.next_time <= now:
+                    source.next_time += 1.0 / source.rate
+                    if len(self.out_buffer) > HIGH_WATER_MARK:
+                        self.stats.events_dropped += 1
+                    else:
+                        self.send_STP_1(source.make_message(now))
+                        self.stats.events_sent += 1
+            else:
+                while len(self.out_buffer) < HIGH_WATER_MARK:
+                    self.send_STP_1(source.make_message(now))
+                    self.stats.events_sent += 1
+
+    # ============================================================
+    # STP 0
+    # ============================================================
+
+    def read_STP_0(self):
+        # the STP/0 messages are UTF-16BE encoded '<length> <message>'
+        while not self.is_stp_1:
+            text = self.in_buffer[0:len(self.in_buffer) & ~1].decode("UTF-16BE")
+            if not BLANK in text:
+                break
+            raw_length, msg = text.split(BLANK, 1)
+            length = int(raw_length)
+            if len(msg) < length:
+                break
+            self.in_buffer = self.in_buffer[(len(raw_length) + 1 + length) * 2:]
+            if msg[0:length] == "*enable stp-1":
+                self.out_buffer += "STP/1\n"
+                self.is_stp_1 = True
+                if not self.args.wait_for_connect:
+                    self.start_events()
+
+    # ============================================================
+    # STP 1
+    # ============================================================
+
+    def read_STP_1(self):
+        pos = 0
+        while True:
+            if not self.in_buffer.startswith(STP_1_PREFIX, pos):
+                if len(self.in_buffer) - pos >= len(STP_1_PREFIX):
+                    raise ValueError("not a valid STP/1 message")
+                break
+            length, start = decode_varuint(self.in_buffer, pos + len(STP_1_PREFIX))
+            if length is None or start + length > len(self.in_buffer):
+                break
+            self.handle_command(parse_stp_1_message(self.in_buffer[pos:start + length]))
+            pos = start + length
+        self.in_buffer = self.in_buffer[pos:]
+
+    def handle_command(self, msg):
+        self.stats.commands_received += 1
+        payload = "[]"
+        if msg[SERVICE] == "scope":
+            payload = self.get_scope_response(msg)
+        else:
+            service = self.fixture["services"].get(msg[SERVICE], {})
+            response = service.get("responses", {}).get(str(msg[COMMAND]))
+            if response is not None:
+                payload = json.dumps(response)
+        self.send_STP_1({TYPE: MSG_TYPE_RESPONSE,
+                         SERVICE: msg[SERVICE],
+                         COMMAND: msg[COMMAND],
+                         FORMAT: FORMAT_JSON,
+                         STATUS: 0,
+                         TAG: msg.get(TAG, 0),
+                         PAYLOAD: payload})
+        self.stats.responses_sent += 1
+
+    def get_scope_response(self, msg):
+        services = self.fixture["services"]
+        if msg[COMMAND] == COMMAND_CONNECT:
+            if json.loads(msg[PAYLOAD]) == ["protobuf"]:
+                self.format = FORMAT_PROTOBUF
+            else:
+                self.format = FORMAT_JSON
+            if self.args.wait_for_connect and not self.is_sending_events:
+                self.start_events()
+            return "[]"
+        if msg[COMMAND] == COMMAND_DISCONNECT:
+            if self.args.wait_for_connect:
+                self.is_sending_events = False
+            return "[]"
+        if msg[COMMAND] == COMMAND_HOST_INFO:
+            return json.dumps([1,
+                               self.fixture["core_version"],
+                               self.fixture["platform"],
+                               self.fixture["os"],
+                               self.fixture["user_agent"],
+                               [[name, service["version"]]
+                                for name, service in sorted(services.items())]])
+        if msg[COMMAND] in [COMMAND_INFO, COMMAND_MESSAGE_INFO, COMMAND_ENUM_INFO]:
+            service = services.get(json.loads(msg[PAYLOAD])[0], {})
+            if msg[COMMAND] == COMMAND_INFO:
+                return json.dumps(service.get("info", [[], []]))
+            if msg[COMMAND] == COMMAND_MESSAGE_INFO:
+                return json.dumps(service.get("message_info", [[]]))
+            return json.dumps(service.get("enum_info", [[]]))
+        return "[]"
+
+    # ============================================================
+    # Implementations of the asyncore.dispatcher class methods
+    # ============================================================
+
+    def handle_connect(self):
+        self.send_STP_0("*services %s" % ",".join(
+                ["stp-1"] + sorted(self.fixture["services"].keys())))
+
+    def handle_read(self):
+        data = self.recv(BUFFERSIZE)
+        if not data:
+            return
+        self.in_buffer += data
+        if not self.is_stp_1:
+            self.read_STP_0()
+        if self.is_stp_1:
+            self.read_STP_1()
+
+    def writable(self):
+        return bool(self.out_buffer) or not self.connected
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        del self.out_buffer[0:sent]
+
+    def handle_close(self):
+        self.is_sending_events = False
+        self.is_closed = True
+        self.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="""
+        Mock STP host for load and regression tests of dragonkeeper.
+        Prints the results as JSON.""")
+    parser.add_argument("host", nargs="?", default="localhost")
+    parser.add_argument("port", nargs="?", type=int, default=7001,
+                        help="the proxy port of dragonkeeper (default: %(default)s)")
+    parser.add_argument("-e", "--events",
+                        action="append",
+                        default=[],
+                        help="events to generate as SERVICE:COMMAND:RATE:SIZE, "
+                             "RATE in events per second, 0 for as fast as "
+                             "possible, SIZE of the payload in bytes, "
+                             "can be repeated")
+    parser.add_argument("--fixture",
+                        help="JSON file with the responses of the scope service, "
+                             "see DEFAULT_FIXTURE")
+    parser.add_argument("--wait-for-connect",
+                        action="store_true",
+                        default=False,
+                        help="send events only while a client is connected")
+    parser.add_argument("-d", "--duration",
+                        type=float,
+                        default=10,
+                        help="duration in seconds, 0 to run until interrupted (default: %(default)s)")
+    return parser.parse_args()
+
+def run(args, fixture=DEFAULT_FIXTURE):
+    """Run the mock host, return the report"""
+    stats = Stats()
+    host = MockHost(args, fixture, stats)
+    start = time()
+    end = args.duration and start + args.duration or None
+    now = start
+    try:
+        while (not end or now < end) and not host.is_closed:
+            asyncore.loop(timeout=0.001, count=1)
+            now = time()
+            host.tick(now)
+    except KeyboardInterrupt:
+        pass
+    host.close()
+    return stats.report(time() - start)
+
+if __name__ == "__main__":
+    args = _parse_args()
+    fixture = DEFAULT_FIXTURE
+    if args.fixture:
+        fixture = json.load(open(args.fixture, 'rb'))
+    print json.dumps(run(args, fixture), indent=2, sort_keys=True)
@@ -0,0 +1,302 @@
+"""Protocol buffer payloads of STP/1.
+
+With --host-format protobuf the proxy connects to the host with format 0,
+the host sends the payloads as protocol buffers. The payloads are
+transcoded to the JSON format only if a client or the debug printer
+needs them, with the field definitions of the message map, e.g.
+
+    payload = decode_message(msg[PAYLOAD], message_map[service][command][msg_type])
+
+returns the same list as json.loads of the payload in the JSON format:
+the values in the order of the field definitions, None for a missing
+optional field, a list for a repeated field and a list of the values for
+a nested message. Unknown field numbers are skipped. The field types are
+the types of the FieldDescriptorProto of protocol buffers, as reported
+by MessageInfo of the scope service.
+
+encode_message is the other direction, for the commands of the JSON
+clients and for the mock host.
+"""
+
+import struct
+from common import encode_varuint, decode_varuint
+
+# wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH = 2
+FIXED32 = 5
+
+# field types
+DOUBLE = 1
+FLOAT = 2
+INT64 = 3
+UINT64 = 4
+INT32 = 5
+FIXED64_TYPE = 6
+FIXED32_TYPE = 7
+BOOL = 8
+STRING = 9
+MESSAGE = 11
+BYTES = 12
+UINT32 = 13
+ENUM = 14
+SFIXED32 = 15
+SFIXED64 = 16
+SINT32 = 17
+SINT64 = 18
+
+WIRE_TYPES = {
+    DOUBLE: FIXED64,
+    FLOAT: FIXED32,
+    INT64: VARINT,
+    UINT64: VARINT,
+    INT32: VARINT,
+    FIXED64_TYPE: FIXED64,
+    FIXED32_TYPE: FIXED32,
+    BOOL: VARINT,
+    STRING: LENGTH,
+    MESSAGE: LENGTH,
+    BYTES: LENGTH,
+    UINT32: VARINT,
+    ENUM: VARINT,
+    SFIXED32: FIXED32,
+    SFIXED64: FIXED64,
+    SINT32: VARINT,
+    SINT64: VARINT
+}
+STRUCT_FORMATS = {
+    DOUBLE: "<d",
+    FLOAT: "<f",
+    FIXED64_TYPE: "<Q",
+    FIXED32_TYPE: "<I",
+    SFIXED32: "<i",
+    SFIXED64: "<q"
+}
+SIGNED_TYPES = [INT32, INT64, ENUM]
+ZIGZAG_TYPES = [SINT32, SINT64]
+SIZES = {FIXED64: 8, FIXED32: 4}
+
+class ErrorField(object):
+    """A field of ErrorInfo, like a FieldDef of the message map"""
+
+    def __init__(self, name, type, number):
+        self.name = name
+        self.type = type
+        self.number = number
+        self.q = "optional"
+        self.message = None
+        self.enum = None
+
+# the payload of the messages with the message type error,
+# they are not in the message map
+ERROR_INFO = [ErrorField("description", STRING, 1),
+              ErrorField("line", UINT32, 2),
+              ErrorField("column", UINT32, 3),
+              ErrorField("offset", UINT32, 4)]
+
+# id(fields) -> (fields, {key: (index, mode, convert)}, indexes of the repeated fields)
+_layouts = {}
+# the modes of a key
+SINGLE = 0
+REPEATED = 1
+PACKED = 2
+
+def _get_layout(fields):
+    """The fields are indexed by the key of the wire format, the field
+    number and the wire type. Each key has a function to convert the
+    value to the JSON format, or None if it is taken as it is."""
+    layout = _layouts.get(id(fields))
+    if not layout or not layout[0] is fields:
+        keys = {}
+        repeated = []
+        for index, field in enumerate(fields):
+            wire_type = field.message and LENGTH or WIRE_TYPES.get(field.type, LENGTH)
+            convert = _get_converter(field, wire_type)
+            if field.q == "repeated":
+                repeated.append(index)
+                keys[field.number << 3 | wire_type] = (index, REPEATED, convert)
+                if not wire_type == LENGTH:
+                    keys[field.number << 3 | LENGTH] = (
+                        index, PACKED, _get_unpacker(wire_type, convert))
+            else:
+                keys[field.number << 3 | wire_type] = (index, SINGLE, convert)
+        layout = _layouts[id(fields)] = (fields, keys, repeated)
+    return layout
+
+def _decode_string(value):
+    return value.decode("utf-8", "replace")
+
+def _get_converter(field, wire_type):
+    """Return the function to convert a value of field, or None"""
+    type = field.type
+    if field.message:
+        message_fields = field.message.fields
+        return lambda value: decode_message(value, message_fields)
+    if wire_type == LENGTH:
+        return _decode_string
+    if type in STRUCT_FORMATS:
+        unpack = struct.Struct(STRUCT_FORMATS[type]).unpack
+        return lambda value: unpack(value)[0]
+    if wire_type in SIZES:
+        unpack = struct.Struct(wire_type == FIXED64 and "<Q" or "<I").unpack
+        return lambda value: unpack(value)[0]
+    if type in SIGNED_TYPES:
+        return lambda value: value >= 1 << 63 and value - (1 << 64) or value
+    if type in ZIGZAG_TYPES:
+        return lambda value: (value >> 1) ^ -(value & 1)
+    if type == BOOL:
+        return bool
+    return None
+
+def _get_unpacker(wire_type, convert):
+    """Return the function to read the values of a packed repeated field"""
+    def unpack(data):
+        values = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if wire_type == VARINT:
+                value, pos = decode_varuint(data, pos)
+                if value is None:
+                    raise ValueError("truncated packed field")
+            else:
+                value = data[pos:pos + SIZES[wire_type]]
+                pos += SIZES[wire_type]
+            if convert:
+                value = convert(value)
+            values.append(value)
+        return values
+    return unpack
+
+def decode_message(data, fields):
+    """Return the payload of a protobuf message as in the JSON format.
+    Raises ValueError if the data is not a valid message."""
+    fields, keys, repeated = _get_layout(fields)
+    payload = [None] * len(fields)
+    for index in repeated:
+        payload[index] = []
+    pos = 0
+    end = len(data)
+    try:
+        while pos < end:
+            # most keys, values and lengths are a single byte
+            key = ord(data[pos])
+            pos += 1
+            if key & 0x80:
+                key, pos = decode_varuint(data, pos - 1)
+            wire_type = key & 7
+            if wire_type == VARINT:
+                value = ord(data[pos])
+                pos += 1
+                if value & 0x80:
+                    value, pos = decode_varuint(data, pos - 1)
+            elif wire_type == LENGTH:
+                length = ord(data[pos])
+                pos += 1
+                if length & 0x80:
+                    length, pos = decode_varuint(data, pos - 1)
+                value = data[pos:pos + length]
+                pos += length
+            elif wire_type in SIZES:
+                value = data[pos:pos + SIZES[wire_type]]
+                pos += SIZES[wire_type]
+            else:
+                raise ValueError("unsupported wire type %s" % wire_type)
+            if pos > end or value is None:
+                raise ValueError("truncated message")
+            entry = keys.get(key)
+            if entry:
+                index, mode, convert = entry
+                if convert:
+                    value = convert(value)
+                if mode == SINGLE:
+                    payload[index] = value
+                elif mode == REPEATED:
+                    payload[index].append(value)
+                else:
+                    payload[index].extend(value)
+    except (IndexError, TypeError, struct.error):
+        raise ValueError("truncated message")
+    while payload and payload[-1] is None:
+        payload.pop()
+    return payload
+
+def _encode_value(field, value):
+    type = field.type
+    if field.message:
+        return encode_message(value or [], field.message.fields)
+    if type in STRUCT_FORMATS:
+        return struct.pack(STRUCT_FORMATS[type], value)
+    if type in ZIGZAG_TYPES:
+        return encode_varuint((value << 1) ^ (value >> 63))
+    if WIRE_TYPES.get(type) == VARINT:
+        return encode_varuint(int(value))
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def encode_message(payload, fields):
+    """Return the protobuf message of a payload in the JSON format"""
+    out = []
+    for field, value in zip(fields, payload):
+        if value is None:
+            continue
+        wire_type = field.message and LENGTH or WIRE_TYPES.get(field.type, LENGTH)
+        key = encode_varuint(field.number << 3 | wire_type)
+        for item in field.q == "repeated" and value or [value]:
+            data = _encode_value(field, item)
+            if wire_type == LENGTH:
+                out.extend([key, encode_varuint(len(data)), data])
+            else:
+                out.extend([key, data])
+    return "".join(out)
+
+if __name__ == "__main__":
+    # size and transcoding time of a runtime list and of a small event,
+    # JSON against protocol buffers
+    import json
+    import timeit
+    from utils import compile_service
+    COUNT = 10000
+    service_map = compile_service(
+        [[["ListRuntimes", 1, 1, 2]], [["OnThreadStarted", 9, 3]]],
+        [[[1, "RuntimeSelection", [["runtimeIDList", UINT32, 1, 2],
+                                   ["create", BOOL, 2, 1]]],
+          [2, "RuntimeList", [["runtimeList", MESSAGE, 1, 2, 4]]],
+          [3, "ThreadInfo", [["runtimeID", UINT32, 1],
+                             ["threadID", UINT32, 2],
+                             ["parentThreadID", UINT32, 3],
+                             ["threadType", STRING, 4],
+                             ["eventNamespaceURI", STRING, 5, 1],
+                             ["eventType", STRING, 6, 1]]],
+          [4, "RuntimeInfo", [["runtimeID", UINT32, 1],
+                              ["htmlFramePath", STRING, 2],
+                              ["windowID", UINT32, 3],
+                              ["objectID", UINT32, 4],
+                              ["uri", STRING, 5],
+                              ["description", STRING, 6, 1]]]]],
+        [])
+    payloads = [
+        ("OnThreadStarted", service_map[9][3],
+         '[1,2,0,"inline",null,"load"]'),
+        ("ListRuntimes", service_map[1][2],
+         "[[%s]]" % ",".join(['[%s,"_top",1,%s,"http://localhost/%s"]' % (i, i, i)
+                              for i in range(50)]))]
+    for name, fields, json_payload in payloads:
+        payload = json.loads(json_payload)
+        data = encode_message(payload, fields)
+        assert decode_message(data, fields) == payload
+        t_json = min(timeit.repeat(lambda: json.loads(json_payload),
+                                   number=COUNT, repeat=3))
+        t_decode = min(timeit.repeat(lambda: decode_message(data, fields),
+                                     number=COUNT, repeat=3))
+        t_transcode = min(timeit.repeat(
+                lambda: json.dumps(decode_message(data, fields), separators=(',', ':')),
+                number=COUNT, repeat=3))
+        print "%s:" % name
+        print "  %-12s %6s bytes %7.2f us to parse" % (
+                "json", len(json_payload), t_json / COUNT * 1000000)
+        print "  %-12s %6s bytes %7.2f us to decode %7.2f us to transcode" % (
+                "protobuf", len(data), t_decode / COUNT * 1000000,
+                t_transcode / COUNT * 1000000)
@@ -0,0 +1,321 @@
+"""Streamed request bodies.
+
+Big POST bodies, e.g. screenshots and markup snapshots, are not collected
+in the in_buffer of the connection. The connection hands each received
+chunk to a SpooledBody, which keeps the body in memory up to a threshold
+and appends the rest to a temporary file. All file operations run on the
+threads of io_pool, the loop thread never blocks on the disk.
+
+SpooledBody.finish schedules a function which streams the body to its
+destination, block by block. It returns an IOJob which is polled by the
+connection (see HTTPConnection.wait_for_io).
+"""
+
+import os
+import re
+import json
+import string
+import shutil
+import tempfile
+import threading
+from Queue import Queue
+from cStringIO import StringIO
+from collections import deque
+from base64 import b64decode
+from common import CRLF, URI_to_system_path
+
+# bodies bigger than that are written to a temporary file
+SPOOL_THRESHOLD = 1024 * 1024
+# chunks are collected up to that size before they are handed to the io pool
+SPOOL_BLOCK_SIZE = 256 * 1024
+# the connection stops reading if more than that waits for the io pool
+MAX_PENDING_IO = 4 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+IO_THREADS = 2
+BASE64_CHARS = frozenset(string.ascii_letters + string.digits + "+/=")
+# the escapes of a JSON string which can be part of a base64 string,
+# the line breaks of wrapped base64 are dropped
+BASE64_ESCAPES = {"n": "", "r": "", "t": "", "/": "/"}
+
+class IOJob(object):
+    """A function call to be executed on the io pool"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception, error:
+            self.error = error
+        self.done = True
+
+class IOPool(object):
+    """A small pool of threads for blocking file operations.
+    Jobs submitted with the same key run in order on the same thread."""
+
+    def __init__(self, size=IO_THREADS):
+        self._size = size
+        self._queues = None
+
+    def _start(self):
+        self._queues = []
+        for i in range(self._size):
+            queue = Queue()
+            thread = threading.Thread(target=self._work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+
+    def _work(self, queue):
+        while True:
+            queue.get().run()
+
+    def submit(self, key, func, *args):
+        if not self._queues:
+            self._start()
+        job = IOJob(func, args)
+        self._queues[hash(key) % self._size].put(job)
+        return job
+
+io_pool = IOPool()
+
+class SpooledBody(object):
+    """A request body which is kept in memory up to threshold,
+    past that it is appended to a temporary file on the io pool.
+    write is called on the loop thread, the file is only touched
+    by the jobs of the io pool."""
+
+    def __init__(self, threshold=SPOOL_THRESHOLD):
+        self.threshold = threshold
+        self.size = 0
+        self._chunks = []
+        self._chunks_size = 0
+        self._is_spooled = False
+        self._file = None
+        self._jobs = deque()
+        self._pending_size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self._chunks.append(data)
+        self._chunks_size += len(data)
+        if self.size > self.threshold:
+            self._is_spooled = True
+        if self._is_spooled and self._chunks_size >= SPOOL_BLOCK_SIZE:
+            self._flush()
+
+    def pending_size(self):
+        """Return the size of the data which waits for the io pool"""
+        while self._jobs and self._jobs[0][0].done:
+            self._pending_size -= self._jobs.popleft()[1]
+        return self._pending_size
+
+    def finish(self, func, *args):
+        """Call func(file, *args) on the io pool after all data is written.
+        file is the body, positioned at the start."""
+        if self._is_spooled:
+            self._flush()
+        return io_pool.submit(id(self), self._finish, func, args)
+
+    def _flush(self):
+        data = "".join(self._chunks)
+        self._chunks = []
+        self._chunks_size = 0
+        self._jobs.append((io_pool.submit(id(self), self._spool, data),
+                           len(data)))
+        self._pending_size += len(data)
+
+    def _spool(self, data):
+        if not self._file:
+            self._file = tempfile.TemporaryFile()
+        self._file.write(data)
+
+    def _finish(self, func, args):
+        if self._file:
+            file = self._file
+            file.seek(0)
+        else:
+            file = StringIO("".join(self._chunks))
+            self._chunks = []
+        try:
+            return func(file, *args)
+        finally:
+            file.close()
+            self._file = None
+
+# =====================================================
+# finish functions, they are called on the io pool
+# =====================================================
+
+def save_file(file, path):
+    """Copy the body to path"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.mkdir(directory)
+    dest = open(path, 'wb')
+    try:
+        shutil.copyfileobj(file, dest, BLOCK_SIZE)
+    finally:
+        dest.close()
+
+RE_SCRIPT = re.compile(r'<script(?:[^/>]|/[^>])*/>[ \r\n]*')
+
+def _clean_snapshot(data):
+    return RE_SCRIPT.sub('', data.replace("'=\"\"", ""))
+
+def save_snapshot(file):
+    """Store a markup snapshot.
+    The first line of the body is the name of the file,
+    the rest is the markup. Empty script elements and broken
+    attributes are removed block by block."""
+    name = file.readline().rstrip(CRLF)
+    dest = open(name + ".xml", 'wb')
+    try:
+        carry = ""
+        while True:
+            block = file.read(BLOCK_SIZE)
+            if not block:
+                break
+            data = carry + block
+            # cut before the last tag, it may continue in the next block
+            cut = data.rfind('<')
+            if cut == -1:
+                cut = max(0, len(data) - len("'=\"\""))
+            dest.write(_clean_snapshot(data[0:cut]))
+            carry = data[cut:]
+        dest.write(_clean_snapshot(carry))
+    finally:
+        dest.close()
+
+HEAD = 0
+DATA = 1
+TAIL = 2
+
+def _unescape_base64(text):
+    """Return the base64 characters of the JSON string text and the
+    unfinished escape at its end, to be continued with the next block.
+    Raise ValueError for an escape which can't be part of base64."""
+    if not '\\' in text:
+        return text, ""
+    out = []
+    pos = 0
+    while True:
+        index = text.find('\\', pos)
+        if index == -1:
+            out.append(text[pos:])
+            return "".join(out), ""
+        out.append(text[pos:index])
+        char = text[index + 1:index + 2]
+        if not char:
+            return "".join(out), text[index:]
+        if char == "u":
+            code = text[index + 2:index + 6]
+            if len(code) < 4:
+                return "".join(out), text[index:]
+            if not all(c in string.hexdigits for c in code):
+                raise ValueError("invalid escape in base64 string")
+            value = int(code, 16)
+            char = value < 0x80 and chr(value) or ""
+            if char in BASE64_CHARS:
+                out.append(char)
+            elif not char in "\n\r\t ":
+                raise ValueError("invalid escape in base64 string")
+            pos = index + 6
+        elif char in BASE64_ESCAPES:
+            out.append(BASE64_ESCAPES[char])
+            pos = index + 2
+        else:
+            raise ValueError("invalid escape in base64 string")
+
+def extract_base64_member(file, dest, name, block_size=BLOCK_SIZE):
+    """Decode the base64 encoded string member name of the JSON object
+    in file to dest, in blocks of block_size.
+    Return the object without that member."""
+    re_start = re.compile(r'"%s"\s*:\s*"' % name)
+    state = HEAD
+    head = ""
+    json_text = []
+    rest = ""
+    escape = ""
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        if state == HEAD:
+            head += block
+            match = re_start.search(head)
+            if not match:
+                continue
+            json_text.append(head[0:match.end()])
+            block = head[match.end():]
+            head = ""
+            state = DATA
+        if state == DATA:
+            end = block.find('"')
+            text, escape = _unescape_base64(escape + (end == -1 and block or block[0:end]))
+            if escape and not end == -1:
+                raise ValueError("invalid escape in base64 string")
+            data = rest + text
+            pos = len(data) - len(data) % 4
+            dest.write(b64decode(data[0:pos]))
+            rest = data[pos:]
+            if end == -1:
+                continue
+            block = block[end:]
+            state = TAIL
+        json_text.append(block)
+    if not state == TAIL or rest or escape:
+        raise ValueError("no valid base64 member %s" % name)
+    return json.loads("".join(json_text))
+
+def save_base64_png(file, file_name):
+    """Decode a message like
+        {
+            directory: <relative URL>,
+            data: <base64 string>
+        }
+    to the file file_name in directory"""
+    tmp = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
+    try:
+        try:
+            msg = extract_base64_member(file, tmp, "data")
+        finally:
+            tmp.close()
+        sys_path = URI_to_system_path(msg.get("directory"))
+        if not os.path.exists(sys_path):
+            os.mkdir(sys_path)
+        shutil.move(tmp.name, os.path.join(sys_path, file_name))
+    except:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+    return file_name
+
+if __name__ == "__main__":
+    # the base64 member is decoded like json.loads(body)["data"].decode("base64"),
+    # also for wrapped base64 and escapes split between the blocks
+    import base64
+    data = os.urandom(3000)
+    bodies = [json.dumps({"directory": "/x", "data": base64.encodestring(data)}),
+              json.dumps({"directory": "/x", "data": base64.b64encode(data)}),
+              json.dumps({"data": base64.b64encode(data)}).replace("/", "\\/"),
+              json.dumps({"data": base64.encodestring(data)}).replace("\\n", "\\u000a")]
+    for block_size in [1, 2, 3, 5, 7, 64, BLOCK_SIZE]:
+        for body in bodies:
+            dest = StringIO()
+            msg = extract_base64_member(StringIO(body), dest, "data", block_size)
+            assert dest.getvalue() == json.loads(body)["data"].decode("base64") == data
+            assert msg.get("directory") == json.loads(body).get("directory")
+    for body in ['{"data": "QUJD\\"RA=="}', '{"data": "QUJD\\\\RA=="}',
+                 '{"data": "QUJD\\u0021RA="}', '{"data": "QUJDRA\\u003"}']:
+        try:
+            extract_base64_member(StringIO(body), StringIO(), "data")
+        except ValueError:
+            continue
+        raise AssertionError("accepted %r" % body)
+    print "ok"
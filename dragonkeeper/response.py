@@ -0,0 +1,116 @@
+"""Precompiled HTTP response heads.
+
+The % templates in common.py are formatted as a whole for each response,
+including the Date header and the body. A ResponseHead keeps the status
+line, the Date and the Server header as one prefix which is rebuilt at most
+once a second, the rest of the head is a small template with only the
+per response values, e.g. the X-Scope-Message-* headers and the
+Content-Length. The body is not part of the head, it is handed to
+HTTPConnection.write_response as a separate buffer.
+"""
+
+from time import time
+from common import CRLF, get_timestamp
+from common import __version__ as VERSION
+
+class ResponseHead(object):
+    """A response head with a cached Date header.
+    template is everything after the Server header,
+    including the terminating empty line."""
+
+    def __init__(self, code, token, template=CRLF):
+        self._status = 'HTTP/1.1 %s %s' % (code, token) + CRLF + 'Date: '
+        self._server = CRLF + 'Server: Dragonkeeper/%s' % VERSION + CRLF
+        self._template = template
+        self._prefix = ''
+        self._time = 0
+
+    def get_prefix(self):
+        """Return the status line, the Date and the Server header"""
+        now = int(time())
+        if not now == self._time:
+            self._time = now
+            self._prefix = self._status + get_timestamp() + self._server
+        return self._prefix
+
+    def render(self, *args):
+        if args:
+            return self.get_prefix() + self._template % args
+        return self.get_prefix() + self._template
+
+    def render_template(self, *args):
+        """Return the head without the prefix, e.g. to be cached"""
+        return self._template % args
+
+# OK_CONTENT.render(additional headers or empty, mime, content length)
+#
+# HTTP/1.1 200 OK
+# Date: %s
+# Server: Dragonkeeper/0.8
+# %sContent-Type: %s
+# Content-Length: %s
+#
+
+OK_CONTENT = ResponseHead(
+    200,
+    'OK',
+    '%s' + \
+    'Content-Type: %s' + CRLF + \
+    'Content-Length: %s' + 2 * CRLF)
+
+# NOT_MODIFIED.render()
+
+NOT_MODIFIED = ResponseHead(304, 'Not Modified')
+
+# REDIRECT.render(uri)
+
+REDIRECT = ResponseHead(
+    301,
+    'Moved Permanently',
+    'Location: %s' + 2 * CRLF)
+
+# BAD_REQUEST.render()
+
+BAD_REQUEST = ResponseHead(400, 'Bad Request', 2 * CRLF)
+
+# NOT_FOUND.render(content length)
+
+NOT_FOUND = ResponseHead(
+    404,
+    'NOT FOUND',
+    'Content-Type: text/plain' + CRLF + \
+    'Content-Length:%s' + 2 * CRLF)
+
+if __name__ == "__main__":
+    # microbenchmark of the scope message path,
+    # the former template of HTTPScopeInterface with a formatted Date header
+    # for each message against the precompiled head
+    import timeit
+    from time import gmtime, strftime
+    from common import RESPONSE_OK_CONTENT
+    from httpscopeinterface import HTTPScopeInterface
+    SCOPE_MESSAGE_STP_1 = HTTPScopeInterface.SCOPE_MESSAGE_STP_1
+    LEGACY_STP_1 = RESPONSE_OK_CONTENT % (
+        '%s',
+        'Cache-Control: no-cache' + CRLF + \
+        'X-Scope-Message-Service: %s' + CRLF + \
+        'X-Scope-Message-Command: %s' + CRLF + \
+        'X-Scope-Message-Status: %s' + CRLF + \
+        'X-Scope-Message-Tag: %s' + CRLF,
+        'text/plain',
+        '%s',
+        '%s')
+    def legacy(payload):
+        return LEGACY_STP_1 % (
+            strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime()),
+            "ecmascript-debugger", 14, 0, 0, len(payload), payload)
+    def precompiled(payload):
+        return (SCOPE_MESSAGE_STP_1.render(
+            "ecmascript-debugger", 14, 0, 0, len(payload)), payload)
+    for size in [100, 10000, 1000000]:
+        payload = '[%s]' % ('1' * size)
+        for func in [legacy, precompiled]:
+            count = max(10, 1000000 / size)
+            t = min(timeit.repeat(lambda: func(payload), number=count, repeat=3))
+            print "%-12s payload: %8s bytes  %8.2f us per message" % (
+                func.__name__, size, t / count * 1000000)
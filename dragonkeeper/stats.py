@@ -0,0 +1,252 @@
+"""Live metrics of the proxy.
+
+GET /stats returns a snapshot of the counters and gauges, as JSON or, if
+the Accept header asks for text/plain like the Prometheus scraper does,
+in the Prometheus text format:
+
+  - messages and bytes per service and direction, counted by
+    ScopeConnection for the messages from and to the host, the messages
+    of the stp-1 WebSocket subprotocol are not parsed and are counted
+    with the service RAW. The bytes are the size of the framed STP/1
+    messages, with the STP/1 prefix and the length, in both directions
+  - the length of the scope_messages and the connections_waiting queues
+  - the open connections and the size of their pending output by class
+  - the hits of the static file cache, the 304 responses and the cached
+    directory views
+  - the time of the loop iterations without the time waiting in select,
+    measured as the CPU time of the process during each asyncore.poll
+    call, on Windows time.clock is the wall time and includes the wait
+  - the records and the dropped records of the logger
+  - the permessage-deflate sizes and time of the open WebSocket
+    connections, from WebSocket13.get_stats
+
+Counting a message is a dict lookup and two additions on the loop
+thread, inlined in ScopeConnection, everything else is collected when
+/stats is requested.
+"""
+
+import json
+import select
+import asyncore
+from time import time, clock
+import response
+from stprecorder import DIRECTIONS, DIRECTION_FROM_HOST, DIRECTION_TO_HOST
+
+# the service of the messages which are passed through without parsing
+RAW = "(raw)"
+PROMETHEUS_MIME = "text/plain; version=0.0.4"
+PREFIX = "dragonkeeper_"
+# service -> [messages, bytes], updated by ScopeConnection like
+#     counter = from_host.get(service) or from_host.setdefault(service, [0, 0])
+#     counter[0] += 1
+#     counter[1] += size
+from_host = {}
+to_host = {}
+
+class Stats(object):
+
+    def __init__(self):
+        self.messages = {DIRECTION_FROM_HOST: from_host, DIRECTION_TO_HOST: to_host}
+        self.iterations = 0
+        self.busy_time = 0.0
+        self.max_busy_time = 0.0
+        self.start_time = time()
+
+    # =====================================================
+    # the loop
+    # =====================================================
+
+    def loop(self, timeout=30.0, use_poll=False, count=None):
+        """asyncore.loop with the iterations measured. Each call of
+        asyncore.poll, or asyncore.poll2 with use_poll, is timed with
+        time.clock, the CPU time does not include waiting in select"""
+        map = asyncore.socket_map
+        if use_poll and hasattr(select, "poll"):
+            poll = asyncore.poll2
+        else:
+            poll = asyncore.poll
+        while map and (count is None or count > 0):
+            start = clock()
+            poll(timeout, map)
+            self._add_iteration(clock() - start)
+            if count is not None:
+                count -= 1
+
+    def _add_iteration(self, busy_time):
+        self.iterations += 1
+        self.busy_time += busy_time
+        if busy_time > self.max_busy_time:
+            self.max_busy_time = busy_time
+
+    # =====================================================
+    # the snapshot
+    # =====================================================
+
+    def get_snapshot(self):
+        from httpscopeinterface import scope_messages, connections_waiting
+        from httpconnection import static_stats
+        from logwriter import logger
+        connections = {}
+        for obj in asyncore.socket_map.values():
+            name = obj.__class__.__name__
+            if not name in connections:
+                connections[name] = {"count": 0, "pending_bytes": 0}
+            connections[name]["count"] += 1
+            connections[name]["pending_bytes"] += get_pending_size(obj)
+        websockets = get_websocket_stats()
+        lookups = sum(static_stats.values())
+        hits = static_stats["not_modified"] + static_stats["dir_view_hits"]
+        messages = []
+        for direction, services in self.messages.items():
+            for service, (count, size) in sorted(services.items()):
+                messages.append({"direction": DIRECTIONS[direction],
+                                 "service": service,
+                                 "messages": count,
+                                 "bytes": size})
+        return {
+            "uptime": round(time() - self.start_time, 3),
+            "messages": messages,
+            "queues": {"scope_messages": len(scope_messages),
+                       "connections_waiting": len(connections_waiting)},
+            "connections": connections,
+            "websockets": websockets,
+            "static_cache": dict(static_stats,
+                                 hit_ratio=lookups and round(float(hits) / lookups, 4) or 0),
+            "loop": {"iterations": self.iterations,
+                     "busy_time": round(self.busy_time, 6),
+                     "mean_busy_time": self.iterations and
+                                       round(self.busy_time / self.iterations, 9) or 0,
+                     "max_busy_time": round(self.max_busy_time, 6)},
+            "logger": {"records": logger.record_count,
+                       "dropped": logger.dropped_count,
+                       "pending_bytes": logger.get_pending_size()}
+        }
+
+    def get_response(self, headers):
+        """The handler of GET /stats, the Prometheus text format
+        if the Accept header has text/plain, JSON otherwise"""
+        snapshot = self.get_snapshot()
+        if "text/plain" in headers.get("Accept", ""):
+            content = render_prometheus(snapshot)
+            mime = PROMETHEUS_MIME
+        else:
+            content = json.dumps(snapshot, indent=2, sort_keys=True)
+            mime = "application/json"
+        return response.OK_CONTENT.render("", mime, len(content)) + content
+
+def get_pending_size(obj):
+    """Return the size of the output of a connection which is not yet sent"""
+    if hasattr(obj, "pending_size"):
+        return obj.pending_size()
+    size = len(getattr(obj, "out_buffer", ""))
+    for buf in getattr(obj, "out_queue", []):
+        size += len(buf)
+    return size
+
+def get_websocket_stats():
+    """Return the sums of the write and compression stats
+    of the open WebSocket connections"""
+    totals = {"connections": 0, "deflate_connections": 0, "messages_out": 0,
+              "raw_size": 0, "compressed_size": 0, "deflate_time": 0.0}
+    for obj in asyncore.socket_map.values():
+        if not hasattr(obj, "get_stats"):
+            continue
+        connection_stats = obj.get_stats()
+        totals["connections"] += 1
+        totals["messages_out"] += connection_stats["messages_out"]
+        if connection_stats["deflate"]:
+            totals["deflate_connections"] += 1
+            totals["raw_size"] += connection_stats["raw_size"]
+            totals["compressed_size"] += connection_stats["compressed_size"]
+            totals["deflate_time"] += connection_stats["deflate_time"]
+    totals["deflate_time"] = round(totals["deflate_time"], 6)
+    totals["ratio"] = totals["raw_size"] and \
+                      round(float(totals["compressed_size"]) / totals["raw_size"], 4) or 1.0
+    return totals
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_prometheus(snapshot):
+    lines = []
+    def add(name, type, help, samples):
+        name = PREFIX + name
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, type))
+        for labels, value in samples:
+            label_text = ",".join('%s="%s"' % (key, _escape(labels[key]))
+                                  for key in sorted(labels))
+            lines.append("%s%s %s" % (name, label_text and "{%s}" % label_text or "",
+                                      value))
+    messages = snapshot["messages"]
+    add("messages_total", "counter", "STP/1 messages by service and direction",
+        [({"service": item["service"], "direction": item["direction"]}, item["messages"])
+         for item in messages])
+    add("message_bytes_total", "counter", "STP/1 bytes by service and direction",
+        [({"service": item["service"], "direction": item["direction"]}, item["bytes"])
+         for item in messages])
+    add("queue_length", "gauge", "length of the message queues",
+        [({"queue": name}, length) for name, length in sorted(snapshot["queues"].items())])
+    connections = sorted(snapshot["connections"].items())
+    add("connections", "gauge", "open connections by class",
+        [({"class": name}, item["count"]) for name, item in connections])
+    add("pending_bytes", "gauge", "output not yet sent by connection class",
+        [({"class": name}, item["pending_bytes"]) for name, item in connections])
+    websockets = snapshot["websockets"]
+    add("websocket_deflate_connections", "gauge", "open WebSocket connections "
+        "with permessage-deflate", [({}, websockets["deflate_connections"])])
+    add("websocket_deflate_bytes", "gauge", "size of the messages before and after "
+        "permessage-deflate on the open WebSocket connections",
+        [({"stage": "raw"}, websockets["raw_size"]),
+         ({"stage": "compressed"}, websockets["compressed_size"])])
+    add("websocket_deflate_seconds", "gauge", "time spent in permessage-deflate "
+        "on the open WebSocket connections", [({}, websockets["deflate_time"])])
+    static_cache = snapshot["static_cache"]
+    add("static_requests_total", "counter", "static file and directory requests",
+        [({"result": name}, value) for name, value in sorted(static_cache.items())
+         if not name == "hit_ratio"])
+    add("static_cache_hit_ratio", "gauge", "304 responses and cached directory views "
+        "of the static requests", [({}, static_cache["hit_ratio"])])
+    loop = snapshot["loop"]
+    add("loop_iterations_total", "counter", "iterations of the loop",
+        [({}, loop["iterations"])])
+    add("loop_busy_seconds_total", "counter", "time of the loop iterations "
+        "without waiting in select", [({}, loop["busy_time"])])
+    add("loop_max_busy_seconds", "gauge", "longest loop iteration "
+        "without waiting in select", [({}, loop["max_busy_time"])])
+    add("log_records_total", "counter", "records of the logger",
+        [({}, snapshot["logger"]["records"])])
+    add("log_dropped_total", "counter", "records dropped by the logger",
+        [({}, snapshot["logger"]["dropped"])])
+    add("uptime_seconds", "gauge", "seconds since the start",
+        [({}, snapshot["uptime"])])
+    return "\n".join(lines) + "\n"
+
+stats = Stats()
+
+if __name__ == "__main__":
+    # cost of counting a message against parsing it in ScopeConnection
+    import types
+    import timeit
+    import stpconnection
+    from stprecorder import encode_stp_1_message
+    COUNT = 100000
+    data = encode_stp_1_message({0: 3, 1: "ecmascript-debugger", 2: 14, 3: 1,
+                                 4: 0, 5: 0, 8: '[1,2,"OnThreadStarted",[3,4,5,"inline"]]'})
+    connection = types.InstanceType(stpconnection.ScopeConnection)
+    connection.handle_stp1_msg = lambda msg: None
+    def parse():
+        connection.in_buffer = data
+        connection.buf_cursor = 4
+        connection._msg_start = 0
+        connection.decode_varuint()
+        connection.parse_STP_1_msg(len(data))
+    def count():
+        counter = from_host.get(SERVICE) or from_host.setdefault(SERVICE, [0, 0])
+        counter[0] += 1
+        counter[1] += len(data)
+    SERVICE = intern("ecmascript-debugger")
+    t_parse = min(timeit.repeat(parse, number=COUNT, repeat=5))
+    t_count = min(timeit.repeat(count, number=COUNT, repeat=5))
+    print "%-8s %6.3f us per message" % ("parse", t_parse / COUNT * 1000000)
+    print "%-8s %6.3f us per message" % ("count", t_count / COUNT * 1000000)
@@ -3,22 +3,13 @@ import asyncore
 import codecs
 from time import time
 from random import randint
-from common import BLANK, BUFFERSIZE
+from common import BLANK, BUFFERSIZE, encode_varuint
 from httpscopeinterface import connections_waiting, scope_messages, scope
-from utils import pretty_print_XML, pretty_print
-
-def encode_varuint(value):
-    if value == 0:
-        return "\0"
-    out = ""
-    value = value & 0xffffffffffffffff
-    while value:
-        part = value & 0x7f
-        value >>= 7
-        if value:
-            part |= 0x80
-        out += chr(part)
-    return out
+from utils import MessageMap, pretty_print_XML, pretty_print, check_message
+from stprecorder import recorder, DIRECTION_FROM_HOST, DIRECTION_TO_HOST
+from stpmessage import Message, to_protobuf, FORMAT_PROTOBUF, FORMAT_JSON
+from logwriter import logger
+from stats import from_host, to_host, RAW
 
 """
 msg_type: 1 = command, 2 = response, 3 = event, 4 = error
@@ -58,6 +49,9 @@ class ScopeConnection(asyncore.dispatcher):
         self.verbose_debug = context.verbose_debug
         self.debug_only_errors = context.only_errors
         self.force_stp_0 = context.force_stp_0
+        self.host_format = context.host_format
+        # the format of the messages from the host, set with Connect
+        self.format = FORMAT_JSON
         # STP 0 meassages
         self.in_buffer = u""
         self.out_buffer = ""
@@ -68,11 +62,14 @@ class ScopeConnection(asyncore.dispatcher):
         self.stream = codecs.lookup('UTF-16BE').streamreader(self)
         # STP 1 messages
         self.connect_client_callback = None
+        self.handle_stp1_raw_msg = None
         self.varint = 0
+        self._msg_start = 0
         self._service_list = None
         scope.set_connection(self)
         self._msg_count = 0
         self._last_time = 0
+        self._is_paused = False
 
     # ============================================================
     # STP 0
@@ -129,7 +126,7 @@ class ScopeConnection(asyncore.dispatcher):
             command = command.encode("UTF-8")
             if command == "*services":
                 services = msg.split(',')
-                print "services available:\n ", "\n  ".join(services)
+                logger.info("services available:\n  %s" % "\n  ".join(services))
                 if not self.force_stp_0 and 'stp-1' in services:
                     self.set_initializer_STP_1()
                     self.send_command_STP_0('*enable stp-1')
@@ -236,27 +233,67 @@ class ScopeConnection(asyncore.dispatcher):
             if self.in_buffer: self.handle_read()
 
     def send_command_STP_1(self, msg):
-        if self.debug and not self.debug_only_errors:
+        self.out_buffer += self.encode_command_STP_1(msg)
+        self.handle_write()
+
+    def send_commands_STP_1(self, msgs):
+        """Send a list of commands with a single write"""
+        self.out_buffer += "".join([self.encode_command_STP_1(msg) for msg in msgs])
+        self.handle_write()
+
+    def encode_command_STP_1(self, msg):
+        if self.debug and not self.debug_only_errors and check_message(msg):
             pretty_print("send to host:", msg, self.debug_format, self.debug_format_payload)
+        if self.format == FORMAT_PROTOBUF:
+            msg = to_protobuf(msg)
+        if recorder.is_recording:
+            recorder.record(DIRECTION_TO_HOST, msg)
         stp_1_cmd = STP1_COMMAND % (encode_varuint(len(msg[SERVICE])), msg[SERVICE],
                                     encode_varuint(msg[COMMAND]),
                                     encode_varuint(msg[FORMAT]),
                                     encode_varuint(msg[TAG]),
                                     encode_varuint(len(msg[PAYLOAD])), msg[PAYLOAD])
-        self.out_buffer += STP1_MSG % (encode_varuint(len(stp_1_cmd)), stp_1_cmd)
+        stp_1_msg = STP1_MSG % (encode_varuint(len(stp_1_cmd)), stp_1_cmd)
+        counter = to_host.get(msg[SERVICE]) or to_host.setdefault(msg[SERVICE], [0, 0])
+        counter[0] += 1
+        counter[1] += len(stp_1_msg)
+        return stp_1_msg
+
+    def send_raw_STP_1(self, msg):
+        """Send an already encoded STP/1 message, including the
+        STP/1 prefix and the length"""
+        if self.debug and not self.debug_only_errors:
+            logger.debug("send to host: STP/1 message, %s bytes" % len(msg))
+        if recorder.is_recording:
+            recorder.record_raw(DIRECTION_TO_HOST, msg)
+        counter = to_host.get(RAW) or to_host.setdefault(RAW, [0, 0])
+        counter[0] += 1
+        counter[1] += len(msg)
+        self.out_buffer += msg
         self.handle_write()
 
     def handle_read_STP_1(self):
         self.in_buffer += self.recv(BUFFERSIZE)
         while True:
             if not self.varint:
+                # the message starts with "STP\x01" before the length
+                self._msg_start = self.buf_cursor - 4
                 varint = self.decode_varuint()
                 if varint == None: break
                 else: self.varint = varint
             else:
                 pos = self.buf_cursor + self.varint
                 if len(self.in_buffer) >= pos:
-                    self.parse_STP_1_msg(pos)
+                    if self.handle_stp1_raw_msg:
+                        msg = self.in_buffer[self._msg_start:pos]
+                        if recorder.is_recording:
+                            recorder.record_raw(DIRECTION_FROM_HOST, msg)
+                        counter = from_host.get(RAW) or from_host.setdefault(RAW, [0, 0])
+                        counter[0] += 1
+                        counter[1] += len(msg)
+                        self.handle_stp1_raw_msg(msg)
+                    else:
+                        self.parse_STP_1_msg(pos)
                     self.varint = 0
                     if len(self.in_buffer) > BUFFERSIZE:
                         self.in_buffer = self.in_buffer[pos:]
@@ -269,7 +306,7 @@ class ScopeConnection(asyncore.dispatcher):
         if msg_type == None:
             raise Exception("Message type of STP 1 message cannot be parsed")
         else:
-            msg = {TYPE: msg_type, STATUS: 0, TAG: 0, PAYLOAD: ""}
+            msg = Message(msg_type)
             while self.buf_cursor < end_pos:
                 varint = self.decode_varuint()
                 if not varint == None:
@@ -277,13 +314,22 @@ class ScopeConnection(asyncore.dispatcher):
                     if type == 2:
                         length = self.decode_varuint()
                         pos = self.buf_cursor
-                        msg[tag] = self.in_buffer[pos:pos + length]
+                        if tag == SERVICE:
+                            msg[tag] = intern(self.in_buffer[pos:pos + length])
+                        else:
+                            msg[tag] = self.in_buffer[pos:pos + length]
                         self.buf_cursor += length
                     elif type == 0:
                         value = self.decode_varuint()
                         msg[tag] = value
                     else: raise Exception("Not valid type in STP 1 message")
                 else: raise Exception("Cannot read STP 1 message part")
+        if recorder.is_recording:
+            recorder.record(DIRECTION_FROM_HOST, msg)
+        service = msg.get(SERVICE)
+        counter = from_host.get(service) or from_host.setdefault(service, [0, 0])
+        counter[0] += 1
+        counter[1] += end_pos - self._msg_start
         self.handle_stp1_msg(msg)
 
     def handle_stp1_msg_default(self, msg):
@@ -295,28 +341,60 @@ class ScopeConnection(asyncore.dispatcher):
     def set_msg_handler(self, handler):
         self.handle_stp1_msg = handler
 
+    def set_raw_msg_handler(self, handler):
+        """Hand the messages from the host to handler as they are,
+        without parsing them"""
+        self.handle_stp1_raw_msg = handler
+
     def clear_msg_handler(self):
         self.handle_stp1_msg = self.handle_stp1_msg_default
+        self.handle_stp1_raw_msg = None
+
+    def pause_reading(self):
+        """Stop reading from the host, e.g. while a client is too slow
+        to take the messages"""
+        self._is_paused = True
+
+    def resume_reading(self):
+        self._is_paused = False
 
     def connect_client(self, callback):
         self.connect_client_callback = callback
+        self.handle_stp1_raw_msg = None
         self.handle_stp1_msg = self.handle_connect_client
+        # protobuf needs the message map to decode the messages,
+        # the map is fetched with a JSON connection
+        if self.host_format == "protobuf" and MessageMap.has_map():
+            self.send_connect(FORMAT_PROTOBUF)
+        else:
+            self.send_connect(FORMAT_JSON)
+
+    def send_connect(self, format):
+        self.format = FORMAT_JSON
+        self._connect_format = format
         self.send_command_STP_1({TYPE: 1,
                                  SERVICE: "scope",
                                  COMMAND: 3,
                                  FORMAT: 1,
                                  TAG: 0,
-                                 PAYLOAD: '["json"]'})
+                                 PAYLOAD: format == FORMAT_PROTOBUF and '["protobuf"]'
+                                                                    or '["json"]'})
 
     def handle_connect_client(self, msg):
-        if self.debug and not self.debug_only_errors:
+        if self.debug and not self.debug_only_errors and check_message(msg):
             pretty_print("client connected:", msg, self.debug_format, self.debug_format_payload)
-        if msg[SERVICE] == "scope" and msg[COMMAND] == 3 and msg[STATUS] == 0:
+        is_connect = msg[SERVICE] == "scope" and msg[COMMAND] == 3
+        if is_connect and msg[STATUS] == 0:
+            self.format = self._connect_format
             self.handle_stp1_msg = self.handle_stp1_msg_default
             self.connect_client_callback()
             self.connect_client_callback = None
+        elif is_connect and self._connect_format == FORMAT_PROTOBUF:
+            logger.warning("the host does not accept the protobuf format, using json")
+            self.host_format = "json"
+            self.send_connect(FORMAT_JSON)
         else:
-            print "conection to host failed in scope.handle_connect_callback"
+            logger.error("conection to host failed in scope.handle_connect_callback")
 
     def decode_varuint(self):
         value = 0
@@ -340,7 +418,14 @@ class ScopeConnection(asyncore.dispatcher):
     def handle_read(self):
         pass
 
+    def readable(self):
+        return not self._is_paused
+
     def writable(self):
+        if recorder.is_recording:
+            recorder.poll()
+        if MessageMap.filter:
+            MessageMap.filter.poll()
         return (len(self.out_buffer) > 0)
 
     def handle_write(self):
@@ -348,5 +433,7 @@ class ScopeConnection(asyncore.dispatcher):
         self.out_buffer = self.out_buffer[sent:]
 
     def handle_close(self):
+        if recorder.is_recording:
+            recorder.flush()
         scope.reset()
         self.close()
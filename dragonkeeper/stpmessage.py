@@ -0,0 +1,210 @@
+"""The messages of the host.
+
+ScopeConnection creates a Message for each STP/1 message of the host. A
+Message is a dict with the same keys as the message dicts of the clients,
+TYPE, SERVICE, ..., PAYLOAD, all code working on messages takes both.
+On top of that
+
+  - the payload is parsed on the first get_payload call and kept,
+    the debug printer and the message map share the parsed payload
+  - the encodings for the transports, e.g. the HTTP head or the
+    WebSocket envelope, are made once with get_encoding
+  - the service names are interned by ScopeConnection, the queued
+    messages share one string per service
+  - a protobuf payload, see --host-format, is decoded with the message
+    map, get_json_payload returns it in the JSON format for the clients.
+    If it can not be decoded the message is turned into an error message
+    with the status internal error and a JSON payload, the clients get
+    the error instead of the connection to the host being dropped
+
+The parsed payload and the encodings are not updated if an item of the
+message is changed afterwards.
+"""
+
+from json import loads as parse_json, dumps
+from maps import message_map
+from protobuf import decode_message, encode_message, ERROR_INFO
+from logwriter import logger
+
+TYPE = 0
+SERVICE = 1
+COMMAND = 2
+FORMAT = 3
+STATUS = 4
+TAG = 5
+PAYLOAD = 8
+MSG_TYPE_ERROR = 4
+STATUS_INTERNAL_ERROR = 4
+FORMAT_PROTOBUF = 0
+FORMAT_JSON = 1
+JSON_PAYLOAD = "json-payload"
+# the items of a new message
+DEFAULTS = {STATUS: 0, TAG: 0, PAYLOAD: ""}
+_NOT_PARSED = object()
+
+class Message(dict):
+    """Message(msg_type) returns a message with the DEFAULTS"""
+
+    # the slots are not set until they are used
+    __slots__ = ["_payload", "_encodings"]
+
+    def __init__(self, msg_type):
+        dict.__init__(self, DEFAULTS)
+        self[TYPE] = msg_type
+
+    def get_payload(self):
+        """Return the parsed payload, it is parsed only once"""
+        payload = getattr(self, "_payload", _NOT_PARSED)
+        if payload is _NOT_PARSED:
+            if self.get(FORMAT) == FORMAT_PROTOBUF:
+                try:
+                    payload = decode_message(self[PAYLOAD], get_fields(self))
+                except ValueError, error:
+                    self.set_transcoding_error(error)
+                    return self.get_payload()
+            else:
+                payload = parse_json(self[PAYLOAD])
+            self._payload = payload
+        return payload
+
+    def get_json_payload(self):
+        """Return the payload in the JSON format,
+        a protobuf payload is transcoded once"""
+        if self.get(FORMAT) == FORMAT_PROTOBUF:
+            self.get_payload()
+            if self.get(FORMAT) == FORMAT_PROTOBUF:
+                return self.get_encoding(JSON_PAYLOAD, encode_json_payload)
+        return self[PAYLOAD]
+
+    def set_transcoding_error(self, error):
+        """Turn the message into an error message in the JSON format,
+        with the description of error in the payload"""
+        description = "failed to decode the protobuf payload of %s %s: %s" % (
+                      self[SERVICE], self[COMMAND], error)
+        logger.warning(description)
+        self[TYPE] = MSG_TYPE_ERROR
+        self[STATUS] = STATUS_INTERNAL_ERROR
+        self[FORMAT] = FORMAT_JSON
+        self[PAYLOAD] = dumps([description])
+
+    def get_encoding(self, name, encode):
+        """Return encode(message), encode is called once for each name"""
+        encodings = getattr(self, "_encodings", None)
+        if encodings is None:
+            encodings = self._encodings = {}
+        if not name in encodings:
+            encodings[name] = encode(self)
+        return encodings[name]
+
+def get_payload(msg):
+    """Return the parsed payload of a Message or of a message dict"""
+    if isinstance(msg, Message):
+        return msg.get_payload()
+    return parse_json(msg[PAYLOAD])
+
+def get_json_payload(msg):
+    """Return the payload of a Message or of a message dict in the JSON format"""
+    if isinstance(msg, Message):
+        return msg.get_json_payload()
+    return msg[PAYLOAD]
+
+def get_fields(msg):
+    """Return the field definitions of the payload of msg.
+    Raises ValueError if the message is not in the message map."""
+    if msg[TYPE] == MSG_TYPE_ERROR:
+        return ERROR_INFO
+    command = message_map.get(msg[SERVICE], {}).get(msg[COMMAND])
+    fields = command and command.get(msg[TYPE])
+    if fields is None:
+        raise ValueError("no definition of the payload of %s %s" % (
+                         msg[SERVICE], msg[COMMAND]))
+    return fields
+
+def encode_json_payload(msg):
+    return dumps(msg.get_payload(), separators=(',', ':'))
+
+def to_protobuf(msg):
+    """Return a message dict in the JSON format as a copy with the
+    payload in the protobuf format, or msg if it can not be transcoded"""
+    if not msg.get(FORMAT) == FORMAT_JSON:
+        return msg
+    try:
+        payload = encode_message(parse_json(msg[PAYLOAD] or "[]"), get_fields(msg))
+    except Exception:
+        return msg
+    msg = dict(msg)
+    msg[FORMAT] = FORMAT_PROTOBUF
+    msg[PAYLOAD] = payload
+    return msg
+
+if __name__ == "__main__":
+    # allocations and time per event of the host with a dict and with a
+    # Message: the event is parsed from the read buffer, the payload is
+    # decoded by the debug printer and by the message filter and the
+    # WebSocket envelope is made.
+    # allocations are the objects tracked by the garbage collector,
+    # the bytes queued are the size of the message and of the service name
+    import gc
+    import sys
+    import timeit
+    STP_MSG = "[\"%s\",%s,%s,%s,%s]"
+    COUNT = 10000
+    SERVICE_NAME = "ecmascript-debugger"
+    PAYLOADS = ['[1,2,"OnThreadStarted",[3,4,5,"inline"]]',
+                "[%s]" % ",".join(['[%s,"_top",1,%s,"http://localhost/%s"]' % (i, i, i)
+                                   for i in range(50)])]
+    # like ScopeConnection.parse_STP_1_msg
+    def make_dict(buf):
+        msg = {TYPE: 3, STATUS: 0, TAG: 0, PAYLOAD: ""}
+        msg[1] = buf[0:19]
+        msg[2] = 14
+        msg[3] = 1
+        msg[8] = buf[19:]
+        return msg
+    def make_message(buf):
+        msg = Message(3)
+        msg[1] = intern(buf[0:19])
+        msg[2] = 14
+        msg[3] = 1
+        msg[8] = buf[19:]
+        return msg
+    def encode(msg):
+        return STP_MSG % (msg[1], msg[2], msg[4], msg[5], msg[8])
+    def use_dict(msg):
+        return [parse_json(msg[8]), parse_json(msg[8]), encode(msg)]
+    def use_message(msg):
+        return [msg.get_payload(), msg.get_payload(),
+                msg.get_encoding("stp-0", encode)]
+    def get_bytes(msgs):
+        seen = set()
+        size = 0
+        for msg in msgs:
+            for obj in [msg, msg[1]]:
+                if not id(obj) in seen:
+                    seen.add(id(obj))
+                    size += sys.getsizeof(obj)
+        return size
+    for payload in PAYLOADS:
+        buf = SERVICE_NAME + payload
+        print "payload: %s bytes" % len(payload)
+        for name, make, use in [("dict", make_dict, use_dict),
+                                ("Message", make_message, use_message)]:
+            gc.collect()
+            gc.disable()
+            count = gc.get_count()[0]
+            msgs = [make(buf) for i in xrange(COUNT)]
+            queued = gc.get_count()[0] - count
+            # the list of the results is one allocation per message
+            results = [use(msg) for msg in msgs]
+            used = gc.get_count()[0] - count - queued - COUNT
+            gc.enable()
+            size = get_bytes(msgs)
+            del msgs, results
+            t = min(timeit.repeat(lambda: use(make(buf)), number=COUNT, repeat=3))
+            print "  %-8s %6.2f allocations queued %6.2f allocations used " \
+                  "%6.1f bytes queued %7.2f us per message" % (
+                    name,
+                    float(queued) / COUNT,
+                    float(used) / COUNT,
+                    float(size) / COUNT,
+                    t / COUNT * 1000000)
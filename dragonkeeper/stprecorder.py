@@ -0,0 +1,324 @@
+"""Binary recorder of the STP/1 traffic.
+
+With --record FILE all STP/1 messages are appended to FILE, in both
+directions on the host side (ScopeConnection) and on the client side
+(HTTPScopeInterface, STPWebSocket). Each record is
+
+    size        uint32, the size of the rest of the record
+    timestamp   double, seconds since the epoch
+    direction   uint8, see DIRECTIONS
+    type        uint8, 1 = command, 2 = response, 3 = event, 4 = error
+    format      uint8
+    command     uint32
+    status      uint32
+    tag         uint32
+    service     uint16 length and the UTF-8 encoded name
+    payload     the rest of the record
+
+in network byte order. The offset of each record is appended to the index
+FILE.idx as uint64, a Recording maps both files to access any record
+without reading the file up to it.
+
+The records are collected in memory and written in blocks on the io pool,
+the loop thread never blocks on the disk. If FILE is bigger than
+--record-max-size it is rotated to FILE.1, FILE.1 to FILE.2 and so on.
+"""
+
+import os
+import mmap
+import struct
+from time import time, sleep
+from collections import namedtuple
+from common import encode_varuint, decode_varuint, rotate_file
+from requestbody import io_pool
+
+DIRECTION_FROM_HOST = 0
+DIRECTION_TO_HOST = 1
+DIRECTION_FROM_CLIENT = 2
+DIRECTION_TO_CLIENT = 3
+DIRECTIONS = {
+    DIRECTION_FROM_HOST: "from host",
+    DIRECTION_TO_HOST: "to host",
+    DIRECTION_FROM_CLIENT: "from client",
+    DIRECTION_TO_CLIENT: "to client"
+}
+# keys of the message dicts, see stpconnection
+TYPE = 0
+SERVICE = 1
+COMMAND = 2
+FORMAT = 3
+STATUS = 4
+TAG = 5
+PAYLOAD = 8
+# version 2, the length of the service name was an uint8 in version 1
+FILE_HEADER = "STP/1 recording 2\n"
+RECORD_HEAD = struct.Struct("!IdBBBIIIH")
+INDEX_ENTRY = struct.Struct("!Q")
+INDEX_SUFFIX = ".idx"
+# the records are written if that much is collected or after FLUSH_INTERVAL
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 1.0
+MAX_SIZE = 64 * 1024 * 1024
+BACKUP_COUNT = 4
+
+Record = namedtuple("Record", ["timestamp", "direction", "type", "format",
+                               "service", "command", "status", "tag",
+                               "payload"])
+
+def parse_stp_1_message(data):
+    """Parse an encoded STP/1 message, including the STP/1 prefix and
+    the length, to a message dict like the ones of ScopeConnection"""
+    length, pos = decode_varuint(data, 4)
+    msg_type, pos = decode_varuint(data, pos)
+    if length is None or msg_type is None:
+        raise ValueError("not a valid STP/1 message")
+    msg = {TYPE: msg_type, STATUS: 0, TAG: 0, PAYLOAD: ""}
+    while pos < len(data):
+        key, pos = decode_varuint(data, pos)
+        if key is None:
+            raise ValueError("not a valid STP/1 message")
+        if key & 7 == 2:
+            size, pos = decode_varuint(data, pos)
+            msg[key >> 3] = data[pos:pos + size]
+            pos += size
+        elif key & 7 == 0:
+            msg[key >> 3], pos = decode_varuint(data, pos)
+        else:
+            raise ValueError("not a valid type in STP/1 message")
+    return msg
+
+def encode_stp_1_message(msg):
+    """Encode a message dict to a STP/1 message,
+    including the STP/1 prefix and the length"""
+    parts = [encode_varuint(msg.get(TYPE, 1))]
+    for key in [SERVICE, COMMAND, FORMAT, STATUS, TAG, PAYLOAD]:
+        value = msg.get(key)
+        if value is None:
+            continue
+        if isinstance(value, basestring):
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            parts.extend([encode_varuint(key << 3 | 2),
+                          encode_varuint(len(value)),
+                          value])
+        else:
+            parts.extend([encode_varuint(key << 3 | 0), encode_varuint(value)])
+    data = "".join(parts)
+    return "STP\x01%s%s" % (encode_varuint(len(data)), data)
+
+def encode_record(timestamp, direction, msg):
+    service = msg.get(SERVICE, "")
+    if isinstance(service, unicode):
+        service = service.encode("utf-8")
+    payload = msg.get(PAYLOAD, "")
+    if isinstance(payload, unicode):
+        payload = payload.encode("utf-8")
+    return "".join([RECORD_HEAD.pack(RECORD_HEAD.size - 4 + len(service) + len(payload),
+                                     timestamp,
+                                     direction,
+                                     msg.get(TYPE, 0),
+                                     msg.get(FORMAT, 1),
+                                     msg.get(COMMAND, 0),
+                                     msg.get(STATUS, 0),
+                                     msg.get(TAG, 0),
+                                     len(service)),
+                    service,
+                    payload])
+
+def decode_record(data, pos=0):
+    (size, timestamp, direction, msg_type, format,
+     command, status, tag, service_length) = RECORD_HEAD.unpack_from(data, pos)
+    start = pos + RECORD_HEAD.size
+    end = pos + 4 + size
+    return Record(timestamp, direction, msg_type, format,
+                  data[start:start + service_length].decode("utf-8"),
+                  command, status, tag,
+                  data[start + service_length:end])
+
+def record_to_msg(record):
+    """Return the message dict of a record"""
+    return {TYPE: record.type,
+            SERVICE: record.service,
+            COMMAND: record.command,
+            FORMAT: record.format,
+            STATUS: record.status,
+            TAG: record.tag,
+            PAYLOAD: record.payload}
+
+class Recorder(object):
+    """Collects the records on the loop thread, the files are only
+    touched by the jobs of the io pool"""
+
+    def __init__(self):
+        self.is_recording = False
+        self.path = None
+        self.max_size = MAX_SIZE
+        self.backup_count = BACKUP_COUNT
+        self._records = []
+        self._offsets = []
+        self._buffered_size = 0
+        self._last_flush = 0
+        # size of the file after the collected records are written
+        self._size = 0
+        self._files = None
+        self._job = None
+
+    def open(self, path, max_size=MAX_SIZE, backup_count=BACKUP_COUNT):
+        self.path = path
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self._size = os.path.exists(path) and os.path.getsize(path) or 0
+        self._last_flush = time()
+        self.is_recording = True
+
+    def record(self, direction, msg):
+        data = encode_record(time(), direction, msg)
+        if self._size > self.max_size:
+            self.flush()
+            self._job = io_pool.submit(id(self), self._rotate)
+            self._size = 0
+        if not self._size:
+            self._records.append(FILE_HEADER)
+            self._size = self._buffered_size = len(FILE_HEADER)
+        self._offsets.append(INDEX_ENTRY.pack(self._size))
+        self._records.append(data)
+        self._size += len(data)
+        self._buffered_size += len(data)
+        if self._buffered_size >= FLUSH_SIZE:
+            self.flush()
+
+    def record_raw(self, direction, data):
+        """Record an encoded STP/1 message"""
+        try:
+            msg = parse_stp_1_message(data)
+        except ValueError:
+            return
+        self.record(direction, msg)
+
+    def poll(self):
+        """Write the collected records if they are older than FLUSH_INTERVAL"""
+        if self._records and time() - self._last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._records:
+            self._job = io_pool.submit(id(self), self._write,
+                                       "".join(self._records),
+                                       "".join(self._offsets))
+            self._records = []
+            self._offsets = []
+            self._buffered_size = 0
+        self._last_flush = time()
+
+    def close(self):
+        """Write the collected records and wait for the io pool"""
+        if not self.is_recording:
+            return
+        self.flush()
+        self.is_recording = False
+        self._job = io_pool.submit(id(self), self._close_files)
+        while not self._job.done:
+            sleep(0.01)
+
+    # =====================================================
+    # the jobs of the io pool
+    # =====================================================
+
+    def _open_files(self):
+        if not self._files:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._files = (open(self.path, 'ab'),
+                           open(self.path + INDEX_SUFFIX, 'ab'))
+        return self._files
+
+    def _close_files(self):
+        if self._files:
+            for file in self._files:
+                file.close()
+            self._files = None
+
+    def _write(self, data, index):
+        log_file, index_file = self._open_files()
+        log_file.write(data)
+        log_file.flush()
+        index_file.write(index)
+        index_file.flush()
+
+    def _rotate(self):
+        self._close_files()
+        for suffix in ["", INDEX_SUFFIX]:
+            rotate_file(self.path, self.backup_count, suffix)
+
+recorder = Recorder()
+
+class Recording(object):
+    """Random access to the records of a file written by Recorder.
+    The file and the index are memory mapped, a record is only decoded
+    when it is accessed."""
+
+    def __init__(self, path):
+        self.path = path
+        self._maps = []
+        self._data = self._map(path)
+        self._index = self._map(path + INDEX_SUFFIX)
+        if not self._data[0:len(FILE_HEADER)] == FILE_HEADER:
+            if self._data[0:len("STP/1 recording")] == "STP/1 recording":
+                raise ValueError("%s is a STP/1 recording of another version" % path)
+            raise ValueError("%s is not a STP/1 recording" % path)
+        self._count = len(self._index) / INDEX_ENTRY.size
+        # a crash may leave index entries without a complete record
+        while self._count:
+            offset = INDEX_ENTRY.unpack_from(self._index,
+                                             (self._count - 1) * INDEX_ENTRY.size)[0]
+            if offset + RECORD_HEAD.size <= len(self._data) and \
+                    offset + 4 + struct.unpack_from("!I", self._data, offset)[0] <= len(self._data):
+                break
+            self._count -= 1
+
+    def _map(self, path):
+        file = open(path, 'rb')
+        try:
+            if not os.fstat(file.fileno()).st_size:
+                return ""
+            map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(map)
+            return map
+        finally:
+            file.close()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("record index out of range")
+        offset = INDEX_ENTRY.unpack_from(self._index, index * INDEX_ENTRY.size)[0]
+        return decode_record(self._data, offset)
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self[index]
+
+    def close(self):
+        for map in self._maps:
+            map.close()
+        self._maps = []
+
+if __name__ == "__main__":
+    # print a recording, e.g.
+    #     python stprecorder.py session.rec [first index] [count]
+    import sys
+    recording = Recording(sys.argv[1])
+    start = len(sys.argv) > 2 and int(sys.argv[2]) or 0
+    count = len(sys.argv) > 3 and int(sys.argv[3]) or len(recording)
+    print "%s records" % len(recording)
+    for index in xrange(start, min(start + count, len(recording))):
+        record = recording[index]
+        print "%8s %.6f %-11s %s %s %s %s %s %s" % (
+                index, record.timestamp, DIRECTIONS.get(record.direction),
+                record.type, record.service, record.command,
+                record.status, record.tag, record.payload[0:60])
@@ -0,0 +1,360 @@
+"""Replay of recorded STP/1 traffic against a running dragonkeeper.
+
+Replays a recording of --record (see stprecorder.py) in the role of the
+host, of the client or of both, e.g.
+
+    python stpreplay.py --role both --speed 10 session.rec
+
+With the host role the replayer connects to the proxy port like
+mockhost.py. The recorded events are sent on schedule, a command from
+the proxy is answered with the recorded response of the same service,
+command and tag, or of the same service and command, after the recorded
+response time. Commands without a recorded response are answered from
+the fixture of mockhost.py.
+
+With the client role the replayer connects to /stp-1-channel and sends
+the recorded commands of the client on schedule.
+
+--speed scales the recorded timing, 0 sends as fast as possible, --rate
+sends at a fixed number of messages per second instead. The report, as
+JSON, compares the messages which arrived at the host and at the client
+with the recording: missing and unexpected messages, the messages out of
+order and the latency against the recorded latency. The latency of a
+message to the client is measured from the time it was sent by the
+replayed host, or with the client role only, from the command with the
+same tag.
+
+The recorded files are replayed in the given order, e.g. the rotated
+files session.rec.2 session.rec.1 session.rec.
+"""
+
+import heapq
+import asyncore
+import argparse
+from bisect import bisect_left
+from collections import deque
+from time import time
+from stprecorder import Recording, record_to_msg
+from stprecorder import DIRECTION_FROM_HOST, DIRECTION_TO_HOST
+from stprecorder import DIRECTION_FROM_CLIENT, DIRECTION_TO_CLIENT
+from stprecorder import SERVICE, COMMAND, TAG, PAYLOAD
+from mockhost import MockHost, DEFAULT_FIXTURE, MSG_TYPE_EVENT
+from mockhost import Stats as HostStats
+from wsloadtest import LoadClient, Stats as ClientStats, STP_1_CHANNEL, percentiles
+from stpwebsocket import RE_ENVELOPE_HEAD
+from websocket13 import OPCODE_TEXT
+
+ROLE_HOST = "host"
+ROLE_CLIENT = "client"
+ROLE_BOTH = "both"
+# the replay ends if nothing arrived for that long after the last message
+DRAIN_TIME = 2.0
+
+def count_out_of_order(indexes):
+    """Return how many of the indexes are not part of the longest
+    increasing subsequence"""
+    tails = []
+    for index in indexes:
+        pos = bisect_left(tails, index)
+        if pos == len(tails):
+            tails.append(index)
+        else:
+            tails[pos] = index
+    return len(indexes) - len(tails)
+
+class Stream(object):
+    """The messages in one direction, in order. The key of a message is
+    (service, command, tag, n) for the n-th message with that service,
+    command and tag."""
+
+    def __init__(self):
+        self.keys = []
+        self.times = {}
+        self._counts = {}
+
+    def add(self, service, command, tag, timestamp):
+        name = (service, command, tag)
+        count = self._counts.get(name, 0)
+        self._counts[name] = count + 1
+        key = name + (count,)
+        self.keys.append(key)
+        self.times[key] = timestamp
+        return key
+
+class Replay(object):
+
+    def __init__(self, records, role, speed, rate):
+        self.role = role
+        self.speed = speed
+        self.rate = rate
+        self.host = None
+        self.client = None
+        self.is_started = False
+        self.start_time = 0
+        self.last_arrival = 0
+        # the recording
+        self.recorded = dict((direction, Stream()) for direction in
+                             [DIRECTION_FROM_HOST, DIRECTION_TO_HOST,
+                              DIRECTION_FROM_CLIENT, DIRECTION_TO_CLIENT])
+        # the replay, sent by the replayer and arrived at the replayer
+        self.sent = {DIRECTION_FROM_HOST: Stream(),
+                     DIRECTION_FROM_CLIENT: Stream()}
+        self.arrived = {DIRECTION_TO_HOST: Stream(),
+                        DIRECTION_TO_CLIENT: Stream()}
+        # (time offset, sequence number, direction, message)
+        self.schedule = []
+        self.responses_by_tag = {}
+        self.responses = {}
+        # a response is in both dicts
+        self._used_responses = set()
+        self._load(records)
+
+    def _load(self, records):
+        command_times = {}
+        start = None
+        for record in records:
+            key = self.recorded[record.direction].add(record.service,
+                                                      record.command,
+                                                      record.tag,
+                                                      record.timestamp)
+            if record.direction == DIRECTION_TO_HOST:
+                command_times[key[0:3]] = record.timestamp
+            is_scheduled = (self.role in [ROLE_HOST, ROLE_BOTH] and
+                            record.direction == DIRECTION_FROM_HOST and
+                            record.type == MSG_TYPE_EVENT) or \
+                           (self.role in [ROLE_CLIENT, ROLE_BOTH] and
+                            record.direction == DIRECTION_FROM_CLIENT)
+            if is_scheduled:
+                if start is None:
+                    start = record.timestamp
+                self.schedule.append((record.timestamp - start,
+                                      len(self.schedule),
+                                      record.direction,
+                                      record_to_msg(record)))
+            elif record.direction == DIRECTION_FROM_HOST:
+                # the response time of the host
+                delay = record.timestamp - command_times.get(key[0:3], record.timestamp)
+                response = (delay, record_to_msg(record))
+                self.responses_by_tag.setdefault(key[0:3], deque()).append(response)
+                self.responses.setdefault(key[0:2], deque()).append(response)
+        for index, (offset, seq, direction, msg) in enumerate(self.schedule):
+            if self.rate:
+                offset = float(index) / self.rate
+            elif self.speed:
+                offset = offset / self.speed
+            else:
+                offset = 0
+            self.schedule[index] = (offset, seq, direction, msg)
+        heapq.heapify(self.schedule)
+
+    def get_services(self):
+        return set(key[0] for key in self.recorded[DIRECTION_FROM_HOST].keys)
+
+    def pop_response(self, msg):
+        """Return the delay and the recorded response to a command
+        from the proxy, or None"""
+        name = (msg[SERVICE], msg[COMMAND], msg.get(TAG, 0))
+        for responses in [self.responses_by_tag.get(name),
+                          self.responses.get(name[0:2])]:
+            while responses:
+                delay, response = responses.popleft()
+                if not id(response) in self._used_responses:
+                    self._used_responses.add(id(response))
+                    if self.rate or not self.speed:
+                        delay = 0
+                    else:
+                        delay = delay / self.speed
+                    return delay, dict(response, **{TAG: name[2]})
+        return None
+
+    def add_response(self, delay, msg):
+        heapq.heappush(self.schedule, (time() - self.start_time + delay,
+                                       -1,
+                                       DIRECTION_FROM_HOST,
+                                       msg))
+
+    def start(self, now):
+        self.is_started = True
+        self.start_time = now
+        self.last_arrival = now
+
+    def tick(self, now):
+        if not self.is_started:
+            return
+        while self.schedule and self.schedule[0][0] <= now - self.start_time:
+            offset, seq, direction, msg = heapq.heappop(self.schedule)
+            self.sent[direction].add(msg[SERVICE], msg[COMMAND], msg[TAG], now)
+            if direction == DIRECTION_FROM_HOST:
+                self.host.send_STP_1(msg)
+            else:
+                self.client.send_command(msg)
+
+    def add_arrival(self, direction, service, command, tag):
+        self.last_arrival = time()
+        self.arrived[direction].add(service, command, tag, self.last_arrival)
+
+    def is_done(self, now):
+        return self.is_started and not self.schedule and \
+               now - self.last_arrival > DRAIN_TIME
+
+    def compare(self, direction):
+        """Compare the arrived messages of direction with the recording"""
+        expected = self.recorded[direction]
+        arrived = self.arrived[direction]
+        indexes = dict((key, index) for index, key in enumerate(expected.keys))
+        matched = [indexes[key] for key in arrived.keys if key in indexes]
+        origin = direction == DIRECTION_TO_HOST and DIRECTION_FROM_CLIENT or \
+                 self.role == ROLE_CLIENT and DIRECTION_FROM_CLIENT or \
+                 DIRECTION_FROM_HOST
+        recorded_latency = []
+        latency = []
+        for key in arrived.keys:
+            if key in self.sent[origin].times:
+                latency.append(arrived.times[key] - self.sent[origin].times[key])
+                if key in self.recorded[origin].times and key in expected.times:
+                    recorded_latency.append(expected.times[key] -
+                                            self.recorded[origin].times[key])
+        return {"expected": len(expected.keys),
+                "arrived": len(arrived.keys),
+                "missing": len(expected.keys) - len(matched),
+                "unexpected": len(arrived.keys) - len(matched),
+                "out_of_order": count_out_of_order(matched),
+                "latency_ms": percentiles(latency),
+                "recorded_latency_ms": percentiles(recorded_latency)}
+
+    def report(self, duration):
+        report = {"role": self.role,
+                  "speed": self.rate and "%s/s" % self.rate or self.speed or "max",
+                  "duration": round(duration, 3),
+                  "sent": dict((name, len(self.sent[direction].keys))
+                               for name, direction in [("from_host", DIRECTION_FROM_HOST),
+                                                       ("from_client", DIRECTION_FROM_CLIENT)])}
+        if self.role in [ROLE_HOST, ROLE_BOTH]:
+            report["to_host"] = self.compare(DIRECTION_TO_HOST)
+        if self.role in [ROLE_CLIENT, ROLE_BOTH]:
+            report["to_client"] = self.compare(DIRECTION_TO_CLIENT)
+        return report
+
+class ReplayHost(MockHost):
+    """Answers the commands of the proxy with the recorded responses"""
+
+    def __init__(self, args, fixture, replay):
+        self.replay = replay
+        MockHost.__init__(self, args, fixture, HostStats())
+
+    def handle_command(self, msg):
+        self.replay.add_arrival(DIRECTION_TO_HOST,
+                                msg[SERVICE], msg[COMMAND], msg.get(TAG, 0))
+        response = self.replay.pop_response(msg)
+        if response:
+            self.replay.add_response(*response)
+        else:
+            MockHost.handle_command(self, msg)
+
+class ReplayClient(LoadClient):
+    """Sends the recorded commands to /stp-1-channel"""
+
+    def __init__(self, args, replay):
+        self.replay = replay
+        LoadClient.__init__(self, args, ClientStats())
+
+    def send_command(self, msg):
+        message = '["%s",%s,0,%s,%s]' % (msg[SERVICE].encode("utf-8"),
+                                         msg[COMMAND],
+                                         msg[TAG],
+                                         msg[PAYLOAD] or "[]")
+        self.send_frame(OPCODE_TEXT, message)
+
+    def tick(self, now):
+        pass
+
+    def handle_message(self, message):
+        match = RE_ENVELOPE_HEAD.match(message)
+        if match:
+            service, command, status, tag = match.groups()
+            self.replay.add_arrival(DIRECTION_TO_CLIENT,
+                                    service, int(command), int(tag))
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="""
+        Replay of recorded STP/1 traffic against dragonkeeper.
+        Prints the results as JSON.""")
+    parser.add_argument("recordings", nargs="+",
+                        help="files written by --record, replayed in that order")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("-p", "--proxy-port",
+                        type=int,
+                        default=7001,
+                        dest="stp_port",
+                        help="proxy port (default: %(default)s)")
+    parser.add_argument("-s", "--server-port",
+                        type=int,
+                        default=8002,
+                        dest="server_port",
+                        help="server port (default: %(default)s)")
+    parser.add_argument("--role",
+                        choices=[ROLE_HOST, ROLE_CLIENT, ROLE_BOTH],
+                        default=ROLE_BOTH,
+                        help="replay the host, the client or both (default: %(default)s)")
+    parser.add_argument("--speed",
+                        type=float,
+                        default=1,
+                        help="factor for the recorded timing, 0 for as fast "
+                             "as possible (default: %(default)s)")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=0,
+                        help="send that many messages per second instead")
+    return parser.parse_args()
+
+class Arguments(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def run(args):
+    """Run the replay, return the report"""
+    records = []
+    for path in args.recordings:
+        recording = Recording(path)
+        records.extend(recording)
+        recording.close()
+    replay = Replay(records, args.role, args.speed, args.rate)
+    start = time()
+    if args.role in [ROLE_HOST, ROLE_BOTH]:
+        fixture = dict(DEFAULT_FIXTURE)
+        fixture["services"] = dict(fixture["services"])
+        for service in replay.get_services():
+            fixture["services"].setdefault(service, {"version": "1.0"})
+        replay.host = ReplayHost(Arguments(host=args.host,
+                                           port=args.stp_port,
+                                           events=[],
+                                           wait_for_connect=False),
+                                 fixture,
+                                 replay)
+        while not replay.host.is_stp_1 and not replay.host.is_closed:
+            asyncore.loop(timeout=0.01, count=1)
+    if args.role in [ROLE_CLIENT, ROLE_BOTH]:
+        replay.client = ReplayClient(Arguments(host=args.host,
+                                               port=args.server_port,
+                                               path=STP_1_CHANNEL,
+                                               protocol="",
+                                               binary=False,
+                                               size=0),
+                                     replay)
+        while not replay.client.is_open and asyncore.socket_map:
+            asyncore.loop(timeout=0.01, count=1)
+    replay.start(time())
+    now = time()
+    while not replay.is_done(now) and asyncore.socket_map:
+        asyncore.loop(timeout=0.001, count=1)
+        now = time()
+        replay.tick(now)
+    for dispatcher in [replay.host, replay.client]:
+        if dispatcher:
+            dispatcher.close()
+    return replay.report(time() - start)
+
+if __name__ == "__main__":
+    import json
+    print json.dumps(run(_parse_args()), indent=2, sort_keys=True)
@@ -1,5 +1,11 @@
+import re
+import json
 import websocket13
-from utils import pretty_print
+from utils import pretty_print, check_message
+from common import decode_varuint
+from stprecorder import recorder, DIRECTION_FROM_CLIENT, DIRECTION_TO_CLIENT
+from logwriter import logger
+from stpmessage import get_json_payload
 
 """
 stp-1 message format
@@ -23,41 +29,282 @@ STATUS = 4
 TAG = 5
 PAYLOAD = 8
 STP_MSG = "[\"%s\",%s,%s,%s,%s]"
+# name of the encoding of a Message
+ENCODING = "stp-0-envelope"
+# subprotocol to exchange the STP/1 messages of the host as they are,
+# each in a binary message
+STP_1_PROTOCOL = "stp-1"
+STP_1_PREFIX = "STP\x01"
+COMMAND_TYPE = 1
+# the part of a command envelope before the payload,
+# '["' SERVICE '",' COMMAND_ID ',' STATUS ',' TAG ','
+RE_ENVELOPE_HEAD = re.compile(r'\s*\[\s*"([^"\\]*)"\s*,\s*(\d+)\s*,'
+                              r'\s*(\d+)\s*,\s*(\d+)\s*,\s*')
+RE_BATCH_START = re.compile(r'\s*\[\s*(?=\[)')
+RE_ENVELOPE_END = re.compile(r'\s*\]\s*(?:(,)|(\])\s*$)')
+_json_decoder = json.JSONDecoder()
+
+def encode_envelope(msg):
+    # the payload first, a message which can not be transcoded
+    # is changed to an error message
+    payload = get_json_payload(msg)
+    return STP_MSG % (msg[SERVICE], msg[COMMAND], msg[STATUS], msg[TAG], payload)
+
+def _make_command(match, payload):
+    service, command_id, status, tag = match.groups()
+    return {TYPE: COMMAND_TYPE,
+            SERVICE: service,
+            COMMAND: int(command_id),
+            FORMAT: 1,
+            TAG: int(tag),
+            PAYLOAD: payload}
+
+def parse_command(message):
+    """Parse a command envelope,
+    '["' SERVICE '",' COMMAND_ID ',' STATUS ',' TAG ',' PAYLOAD ']'.
+    The payload is everything up to the closing bracket, it is not parsed."""
+    match = RE_ENVELOPE_HEAD.match(message)
+    end = message.rfind("]")
+    if not match or end < match.end() or message[end + 1:].strip():
+        raise ValueError("not a command envelope")
+    return _make_command(match, message[match.end():end].rstrip())
+
+def parse_batch(message):
+    """Parse a JSON array of command envelopes.
+    The end of each payload is found with the JSON decoder, the payload
+    itself is kept as it is."""
+    match = RE_BATCH_START.match(message)
+    if not match:
+        raise ValueError("not a batch of command envelopes")
+    commands = []
+    pos = match.end()
+    while True:
+        match = RE_ENVELOPE_HEAD.match(message, pos)
+        if not match:
+            raise ValueError("not a command envelope at %s" % pos)
+        end = _json_decoder.raw_decode(message, match.end())[1]
+        commands.append(_make_command(match, message[match.end():end]))
+        match = RE_ENVELOPE_END.match(message, end)
+        if not match:
+            raise ValueError("not a command envelope at %s" % pos)
+        if match.group(2):
+            return commands
+        pos = match.end()
+
+def parse_commands(message):
+    """Return the commands of a message from the client,
+    a single envelope or a batch"""
+    if RE_BATCH_START.match(message):
+        return parse_batch(message)
+    return [parse_command(message)]
+# big scope messages are sent in frames of that size
+FRAME_SIZE = 64 * 1024
+# reading from the host is paused if more than that waits to be sent
+# to the client and resumed if it drops below the low water mark
+HIGH_WATER_MARK = 1024 * 1024
+LOW_WATER_MARK = 256 * 1024
 
 class STPWebSocket(websocket13.WebSocket13):
 
+    frame_size = FRAME_SIZE
+    cork = True
+    protocols = [STP_1_PROTOCOL]
+
     def __init__(self, socket, headers, buffer, path, context, stp_connection):
+        self.deflate_window_bits = context.deflate_window_bits
+        self.deflate_min_size = context.deflate_min_size
         websocket13.WebSocket13.__init__(self, socket, headers, buffer, path)
         self.context = context
         self.debug = context.debug
         self.debug_format = context.format
         self.debug_format_payload = context.format_payload
         self._stp_connection = stp_connection
-        self._stp_connection.set_msg_handler(self.handle_scope_message)
+        if self.protocol == STP_1_PROTOCOL:
+            self._stp_connection.set_raw_msg_handler(self.handle_raw_scope_message)
+        else:
+            self._stp_connection.set_msg_handler(self.handle_scope_message)
+        self._is_host_paused = False
 
     # messages sent from scope
     def handle_scope_message(self, msg):
-        message = STP_MSG % (msg[SERVICE], msg[COMMAND], msg[STATUS], msg[TAG], msg[PAYLOAD])
-        if self.debug:
+        message = msg.get_encoding(ENCODING, encode_envelope)
+        if self.debug and check_message(msg):
             pretty_print("send to client:",
                          msg,
                          self.debug_format,
                          self.debug_format_payload)
+        if recorder.is_recording:
+            recorder.record(DIRECTION_TO_CLIENT, msg)
         self.send_message(message)
+        self._check_pending_size()
+
+    # messages sent from scope with the stp-1 subprotocol
+    def handle_raw_scope_message(self, msg):
+        if self.debug:
+            logger.debug("send to client: STP/1 message, %s bytes" % len(msg))
+        if recorder.is_recording:
+            recorder.record_raw(DIRECTION_TO_CLIENT, msg)
+        self.send_message(msg, binary=True)
+        self._check_pending_size()
+
+    def _check_pending_size(self):
+        if not self._is_host_paused and self.pending_size() > HIGH_WATER_MARK:
+            self._is_host_paused = True
+            self._stp_connection.pause_reading()
 
     # messages sent from the client
     def handle_message(self, message):
-        # format: "['" SERVICE "'," COMMAND_ID "," STATUS "," TAG "," PAYLOAD "]"
+        # format: '["' SERVICE '",' COMMAND_ID ',' STATUS ',' TAG ',' PAYLOAD ']'
+        # or a JSON array of such envelopes, which are sent to the host
+        # with a single write
+        try:
+            commands = parse_commands(message)
+        except ValueError, error:
+            logger.warning("invalid message from the client: %s" % error)
+            return
+        if recorder.is_recording:
+            for command in commands:
+                recorder.record(DIRECTION_FROM_CLIENT, command)
+        self._stp_connection.send_commands_STP_1(commands)
+
+    # messages sent from the client with the stp-1 subprotocol
+    def handle_binary_message(self, message):
+        """Forward an encoded STP/1 command to the host. Only the prefix,
+        the length and the message type are checked, a broken message
+        would corrupt the message stream to the host."""
+        if not self.protocol == STP_1_PROTOCOL:
+            self.handle_message(message)
+            return
+        length, pos = decode_varuint(message, len(STP_1_PREFIX))
+        msg_type = decode_varuint(message, pos)[0]
+        if message.startswith(STP_1_PREFIX) and length is not None and \
+                pos + length == len(message) and msg_type == COMMAND_TYPE:
+            if recorder.is_recording:
+                recorder.record_raw(DIRECTION_FROM_CLIENT, message)
+            self._stp_connection.send_raw_STP_1(message)
+        else:
+            logger.warning("invalid STP/1 message from the client")
+            self.handle_close()
+
+    # ============================================================
+    # Implementations of the asyncore.dispatcher class methods
+    # ============================================================
+
+    def handle_write(self):
+        websocket13.WebSocket13.handle_write(self)
+        if self._is_host_paused and self.pending_size() < LOW_WATER_MARK:
+            self._is_host_paused = False
+            self._stp_connection.resume_reading()
+
+    def handle_close(self):
+        if self._is_host_paused:
+            self._is_host_paused = False
+            self._stp_connection.resume_reading()
+        if self._stp_connection.handle_stp1_msg == self.handle_scope_message or \
+           self._stp_connection.handle_stp1_raw_msg == self.handle_raw_scope_message:
+            self._stp_connection.clear_msg_handler()
+        if self.debug:
+            stats = self.get_stats()
+            logger.debug("sent %s messages with %s writes" % (stats["messages_out"],
+                                                              stats["send_count"]))
+            if stats["deflate"]:
+                logger.debug("permessage-deflate: %s bytes to %s bytes (%.1f%%) in %.1f ms" % (
+                        stats["raw_size"],
+                        stats["compressed_size"],
+                        stats["ratio"] * 100,
+                        stats["deflate_time"] * 1000))
+        websocket13.WebSocket13.handle_close(self)
+
+if __name__ == "__main__":
+    # benchmark of the writes to a client for bursts of events,
+    # one write per message against one write per loop iteration
+    import socket
+    import asyncore
+    import threading
+    from time import time
+    from stpmessage import Message
+    EVENT_COUNT = 20000
+    BURST_SIZE = 20
+    EVENT = {SERVICE: "ecmascript-debugger", COMMAND: 14, STATUS: 0, TAG: 0,
+             PAYLOAD: '[1,2,"OnThreadStarted",[3,4,5,"inline"]]'}
+    class Context(object):
+        debug = False
+        format = False
+        format_payload = False
+        deflate_window_bits = 0
+        deflate_min_size = 0
+    class HostConnection(object):
+        pause_count = 0
+        handle_stp1_raw_msg = None
+        def set_msg_handler(self, handler):
+            self.handle_stp1_msg = handler
+        def clear_msg_handler(self):
+            self.handle_stp1_msg = None
+            self.handle_stp1_raw_msg = None
+        def pause_reading(self):
+            self.pause_count += 1
+        def resume_reading(self):
+            pass
+    def drain(sock):
+        while sock.recv(65536):
+            pass
+    for cork in [False, True]:
+        server_sock, client_sock = socket.socketpair()
+        reader = threading.Thread(target=drain, args=(client_sock,))
+        reader.start()
+        host = HostConnection()
+        web_socket = STPWebSocket(server_sock,
+                                  {"Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ=="},
+                                  "", "/stp-1-channel", Context(), host)
+        web_socket.cork = cork
+        t = time()
+        for i in range(EVENT_COUNT / BURST_SIZE):
+            # the events of one read from the host
+            for j in range(BURST_SIZE):
+                msg = Message(3)
+                msg.update(EVENT)
+                web_socket.handle_scope_message(msg)
+            asyncore.loop(timeout=0, count=1)
+        while web_socket.pending_size():
+            asyncore.loop(timeout=0.01, count=1)
+        t = time() - t
+        stats = web_socket.get_stats()
+        web_socket.close()
+        server_sock.close()
+        reader.join()
+        client_sock.close()
+        print "cork: %-5s %6s events %6s writes %6.3f writes per event %7.1f ms" % (
+            cork,
+            stats["messages_out"],
+            stats["send_count"],
+            float(stats["send_count"]) / stats["messages_out"],
+            t * 1000)
+
+    # benchmark of the parsing of a burst of 50 commands from the client,
+    # one envelope per frame with the former find/split parser against
+    # parse_command and a batch with parse_batch
+    import timeit
+    COMMANDS = ['["ecmascript-debugger",%s,0,%s,[1,[2,"[x]"],{"a":3}]]' % (i % 20, i)
+                for i in range(50)]
+    BATCH = "[%s]" % ",".join(COMMANDS)
+    def legacy_parse(message):
         message = message[1:-1]
         pos = message.find("[")
         args = message[0:pos].split(',')
-        self._stp_connection.send_command_STP_1({TYPE: 1,
-                                                 SERVICE: args[0][1:-1],
-                                                 COMMAND: int(args[1]),
-                                                 FORMAT: 1,
-                                                 TAG: int(args[3]),
-                                                 PAYLOAD: message[pos:]})
-
-    """
-    TODO handle socket close
-    """
+        return {TYPE: 1,
+                SERVICE: args[0][1:-1],
+                COMMAND: int(args[1]),
+                FORMAT: 1,
+                TAG: int(args[3]),
+                PAYLOAD: message[pos:]}
+    def legacy():
+        return [legacy_parse(command) for command in COMMANDS]
+    def single():
+        return [parse_command(command) for command in COMMANDS]
+    def batch():
+        return parse_batch(BATCH)
+    assert legacy() == single() == batch()
+    for func in [legacy, single, batch]:
+        t = min(timeit.repeat(func, number=1000, repeat=3))
+        print "%-8s %7.1f us per burst of %s commands" % (
+            func.__name__, t * 1000, len(COMMANDS))
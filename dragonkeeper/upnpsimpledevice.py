@@ -3,6 +3,7 @@ import asyncore
 import time
 import random
 import common
+from logwriter import logger
 
 def get_uuid():
     hex_digit = "0123456789abcdefABCDEF"
@@ -128,7 +129,7 @@ class SimpleUPnPDevice(asyncore.dispatcher):
     def handle_read(self):
         msg, addr = self.recvfrom(common.BUFFERSIZE)
         if self.sniff:
-            print addr, '\n', msg
+            logger.debug("%s\n%s" % (addr, msg))
         else:
             parsed_headers = common.parse_headers(msg)
             if parsed_headers:
@@ -18,6 +18,7 @@ if __name__ == "__main__":
         options.host = "0.0.0.0"
         options.server_port = 8000
         options.cgi_enabled = False
+        options.h2c_enabled = False
         server = SimpleServer(options.host, options.server_port, HTTPConnection, options)
         upnp_device = SimpleUPnPDevice(ip, options.server_port)
         print "time notify alive: ", common.get_ts_short()
@@ -1,13 +1,20 @@
+import os
 import re
+import json
+import hashlib
+from time import time
 from common import Singleton
 from maps import status_map, format_type_map, message_type_map, message_map
+from stpmessage import get_payload
+from logwriter import logger
+from requestbody import io_pool
 
 def _parse_json(msg):
     payload = None
     try:
         payload = eval(msg.replace(",null", ",None"))
     except:
-        print "failed evaling message in parse_json"
+        logger.error("failed evaling message in parse_json")
     return payload
 
 try:
@@ -29,6 +36,10 @@ MSG_VALUE_FORMAT_JSON = 1
 MSG_TYPE_ERROR = 4
 INDENT = "  "
 MAX_STR_LENGTH = 50
+# to be increased if the structure of the cached message map changes
+MESSAGE_MAP_CACHE_VERSION = 3
+# seconds between the summaries of the messages suppressed by the filter
+SUMMARY_INTERVAL = 5
 
 class TagManager(Singleton):
 
@@ -69,47 +80,21 @@ class MessageMap(object):
 
     @staticmethod
     def set_filter(filter):
-        def create_check(check):
-            def check_default(in_str):
-                return check == in_str
-            def check_endswith(in_str):
-                return in_str.endswith(check)
-            def check_startswith(in_str):
-                return in_str.startswith(check)
-            def check_pass(in_str):
-                return True
-            if check in "*":
-                return check_pass
-            if check.endswith('*'):
-                check = check.strip('*')
-                return check_startswith
-            if check.startswith('*'):
-                check = check.strip('*')
-                return check_endswith
-            return check_default
         content = filter
-        filter_obj = None
-        import os
+        source = "the filter argument"
         if os.path.isfile(filter):
+            source = filter
             try:
                 file = open(filter, 'rb')
                 content = file.read()
                 file.close()
             except:
-                print "reading filter failed"
+                logger.error("reading filter failed")
         try:
-            code = compile(content.replace('\r\n', '\n'), filter, 'eval')
-            filter_obj = eval(code)
-        except:
-            print "parsing the specified filter failed"
-        print "parsed filter:", filter_obj
-        if filter_obj:
-            for service in filter_obj:
-                for type in filter_obj[service]:
-                    filter_obj[service][type] = (
-                        [create_check(check) for check in filter_obj[service][type]]
-                        )
-            MessageMap.filter = filter_obj
+            MessageMap.filter = MessageFilter(load_filter(content))
+            logger.info("parsed filter: %s" % MessageMap.filter)
+        except ValueError, error:
+            logger.error("parsing the filter in %s failed: %s" % (source, error))
 
     @staticmethod
     def has_map():
@@ -132,6 +117,8 @@ class MessageMap(object):
         self._callback = callback
         self._print_map = context.print_message_map
         self._print_map_services = filter(bool, context.print_message_map_services.split(','))
+        self._cache_dir = context.message_map_cache
+        self._cache_path = None
         self._connection.set_msg_handler(self.default_msg_handler)
         self.request_host_info()
 
@@ -159,19 +146,24 @@ class MessageMap(object):
 
     def handle_host_info(self, msg):
         if not msg[MSG_KEY_STATUS]:
-            host_info = parse_json(msg[MSG_KEY_PAYLOAD])
+            host_info = get_payload(msg)
             if host_info:
                 for service in host_info[5]:
                     if service[0] == "scope":
                         versions = map(int, service[1].split('.'))
                         self.scope_major_version = versions[0]
                         self.scope_minor_version = versions[1]
+                if self._cache_dir:
+                    self._cache_path = self.get_cache_path(host_info)
+                    if self.load_cached_map():
+                        self.finalize()
+                        return
                 if self.scope_minor_version >= 1:
                     self.request_enums()
                 else:
                     self.request_infos()
         else:
-            print "getting host info failed"
+            logger.error("getting host info failed")
 
     def request_enums(self):
         for service in self._service_infos:
@@ -187,15 +179,14 @@ class MessageMap(object):
 
     def handle_enums(self, msg, service):
         if not msg[MSG_KEY_STATUS] and service in self._service_infos:
-            enum_list = parse_json(msg[MSG_KEY_PAYLOAD])
+            enum_list = get_payload(msg)
             if not enum_list == None:
                 self._service_infos[service]['raw_enums'] = enum_list and enum_list[0] or []
                 self._service_infos[service]['parsed_enums'] = True
                 if self.check_map_complete('parsed_enums'):
                     self.request_infos()
         else:
-            print "handling of message failed in handle_messages in MessageMap:"
-            print msg 
+            logger.error("handling of message failed in handle_messages in MessageMap:\n%s" % msg)
 
     def request_infos(self):
         for service in self._service_infos:
@@ -211,7 +202,7 @@ class MessageMap(object):
 
     def handle_info(self, msg, service):
         if not msg[MSG_KEY_STATUS] and service in self._service_infos:
-            command_list = parse_json(msg[MSG_KEY_PAYLOAD])
+            command_list = get_payload(msg)
             if command_list:
                 self._service_infos[service]['raw_infos'] = command_list
                 tag = tag_manager.set_callback(self.handle_messages, {'service': service})
@@ -224,12 +215,11 @@ class MessageMap(object):
                     MSG_KEY_PAYLOAD: '["%s", [], 1, 1]' % service
                     })
         else:
-            print "handling of message failed in handle_info in MessageMap:"
-            print msg
+            logger.error("handling of message failed in handle_info in MessageMap:\n%s" % msg)
 
     def handle_messages(self, msg, service):
         if not msg[MSG_KEY_STATUS] and service in self._service_infos:
-            message_list = parse_json(msg[MSG_KEY_PAYLOAD])
+            message_list = get_payload(msg)
             self._service_infos[service]['raw_messages'] = message_list
             # the message list can be empty (e.g. for the 'core' service)
             if message_list:
@@ -238,10 +228,61 @@ class MessageMap(object):
             if self.check_map_complete('parsed'):
                 self.finalize()
         else:
-            print "handling of message failed in handle_messages in MessageMap:"
-            print msg
+            logger.error("handling of message failed in handle_messages in MessageMap:\n%s" % msg)
+
+    # =====================================================
+    # cache the message map, keyed by the versions of the host
+    # =====================================================
+    #
+    # the cache is a JSON file with the payloads of Info, MessageInfo
+    # and EnumInfo of each service, the map is compiled from them, like
+    # {<service>: [<raw infos>, <raw messages>, <raw enums>]}
+
+    def get_cache_path(self, host_info):
+        """The cache key is the core version and the name and version
+        of each service from HostInfo"""
+        CORE_VERSION = 1
+        SERVICE_LIST = 5
+        key = repr((MESSAGE_MAP_CACHE_VERSION,
+                    host_info[CORE_VERSION],
+                    sorted(tuple(service[0:2]) for service in host_info[SERVICE_LIST]
+                           if service[0] in self._service_infos)))
+        name = "message-map-%s.json" % hashlib.sha1(key).hexdigest()
+        return os.path.join(os.path.expanduser(self._cache_dir), name)
+
+    def load_cached_map(self):
+        if not os.path.isfile(self._cache_path):
+            return False
+        try:
+            file = open(self._cache_path, 'rb')
+            try:
+                raw_lists = json.load(file)
+            finally:
+                file.close()
+            cached_map = {}
+            for service, (raw_infos, raw_messages, raw_enums) in raw_lists.items():
+                cached_map[service] = compile_service(raw_infos, raw_messages, raw_enums)
+        except Exception, error:
+            logger.warning("reading the message map cache failed: %s" % error)
+            return False
+        self._map.clear()
+        self._map.update(cached_map)
+        self._cache_path = None
+        return True
+
+    def save_cached_map(self):
+        """Collect the raw lists, the file is written on the io pool"""
+        raw_lists = {}
+        for service, info in self._service_infos.items():
+            if service in self._map:
+                raw_lists[service] = [info['raw_infos'],
+                                      info['raw_messages'],
+                                      info.get('raw_enums', [])]
+        io_pool.submit(self._cache_path, write_cache_file, self._cache_path, raw_lists)
 
     def finalize(self):
+        if self._cache_path:
+            self.save_cached_map()
         if self._print_map:
             self.pretty_print_message_map()
         self._connection.clear_msg_handler()
@@ -260,244 +301,496 @@ class MessageMap(object):
 
     def default_msg_handler(self, msg):
         if not tag_manager.handle_message(msg):
-            print "handling of message failed in default_msg_handler in MessageMap:"
-            print msg
+            logger.error("handling of message failed in default_msg_handler in MessageMap:\n%s" % msg)
                 
     # =======================
     # create the message maps
     # =======================
 
-    def get_msg(self, list, id):
-        MSG_ID = 0
-        for msg in list:
-            if msg[MSG_ID] == id:
-                return msg
-        return None
-
-    def get_enum(self, list, id):
-        enums = self.get_msg(list, id)
-        name = enums[1]
-        dict = {}
-        if enums and len(enums) == 3:
-            for enum in enums[2]:
-                dict[enum[1]] = enum[0]
-        return name, dict
-            
-    def parse_msg(self, msg, msg_list, parsed_list, raw_enums, ret):
-        NAME = 1
-        FIELD_LIST = 2
-        FIELD_NAME = 0
-        FIELD_TYPE = 1
-        FIELD_NUMBER = 2
-        FIELD_Q = 3
-        FIELD_ID = 4
-        ENUM_ID = 5
-        Q_MAP = {
-            0: "required",
-            1: "optional",
-            2: "repeated"
-        }
-        if msg:
-            for field in msg[FIELD_LIST]:
-                name = field[FIELD_NAME]
-                field_obj = {
-                    'name': name,
-                    'q': 'required',
-                    'type': field[FIELD_TYPE],
-                }
-                if (len(field) - 1) >= FIELD_Q and field[FIELD_Q]:
-                    field_obj['q'] = Q_MAP[field[FIELD_Q]]
-                if (len(field) - 1) >= FIELD_ID and field[FIELD_ID]:
-                    if name in parsed_list:
-                        field_obj['message'] = parsed_list[name]['message'] 
-                        field_obj['message_name'] = parsed_list[name]['message_name']
-                    else:
-                        parsed_list[name] = field_obj
-                        msg = self.get_msg(msg_list, field[FIELD_ID])
-                        field_obj['message_name'] = msg and msg[1] or 'default'
-                        field_obj['message'] = []
-                        self.parse_msg(msg, msg_list, parsed_list, 
-                                            raw_enums, field_obj['message'])
-                if (len(field) - 1) >= ENUM_ID and field[ENUM_ID]:
-                    name, numbers = self.get_enum(raw_enums, field[ENUM_ID])
-                    field_obj['enum'] = {'name': name, 'numbers': numbers} 
-                ret.append(field_obj)
-        return ret
-
     def parse_raw_lists(self, service):
-        MSG_TYPE_COMMAND = 1
-        MSG_TYPE_RESPONSE = 2
-        MSG_TYPE_EVENT = 3
-        # Command Info
-        COMMAND_LIST = 0
-        EVENT_LIST = 1
-        NAME = 0
-        NUMBER = 1 
-        MESSAGE_ID = 2
-        RESPONSE_ID = 3
-        # Command MessageInfo
-        MSG_LIST = 0
-        MSG_ID = 0
-        map = self._map[service] = {}
-        command_list = self._service_infos[service]['raw_infos'][COMMAND_LIST]
-        msgs = self._service_infos[service]['raw_messages'][MSG_LIST]
-        enums = self._service_infos[service].get('raw_enums', [])
-        for command in command_list:
-            command_obj = map[command[NUMBER]] = {}
-            command_obj['name'] = command[NAME]
-            msg = self.get_msg(msgs, command[MESSAGE_ID])
-            command_obj[MSG_TYPE_COMMAND] = self.parse_msg(msg, msgs, {}, enums, [])
-            msg = self.get_msg(msgs, command[RESPONSE_ID])
-            command_obj[MSG_TYPE_RESPONSE] = self.parse_msg(msg, msgs, {}, enums, [])
-
-        if len(self._service_infos[service]['raw_infos']) - 1 >= EVENT_LIST:
-            event_list = self._service_infos[service]['raw_infos'][EVENT_LIST]
-            for event in event_list:
-                event_obj = map[event[NUMBER]] = {}
-                event_obj['name'] = event[NAME]
-                msg = self.get_msg(msgs, event[MESSAGE_ID])
-                event_obj[MSG_TYPE_EVENT] = self.parse_msg(msg, msgs, {}, enums, [])
+        info = self._service_infos[service]
+        self._map[service] = compile_service(info['raw_infos'],
+                                             info['raw_messages'],
+                                             info.get('raw_enums', []))
 
     # =========================
     # pretty print message maps
     # =========================
 
-    def pretty_print_object(self, obj, indent, c_list, name=''):
+    def pretty_print_fields(self, fields, indent, c_list, lines):
         INDENT = '    '
-        c_list = [] + c_list
-        if name:
-            name = '%s: ' % self.quote(name)
-        print '%s%s{' % (indent * INDENT, name)
-        indent += 1
-        keys = obj.keys()
-        for key in keys:
-            if not (isinstance(obj[key], dict) or isinstance(obj[key], list)):
-                print '%s%s: %s,' % (indent * INDENT, 
-                                        self.quote(key), self.quote(obj[key]))
-        for key in keys:
-            if isinstance(obj[key], dict):
-                self.pretty_print_object(obj[key], indent, c_list, key)
-        for key in keys:
-            if isinstance(obj[key], list):
-                if key == "message":
-                    if obj['message_name'] in c_list:
-                        print '%s"message": <circular reference>,' % (
-                            indent * INDENT)
-                        continue
-                    else:
-                        c_list.append(obj['message_name'])
-                if obj[key]:
-                    print '%s%s: [' % (indent * INDENT, self.quote(key))
-                    for item in obj[key]:
-                        self.pretty_print_object(item, indent + 1, c_list)
-                    print '%s],' % (indent * INDENT)
+        append = lines.append
+        for field in fields:
+            append('%s{' % (indent * INDENT))
+            indent += 1
+            append('%s"name": "%s",' % (indent * INDENT, field.name))
+            append('%s"q": "%s",' % (indent * INDENT, field.q))
+            append('%s"type": %s,' % (indent * INDENT, field.type))
+            if field.enum:
+                append('%s"enum": {' % (indent * INDENT))
+                append('%s"name": "%s",' % ((indent + 1) * INDENT, field.enum.name))
+                append('%s"numbers": %s,' % ((indent + 1) * INDENT, field.enum.numbers))
+                append('%s},' % (indent * INDENT))
+            if field.message:
+                append('%s"message_name": "%s",' % (indent * INDENT, field.message.name))
+                if field.message.name in c_list:
+                    append('%s"message": <circular reference>,' % (indent * INDENT))
+                elif field.message.fields:
+                    append('%s"message": [' % (indent * INDENT))
+                    self.pretty_print_fields(field.message.fields, indent + 1,
+                                             c_list + [field.message.name], lines)
+                    append('%s],' % (indent * INDENT))
                 else:
-                    print '%s%s: [],' % (indent * INDENT, self.quote(key))
-        indent -= 1
-        print '%s},' % (indent * INDENT)
-  
+                    append('%s"message": [],' % (indent * INDENT))
+            indent -= 1
+            append('%s},' % (indent * INDENT))
+
     def pretty_print_message_map(self):
-        print 'message map:'
-        print '{'
+        INDENT = '    '
+        lines = ['message map:', '{']
+        append = lines.append
         for service in self._map:
             if not self._print_map_services or service in self._print_map_services:
-                self.pretty_print_object(self._map[service], 1, [], service)
-        print '}'
-    
-    def quote(self, value):
-        return isinstance(value, str) and '"%s"' % value or value
-        
+                append('%s"%s": {' % (INDENT, service))
+                for number, command in self._map[service].iteritems():
+                    append('%s%s: {' % (2 * INDENT, number))
+                    append('%s"name": "%s",' % (3 * INDENT, command['name']))
+                    for msg_type in sorted(key for key in command if not key == 'name'):
+                        append('%s%s: [' % (3 * INDENT, msg_type))
+                        self.pretty_print_fields(command[msg_type], 4, [], lines)
+                        append('%s],' % (3 * INDENT))
+                    append('%s},' % (2 * INDENT))
+                append('%s},' % INDENT)
+        append('}')
+        logger.info("\n".join(lines))
+
+# =====================================
+# compile the message definitions
+# =====================================
+
+class EnumDef(object):
+    __slots__ = ('name', 'numbers')
+
+    def __init__(self, name, numbers):
+        self.name = name
+        # number -> name
+        self.numbers = numbers
+
+class MessageDef(object):
+    __slots__ = ('id', 'name', 'fields')
+
+    def __init__(self, id, name, fields):
+        self.id = id
+        self.name = name
+        self.fields = fields
+
+class FieldDef(object):
+    __slots__ = ('name', 'type', 'number', 'q', 'message', 'enum')
+
+    def __init__(self, name, type, number, q, message=None, enum=None):
+        self.name = name
+        self.type = type
+        self.number = number
+        self.q = q
+        # a MessageDef or None
+        self.message = message
+        # an EnumDef or None
+        self.enum = enum
+
+Q_MAP = {
+    0: "required",
+    1: "optional",
+    2: "repeated"
+}
+
+class ServiceCompiler(object):
+    """Compiles the raw lists of Info, MessageInfo and EnumInfo of a service.
+    The messages and enums are indexed by id once and each of them is
+    compiled once, all fields referencing it share the descriptor.
+    Recursive messages reference themselves."""
+
+    # MessageInfo
+    MSG_ID = 0
+    MSG_NAME = 1
+    FIELD_LIST = 2
+    FIELD_NAME = 0
+    FIELD_TYPE = 1
+    FIELD_NUMBER = 2
+    FIELD_Q = 3
+    FIELD_ID = 4
+    ENUM_ID = 5
+    # EnumInfo
+    ENUM_NAME = 1
+    ENUM_VALUES = 2
+
+    def __init__(self, raw_messages, raw_enums):
+        self._raw_messages = dict((msg[self.MSG_ID], msg) for msg in raw_messages)
+        self._raw_enums = dict((enum[self.MSG_ID], enum) for enum in raw_enums)
+        self._messages = {}
+        self._enums = {}
+
+    def get_message(self, id):
+        message = self._messages.get(id)
+        if message:
+            return message
+        raw_msg = self._raw_messages.get(id)
+        if not raw_msg:
+            message = self._messages[id] = MessageDef(id, 'default', [])
+            return message
+        # registered before the fields are compiled to resolve recursion
+        message = self._messages[id] = MessageDef(id, raw_msg[self.MSG_NAME], [])
+        for field in raw_msg[self.FIELD_LIST]:
+            length = len(field)
+            field_def = FieldDef(field[self.FIELD_NAME],
+                                 field[self.FIELD_TYPE],
+                                 field[self.FIELD_NUMBER],
+                                 length > self.FIELD_Q and Q_MAP.get(field[self.FIELD_Q])
+                                 or "required")
+            if length > self.FIELD_ID and field[self.FIELD_ID]:
+                field_def.message = self.get_message(field[self.FIELD_ID])
+            if length > self.ENUM_ID and field[self.ENUM_ID]:
+                field_def.enum = self.get_enum(field[self.ENUM_ID])
+            message.fields.append(field_def)
+        return message
+
+    def get_enum(self, id):
+        enum = self._enums.get(id)
+        if not enum:
+            raw_enum = self._raw_enums.get(id)
+            numbers = {}
+            if raw_enum and len(raw_enum) > self.ENUM_VALUES:
+                for name, number in raw_enum[self.ENUM_VALUES]:
+                    numbers[number] = name
+            enum = self._enums[id] = EnumDef(raw_enum and raw_enum[self.ENUM_NAME],
+                                             numbers)
+        return enum
+
+    def get_fields(self, id):
+        return self.get_message(id).fields
+
+def write_cache_file(path, raw_lists):
+    """Write a message map cache, runs on the io pool"""
+    directory = os.path.dirname(path)
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        file = open(tmp_path, 'wb')
+        try:
+            json.dump(raw_lists, file, separators=(',', ':'))
+        finally:
+            file.close()
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Windows does not replace an existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+    except Exception, error:
+        logger.warning("writing the message map cache failed: %s" % error)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def compile_service(raw_infos, raw_messages, raw_enums):
+    """Return the map of a service,
+        {<command or event number>: {'name': <name>,
+                                     <message type>: [<FieldDef>, ...]}}"""
+    MSG_TYPE_COMMAND = 1
+    MSG_TYPE_RESPONSE = 2
+    MSG_TYPE_EVENT = 3
+    # Command Info
+    COMMAND_LIST = 0
+    EVENT_LIST = 1
+    NAME = 0
+    NUMBER = 1
+    MESSAGE_ID = 2
+    RESPONSE_ID = 3
+    # Command MessageInfo
+    MSG_LIST = 0
+    compiler = ServiceCompiler(raw_messages[MSG_LIST], raw_enums)
+    map = {}
+    for command in raw_infos[COMMAND_LIST]:
+        map[command[NUMBER]] = {
+            'name': command[NAME],
+            MSG_TYPE_COMMAND: compiler.get_fields(command[MESSAGE_ID]),
+            MSG_TYPE_RESPONSE: compiler.get_fields(command[RESPONSE_ID])
+        }
+    if len(raw_infos) > EVENT_LIST:
+        for event in raw_infos[EVENT_LIST]:
+            map[event[NUMBER]] = {
+                'name': event[NAME],
+                MSG_TYPE_EVENT: compiler.get_fields(event[MESSAGE_ID])
+            }
+    return map
+
+# ==============
+# message filter
+# ==============
+
+def load_filter(content):
+    """Parse a filter like
+        {"<service name>": {"<message type>": [<message>*]}}
+    A message is a name or an object with the name and a limit,
+        {"name": <name>, "rate": <messages per second>, "sample": <ratio>}"""
+    try:
+        filter_obj = json.loads(content)
+    except ValueError, error:
+        raise ValueError("%s, the filter must be JSON with double quotes like "
+                         "{\"ecmascript-debugger\": {\"event\": [\"OnThread*\"]}}" % error)
+    if not isinstance(filter_obj, dict):
+        raise ValueError("the filter must be an object")
+    return filter_obj
+
+def _get_pattern(names):
+    return "|".join(".*".join(re.escape(part) for part in name.split("*"))
+                    for name in names)
+
+class MessageLimit(object):
+    """The limit of a filter entry with a rate and a sampling ratio.
+    The messages are counted for each service and command, of the
+    messages matching the entry only every 1 / sample is printed and
+    at most rate per second."""
+
+    def __init__(self, entry):
+        if not "name" in entry:
+            raise ValueError("a limited message needs a name: %s" % json.dumps(entry))
+        self.regexp = re.compile("(?:%s)$" % _get_pattern([entry["name"]]))
+        self.rate = entry.get("rate")
+        self.sample = entry.get("sample")
+        if self.rate is not None and not self.rate > 0:
+            raise ValueError("the rate must be greater than 0: %s" % json.dumps(entry))
+        if self.sample is not None and not 0 < self.sample <= 1:
+            raise ValueError("the sample must be in (0, 1]: %s" % json.dumps(entry))
+        # (service, name) -> [sample credit, start of the second, printed in the second]
+        self._states = {}
+
+    def check(self, key, now):
+        state = self._states.get(key)
+        if not state:
+            state = self._states[key] = [1.0, now, 0]
+        if self.sample:
+            if state[0] < 1:
+                state[0] += self.sample
+                return False
+            state[0] += self.sample - 1
+        if self.rate:
+            if now - state[1] >= 1:
+                state[1] = now
+                state[2] = 0
+            if state[2] >= self.rate:
+                return False
+            state[2] += 1
+        return True
+
+class MessageFilter(object):
+    """A compiled message filter. The message names of a service and a
+    message type are combined to one regular expression, a message is
+    checked with a dict lookup and a match of its command name.
+    The messages suppressed by a limit are counted, the counts are
+    logged every SUMMARY_INTERVAL seconds."""
+
+    def __init__(self, filter_obj):
+        type_numbers = dict((name, number) for number, name in message_type_map.items())
+        self._filter_obj = filter_obj
+        self._services = {}
+        # "<service>.<name>" -> count of the suppressed messages
+        self._suppressed = {}
+        self._summary_time = time()
+        for service, types in filter_obj.items():
+            checks = self._services[service] = {}
+            for type, names in types.items():
+                if not type in type_numbers:
+                    raise ValueError("unknown message type %s" % type)
+                limits = [MessageLimit(name) for name in names if isinstance(name, dict)]
+                names = [name for name in names if not isinstance(name, dict)]
+                regexp = names and re.compile("(?:%s)$" % _get_pattern(names)) or None
+                checks[type_numbers[type]] = (regexp, limits)
+
+    def __str__(self):
+        return json.dumps(self._filter_obj)
+
+    def check(self, msg):
+        checks = self._services.get(msg[MSG_KEY_SERVICE])
+        if checks:
+            check = checks.get(msg[MSG_KEY_TYPE])
+            if check:
+                regexp, limits = check
+                command_def = message_map.get(msg[MSG_KEY_SERVICE], {}).get(msg[MSG_KEY_COMMAND_ID])
+                name = command_def and command_def.get("name") or \
+                       '<id: %d>' % msg[MSG_KEY_COMMAND_ID]
+                for limit in limits:
+                    if limit.regexp.match(name):
+                        return self._check_limit(limit, msg[MSG_KEY_SERVICE], name)
+                return bool(regexp and regexp.match(name))
+        return False
+
+    def _check_limit(self, limit, service, name):
+        now = time()
+        if limit.check((service, name), now):
+            self.poll(now)
+            return True
+        key = "%s.%s" % (service, name)
+        self._suppressed[key] = self._suppressed.get(key, 0) + 1
+        self.poll(now)
+        return False
+
+    def poll(self, now=None):
+        """Log the counts of the suppressed messages if they are due"""
+        if self._suppressed:
+            now = now or time()
+            if now - self._summary_time >= SUMMARY_INTERVAL:
+                self._summary_time = now
+                # info, the logger drops debug records first under load
+                for key, count in sorted(self._suppressed.items()):
+                    logger.info(u"%s \u00d7 %s suppressed" % (count, key),
+                                 name=key, suppressed=count)
+                self._suppressed = {}
+
 # ===========================
 # pretty print STP/1 messages
 # ===========================
 
-def pretty_print_payload_item(indent, name, definition, item, verbose_debug=False):
-    if item and "message" in definition:
-        print "%s%s:" % (indent * INDENT, name)
-        pretty_print_payload(item, definition["message"], indent=indent+1)
-    else:
-        value = item
-        if "enum" in definition:
-            value = "%s (%s)" % (definition['enum']['numbers'][item], item)
-        elif item == None:
-            value = "null"
-        elif isinstance(item, unicode):
-            if not verbose_debug and len(item) > MAX_STR_LENGTH:
-                value = "\"%s...\"" % item[0:MAX_STR_LENGTH]
+def format_value(item, verbose_debug=False):
+    if item == None:
+        return "null"
+    if isinstance(item, unicode):
+        if not verbose_debug and len(item) > MAX_STR_LENGTH:
+            return "\"%s...\"" % item[0:MAX_STR_LENGTH]
+        return "\"%s\"" % item
+    return item
+
+class FormatterCompiler(object):
+    """Generates the source of a payload formatter from a list of
+    FieldDef objects. The formatter is called like
+
+        formatter(payload, indent, lines, verbose_debug)
+
+    and appends the formatted lines to lines. Each message gets a function
+    of its own, the tests for the type, the enum and the quantifier and
+    the field names are resolved when the source is generated."""
+
+    def __init__(self):
+        self._names = {}
+        self._sources = []
+        self._namespace = {'INDENT': INDENT, 'format_value': format_value}
+
+    def compile(self, fields):
+        self._add_function("format_payload", fields)
+        exec compile("\n\n".join(self._sources),
+                     "<payload formatter>",
+                     "exec") in self._namespace
+        return self._namespace["format_payload"]
+
+    def _get_function_name(self, message):
+        name = self._names.get(id(message))
+        if not name:
+            # registered before the function is generated,
+            # recursive messages call themselves
+            name = self._names[id(message)] = "format_message_%s" % len(self._names)
+            self._add_function(name, message.fields)
+        return name
+
+    def _add_function(self, name, fields):
+        source = ["def %s(payload, indent, lines, verbose_debug):" % name,
+                  "    count = len(payload)",
+                  "    append = lines.append"]
+        for index, field in enumerate(fields):
+            source.append("    if count > %s:" % index)
+            if field.q == "repeated":
+                source.extend([
+                    "        append(indent + %r)" % (field.name + ":"),
+                    "        item_indent = indent + INDENT",
+                    "        for item in payload[%s]:" % index])
+                self._add_item(source, "            ", "item_indent",
+                               field.name.replace("List", ""), field)
             else:
-                value = "\"%s\"" % item
-        try:
-            print "%s%s: %s" % ( indent * INDENT, name, value)
-        except:
-            print "%s%s: %s%s" % ( indent * INDENT, name, value[0:100], '...')
-
-def pretty_print_payload(payload, definitions, indent=2, verbose_debug=False):
-    for item, definition in zip(payload, definitions):
-        if definition["q"] == "repeated":
-            print "%s%s:" % (indent * INDENT, definition['name'])
-            for sub_item in item:
-                pretty_print_payload_item(
-                        indent + 1,
-                        definition['name'].replace("List", ""),
-                        definition,
-                        sub_item,
-                        verbose_debug=verbose_debug)
+                source.append("        item = payload[%s]" % index)
+                self._add_item(source, "        ", "indent", field.name, field)
+        self._sources.append("\n".join(source))
+
+    def _add_item(self, source, pad, indent, name, field):
+        if field.message:
+            source.extend([
+                pad + "if item:",
+                pad + "    append(%s + %r)" % (indent, name + ":"),
+                pad + "    %s(item, %s + INDENT, lines, verbose_debug)" % (
+                                self._get_function_name(field.message), indent),
+                pad + "else:"])
+            pad += "    "
+        head = "%s: " % name.replace("%", "%%")
+        if field.enum:
+            enum_name = "enum_%s" % id(field.enum)
+            self._namespace[enum_name] = field.enum.numbers
+            source.append(pad + "append(%s + %r %% (%s[item], item))" % (
+                                indent, head + "%s (%s)", enum_name))
         else:
-            pretty_print_payload_item(
-                    indent,
-                    definition['name'],
-                    definition,
-                    item,
-                    verbose_debug=verbose_debug)
+            source.append(pad + "append(%s + %r %% (format_value(item, verbose_debug),))" % (
+                                indent, head + "%s"))
+
+# (service, command id, message type) -> (definitions, formatter)
+_payload_formatters = {}
+
+def get_payload_formatter(service, command_id, message_type, definitions):
+    """Return the cached formatter for the given definitions.
+    The formatter is generated again if the message map has changed."""
+    key = (service, command_id, message_type)
+    formatter = _payload_formatters.get(key)
+    if not formatter or not formatter[0] is definitions:
+        formatter = _payload_formatters[key] = (
+                definitions, FormatterCompiler().compile(definitions))
+    return formatter[1]
 
 def pretty_print(prelude, msg, format, format_payload, verbose_debug=False):
     service = msg[MSG_KEY_SERVICE]
-    command_def = message_map.get(service, {}).get(msg[MSG_KEY_COMMAND_ID], None)
+    command_id = msg[MSG_KEY_COMMAND_ID]
+    command_def = message_map.get(service, {}).get(command_id, None)
     command_name = command_def and command_def.get("name", None) or \
-                                    '<id: %d>' % msg[MSG_KEY_COMMAND_ID]
+                                    '<id: %d>' % command_id
     message_type = message_type_map[msg[MSG_KEY_TYPE]]
-    if not MessageMap.filter or check_message(service, command_name, message_type): 
-        print prelude
-        if format:
-            print "  message type:", message_type
-            print "  service:", service
-            print "  command:", command_name
-            print "  format:", format_type_map[msg[MSG_KEY_FORMAT]]
-            if MSG_KEY_STATUS in msg:
-                print "  status:", status_map[msg[MSG_KEY_STATUS]]
-            if MSG_KEY_CLIENT_ID in msg:
-                print "  cid:", msg[MSG_KEY_CLIENT_ID]
-            if MSG_KEY_UUID in msg:
-                print "  uuid:", msg[MSG_KEY_UUID]
-            if MSG_KEY_TAG in msg:
-                print "  tag:", msg[MSG_KEY_TAG]
-            if format_payload and not msg[MSG_KEY_TYPE] == MSG_TYPE_ERROR:
-                payload = parse_json(msg[MSG_KEY_PAYLOAD])
-                print "  payload:"
-                if payload and command_def:
-                    definition = command_def.get(msg[MSG_KEY_TYPE], None)
-                    try:
-                        pretty_print_payload(payload, definition, verbose_debug=verbose_debug)
-                    except Exception, msg:
-                        # print msg 
-                        print "failed to pretty print the paylod. wrong message structure?"
-                        print "%spayload: %s" % (INDENT, payload)
-                        print "%sdefinition: %s" % (INDENT, definition)
-                else:
-                    print "    ", msg[MSG_KEY_PAYLOAD]
-                print "\n"
-            else:
-                print "  payload:", msg[MSG_KEY_PAYLOAD], "\n"
+    if not format:
+        logger.debug("%s\n%s" % (prelude, msg))
+        return
+    lines = [prelude,
+             "  message type: %s" % message_type,
+             "  service: %s" % service,
+             "  command: %s" % command_name,
+             "  format: %s" % format_type_map[msg[MSG_KEY_FORMAT]]]
+    if MSG_KEY_STATUS in msg:
+        lines.append("  status: %s" % status_map[msg[MSG_KEY_STATUS]])
+    if MSG_KEY_CLIENT_ID in msg:
+        lines.append("  cid: %s" % msg[MSG_KEY_CLIENT_ID])
+    if MSG_KEY_UUID in msg:
+        lines.append("  uuid: %s" % msg[MSG_KEY_UUID])
+    if MSG_KEY_TAG in msg:
+        lines.append("  tag: %s" % msg[MSG_KEY_TAG])
+    if format_payload and not msg[MSG_KEY_TYPE] == MSG_TYPE_ERROR:
+        payload = get_payload(msg)
+        lines.append("  payload:")
+        if payload and command_def:
+            definition = command_def.get(msg[MSG_KEY_TYPE], None)
+            payload_lines = []
+            try:
+                formatter = get_payload_formatter(service, command_id,
+                                                  msg[MSG_KEY_TYPE], definition)
+                formatter(payload, 2 * INDENT, payload_lines, verbose_debug)
+                lines.extend(payload_lines)
+            except Exception:
+                lines.extend([
+                    "failed to pretty print the paylod. wrong message structure?",
+                    "%spayload: %s" % (INDENT, payload),
+                    "%sdefinition: %s" % (INDENT, definition)])
         else:
-            print msg
+            lines.append("     %s" % msg[MSG_KEY_PAYLOAD])
+        lines.append("\n")
+    else:
+        lines.append("  payload: %s \n" % msg[MSG_KEY_PAYLOAD])
+    logger.debug("\n".join(lines),
+                 service=service, command=command_name, type=message_type)
 
-def check_message(service, command, message_type):
-    if MessageMap.filter and service in MessageMap.filter and \
-        message_type in MessageMap.filter[service]:
-            for check in MessageMap.filter[service][message_type]:
-                if check(command):
-                    return True
-    return False
+def check_message(msg):
+    """Check a message against the --message-filter.
+    To be called before any work is done to print the message."""
+    return not MessageMap.filter or MessageMap.filter.check(msg)
 
 # ===========================
 # pretty print STP/0 messages
@@ -511,7 +804,6 @@ def pretty_print_XML(prelude, in_string, format):
     CLOSING_TAG = 2
     OPENING_CLOSING_TAG = 3
     OPENING_TAG = 4
-    print prelude
     if format:
         if in_string.startswith("<"):
             in_string = re.sub(r"<\?[^>]*>", "", in_string)
@@ -543,4 +835,174 @@ def pretty_print_XML(prelude, in_string, format):
         else:
             ret = [in_string]
         in_string = "".join(ret).lstrip(LF)
-    print in_string
+    logger.debug("%s\n%s" % (prelude, in_string))
+
+if __name__ == "__main__":
+    # benchmark of the map build time and the memory of the maps for a large
+    # synthetic service set, the former compiler, which searched the message
+    # lists linearly and parsed each message again for every field,
+    # against compile_service, e.g.
+    #     python utils.py 20 400
+    import sys
+    from time import time
+    service_count = len(sys.argv) > 1 and int(sys.argv[1]) or 20
+    message_count = len(sys.argv) > 2 and int(sys.argv[2]) or 200
+
+    def make_service():
+        msgs = []
+        for id in range(1, message_count + 1):
+            fields = [["field%s" % i, 1 + i % 4, i + 1, i % 3, 0, i == 2 and 1 or 0]
+                      for i in range(6)]
+            if id > 1:
+                fields.append(["child", 11, 7, 2, id / 2, 0])
+            if not id % 10:
+                fields.append(["self", 11, 8, 1, id, 0])
+            msgs.append([id, "Message%s" % id, fields])
+        commands = [["Command%s" % i, i, i * 2 % message_count + 1,
+                     (i * 2 + 1) % message_count + 1]
+                    for i in range(message_count / 3)]
+        events = [["OnEvent%s" % i, 500 + i, i % message_count + 1]
+                  for i in range(message_count / 6)]
+        enums = [[1, "Kind", [[name, i] for i, name in enumerate("ABCDEF")]]]
+        return [commands, events], [msgs], enums
+
+    def get_msg(list, id):
+        for msg in list:
+            if msg[0] == id:
+                return msg
+        return None
+
+    def parse_msg(msg, msg_list, parsed_list, raw_enums, ret):
+        if msg:
+            for field in msg[2]:
+                name = field[0]
+                field_obj = {'name': name, 'q': Q_MAP[field[3]], 'type': field[1]}
+                if field[4]:
+                    if name in parsed_list:
+                        field_obj['message'] = parsed_list[name]['message']
+                        field_obj['message_name'] = parsed_list[name]['message_name']
+                    else:
+                        parsed_list[name] = field_obj
+                        msg = get_msg(msg_list, field[4])
+                        field_obj['message_name'] = msg and msg[1] or 'default'
+                        field_obj['message'] = []
+                        parse_msg(msg, msg_list, parsed_list,
+                                  raw_enums, field_obj['message'])
+                if field[5]:
+                    enum = get_msg(raw_enums, field[5])
+                    field_obj['enum'] = {
+                        'name': enum[1],
+                        'numbers': dict((number, name) for name, number in enum[2])}
+                ret.append(field_obj)
+        return ret
+
+    def legacy_compile(raw_infos, raw_messages, raw_enums):
+        map = {}
+        msgs = raw_messages[0]
+        for name, number, msg_id, response_id in raw_infos[0]:
+            map[number] = {
+                'name': name,
+                1: parse_msg(get_msg(msgs, msg_id), msgs, {}, raw_enums, []),
+                2: parse_msg(get_msg(msgs, response_id), msgs, {}, raw_enums, [])}
+        for name, number, msg_id in raw_infos[1]:
+            map[number] = {
+                'name': name,
+                3: parse_msg(get_msg(msgs, msg_id), msgs, {}, raw_enums, [])}
+        return map
+
+    def get_size(obj):
+        """Size of obj and of all objects it references, each counted once"""
+        seen = set()
+        stack = [obj]
+        size = 0
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple)):
+                stack.extend(obj)
+            elif hasattr(obj, '__slots__'):
+                stack.extend(getattr(obj, name) for name in obj.__slots__)
+        return size
+
+    service = make_service()
+    print "%s services with %s messages" % (service_count, message_count)
+    for compile_map in [legacy_compile, compile_service]:
+        t = time()
+        maps = [compile_map(*service) for i in range(service_count)]
+        print "%-16s %8.1f ms %8.1f MB" % (compile_map.__name__,
+                                              (time() - t) * 1000,
+                                              get_size(maps) / 1024.0 / 1024)
+
+    # formatting of a payload with --format-payload, the former walker of
+    # the definitions which printed line by line against the generated
+    # formatter, the output goes to a null device
+    def legacy_print_item(indent, name, definition, item):
+        if item and definition.message:
+            print "%s%s:" % (indent * INDENT, name)
+            legacy_print_payload(item, definition.message.fields, indent=indent+1)
+        else:
+            value = item
+            if definition.enum:
+                value = "%s (%s)" % (definition.enum.numbers[item], item)
+            elif item == None:
+                value = "null"
+            elif isinstance(item, unicode):
+                if len(item) > MAX_STR_LENGTH:
+                    value = "\"%s...\"" % item[0:MAX_STR_LENGTH]
+                else:
+                    value = "\"%s\"" % item
+            print "%s%s: %s" % (indent * INDENT, name, value)
+
+    def legacy_print_payload(payload, definitions, indent=2):
+        for item, definition in zip(payload, definitions):
+            if definition.q == "repeated":
+                print "%s%s:" % (indent * INDENT, definition.name)
+                for sub_item in item:
+                    legacy_print_item(indent + 1,
+                                      definition.name.replace("List", ""),
+                                      definition,
+                                      sub_item)
+            else:
+                legacy_print_item(indent, definition.name, definition, item)
+
+    def make_payload(fields, depth):
+        payload = []
+        for field in fields:
+            if field.message:
+                value = depth and make_payload(field.message.fields, depth - 1) or None
+            elif field.enum:
+                value = 1
+            else:
+                value = field.type % 2 and u"value of %s" % field.name or 42
+            payload.append(field.q == "repeated" and [value, value] or value)
+        return payload
+
+    # the response of the last command has the deepest message tree
+    definitions = maps[0][message_count / 3 - 1][2]
+    payload = make_payload(definitions, 8)
+    count = 100
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t = time()
+        for i in range(count):
+            legacy_print_payload(payload, definitions)
+        t_legacy = time() - t
+        t = time()
+        for i in range(count):
+            lines = []
+            get_payload_formatter("service", 1, 2, definitions)(payload, 2 * INDENT, lines, False)
+            sys.stdout.write("\n".join(lines).encode("utf-8") + "\n")
+        t_generated = time() - t
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print "payload with %s lines" % len(lines)
+    print "%-16s %8.2f ms per payload" % ("legacy", t_legacy / count * 1000)
+    print "%-16s %8.2f ms per payload" % ("generated", t_generated / count * 1000)
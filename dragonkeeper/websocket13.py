@@ -4,34 +4,152 @@ import asyncore
 import hashlib
 import base64
 import struct
+import zlib
+from time import time
 from array import array
+from collections import deque
 from common import CRLF, BUFFERSIZE
+from logwriter import logger
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 WS13_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 NOT_SET = -1
 INT16 = 2
 INT64 = 8
 BYTE = 1
+MASK_SIZE = 4
+OPCODE_CONTINUATION = 0
+OPCODE_TEXT = 1
+OPCODE_BINARY = 2
 OPCODE_CLOSE = 8
-MSG_DOUBLE = "%s%%s%%s" % struct.pack("!BB", 0x81, 127)
-MSG_LONG = "%s%%s%%s" % struct.pack("!BB", 0x81, 126)
-MSG_SHORT = "%s%%s%%s" % struct.pack("!B", 0x81)
+OPCODE_PING = 9
+OPCODE_PONG = 10
+PERMESSAGE_DEFLATE = "permessage-deflate"
+# the end of a sync flush, it is not sent with permessage-deflate
+DEFLATE_TAIL = "\x00\x00\xff\xff"
 
 
-# RESPONSE_UPGRADE_WEB_SOCKET % (key)
+# RESPONSE_UPGRADE_WEB_SOCKET % (key, additional headers or empty)
 RESPONSE_UPGRADE_WEB_SOCKET = CRLF.join(["HTTP/1.1 101 Switching Protocols",
                                          "Upgrade: websocket",
                                          "Connection: Upgrade",
-                                         "Sec-WebSocket-Accept: %s", CRLF])
+                                         "Sec-WebSocket-Accept: %s",
+                                         "%s"]) + CRLF
+
+# XOR tables for str.translate, one for each mask byte
+XOR_TABLES = ["".join(chr(i ^ m) for i in range(256)) for m in range(256)]
+# the consumed part of the input buffer is removed if it gets bigger than that
+COMPACT_SIZE = 64 * 1024
+# below that the setup of the numpy arrays costs more than it saves
+NUMPY_THRESHOLD = 512
+
+def unmask(data, mask):
+    """Return the string data XORed with the repeated 4 byte string mask.
+    With numpy the XOR is done on uint64 words, else every fourth byte
+    is translated with the table of the according mask byte."""
+    length = len(data)
+    if numpy and length >= NUMPY_THRESHOLD:
+        padded = data + "\0" * (-length % 8)
+        words = numpy.frombuffer(padded, dtype=numpy.uint64)
+        mask_word = numpy.frombuffer(mask * 2, dtype=numpy.uint64)[0]
+        return (words ^ mask_word).tostring()[0:length]
+    unmasked = bytearray(data)
+    for i in range(4):
+        unmasked[i::4] = data[i::4].translate(XOR_TABLES[ord(mask[i])])
+    return str(unmasked)
+
+def frame_head(opcode, length, fin=True, rsv1=False):
+    """Return the head of an unmasked server frame"""
+    byte = (fin and 0x80 or 0) | (rsv1 and 0x40 or 0) | opcode
+    if length > 0xffff:
+        return struct.pack("!BBQ", byte, 127, length)
+    if length > 125:
+        return struct.pack("!BBH", byte, 126, length)
+    return struct.pack("!BB", byte, length)
+
+def parse_extensions(value):
+    """Return the offers of a Sec-WebSocket-Extensions header
+    as a list of (name, parameters) tuples"""
+    offers = []
+    for offer in value.split(","):
+        parts = offer.split(";")
+        params = {}
+        for param in parts[1:]:
+            name, sep, param_value = param.partition("=")
+            if name.strip():
+                params[name.strip()] = sep and param_value.strip().strip('"') or None
+        offers.append((parts[0].strip(), params))
+    return offers
+
+class Deflate(object):
+    """The compression state of a permessage-deflate session"""
+
+    def __init__(self, window_bits, min_size, context_takeover):
+        self.window_bits = window_bits
+        self.min_size = min_size
+        self.context_takeover = context_takeover
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.time = 0.0
+
+    def compress(self, message):
+        t = time()
+        if not self._compressor or not self.context_takeover:
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                                zlib.DEFLATED,
+                                                -self.window_bits)
+        data = self._compressor.compress(message) + \
+               self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(DEFLATE_TAIL):
+            data = data[0:-len(DEFLATE_TAIL)]
+        self.time += time() - t
+        self.raw_size += len(message)
+        self.compressed_size += len(data)
+        return data
+
+    def decompress(self, data):
+        t = time()
+        message = self._decompressor.decompress(data + DEFLATE_TAIL)
+        self.time += time() - t
+        return message
 
 class WebSocket13(asyncore.dispatcher):
 
     # Sec-WebSocket-Version: 13
 
+    # messages bigger than that are sent in fragments, 0 to never fragment
+    frame_size = 0
+    # window bits for permessage-deflate, 0 to not negotiate it
+    deflate_window_bits = 0
+    # smaller messages are not compressed
+    deflate_min_size = 128
+    # queue messages and send them with one write per loop iteration
+    cork = False
+    # supported subprotocols, in order of preference
+    protocols = []
+
     def __init__(self, socket, headers, buffer, path):
         asyncore.dispatcher.__init__(self, sock=socket)
-        self._inbuffer = array("B", buffer)
+        self._inbuffer = bytearray(buffer)
+        # the output which is being sent and the position in it
         self._outbuffer = ""
+        self._out_pos = 0
+        # frames which wait for the next write
+        self._out_frames = []
+        # control frames, they can be sent between the fragments of a message
+        self._out_control = []
+        # messages bigger than frame_size, [opcode, message, position],
+        # sent one fragment per write
+        self._out_messages = deque()
+        self._out_size = 0
+        self.messages_out = 0
+        self.send_count = 0
         self._headers = headers
         self._path = path
         self._shake_hands()
@@ -41,27 +159,80 @@ class WebSocket13(asyncore.dispatcher):
         sha1.update(self._headers.get("Sec-WebSocket-Key"))
         sha1.update(WS13_GUID)
         res_key = base64.b64encode(sha1.digest())
-        self._outbuffer += RESPONSE_UPGRADE_WEB_SOCKET % res_key
+        headers = []
+        self.protocol = self._select_protocol()
+        if self.protocol:
+            headers.append("Sec-WebSocket-Protocol: %s%s" % (self.protocol, CRLF))
+        extensions = self._negotiate_deflate()
+        if extensions:
+            headers.append("Sec-WebSocket-Extensions: %s%s" % (extensions, CRLF))
+        self._write(RESPONSE_UPGRADE_WEB_SOCKET % (res_key, "".join(headers)))
         self._fin = NOT_SET
         self._rsv1 = NOT_SET
         self._rsv2 = NOT_SET
         self._rsv3 = NOT_SET
         self._opcode = NOT_SET
-        self._mask = None
-        self._data_length = 0
+        # opcode and frames of a fragmented message
+        self._message_opcode = NOT_SET
+        self._message_rsv1 = NOT_SET
+        self._fragments = []
         self._buf_cur = 0
-        self._set_read_handler(self._read_fin)
+        self._read_frames()
+
+    def _select_protocol(self):
+        """Return the first supported subprotocol offered by the client"""
+        offered = [protocol.strip() for protocol
+                   in self._headers.get("Sec-WebSocket-Protocol", "").split(",")]
+        for protocol in self.protocols:
+            if protocol in offered:
+                return protocol
+        return None
+
+    def _negotiate_deflate(self):
+        """Accept the first permessage-deflate offer which fits
+        deflate_window_bits, return the value of the response header"""
+        self._deflate = None
+        if not self.deflate_window_bits:
+            return ""
+        offers = parse_extensions(self._headers.get("Sec-WebSocket-Extensions", ""))
+        for name, params in offers:
+            if not name == PERMESSAGE_DEFLATE:
+                continue
+            window_bits = self.deflate_window_bits
+            response = [PERMESSAGE_DEFLATE]
+            if "server_max_window_bits" in params:
+                bits = params["server_max_window_bits"] or ""
+                # zlib does not support raw deflate with a window of 8 bits
+                if not bits.isdigit() or not 9 <= int(bits) <= 15:
+                    continue
+                window_bits = min(window_bits, int(bits))
+            if window_bits < zlib.MAX_WBITS:
+                response.append("server_max_window_bits=%s" % window_bits)
+            context_takeover = not "server_no_context_takeover" in params
+            if not context_takeover:
+                response.append("server_no_context_takeover")
+            self._deflate = Deflate(window_bits, self.deflate_min_size, context_takeover)
+            return "; ".join(response)
+        return ""
 
-    def _read_fin(self):
-        if len(self._inbuffer) >= 2:
-            byte = self._inbuffer[self._buf_cur]
-            self._buf_cur += 1
+    def _read_frames(self):
+        """Parse all complete frames in the input buffer.
+        The buffer is only compacted if it is consumed or if the
+        consumed part gets big, not after each frame."""
+        buf = self._inbuffer
+        cur = self._buf_cur
+        end = len(buf)
+        while end - cur >= 2:
+            byte = buf[cur]
             # final frame
             self._fin = byte >> 7
             # reserves
             self._rsv1 = byte >> 6 & 1
             self._rsv2 = byte >> 5 & 1
             self._rsv3 = byte >> 4 & 1
+            if self._rsv1 and not self._deflate:
+                self.handle_close()
+                return
             # opcode
             #
             # 0   continuation frame
@@ -70,82 +241,202 @@ class WebSocket13(asyncore.dispatcher):
             # 3-7 are reserved for further non-control frames
             # 8   connection close
             self._opcode = byte & 0x0f
-            byte = self._inbuffer[self._buf_cur]
-            self._buf_cur += 1
+            byte = buf[cur + 1]
             has_mask = byte >> 7
-            plen = byte & 0x7f
+            data_length = byte & 0x7f
             if not has_mask or self._opcode == OPCODE_CLOSE:
-                self.close()
-            else:
-                if plen > 125:
-                    self._int_size = INT16 if plen == 126 else INT64
-                    self._set_read_handler(self._read_int)
-                else:
-                    self._data_length = plen
-                    self._set_read_handler(self._read_mask)
-
-    def _read_int(self):
-        if len(self._inbuffer) >= self._buf_cur + self._int_size:
-            self._data_length = 0
-            for i in range(self._int_size):
-                self._data_length <<= 8
-                self._data_length += self._inbuffer[self._buf_cur + i]
-            self._buf_cur += self._int_size
-            self._set_read_handler(self._read_mask)
-
-    def _read_mask(self):
-        if len(self._inbuffer) >= self._buf_cur + 4:
-            self._mask = self._inbuffer[self._buf_cur:self._buf_cur + 4]
-            self._buf_cur += 4
-            self._set_read_handler(self._read_payload)
-
-    def _read_payload(self):
-        if len(self._inbuffer) >= self._buf_cur + self._data_length:
-            buf = self._inbuffer
-            cur = self._buf_cur
-            mask = self._mask
-            r = xrange(self._data_length)
-            data = array("B", (buf[cur + i] ^ mask[i % 4] for i in r))
-            self.handle_message(data.tostring())
-            self._inbuffer = buf[cur + self._data_length:]
-            self._buf_cur = 0
-            self._fin = NOT_SET
-            self._set_read_handler(self._read_fin)
-
-    def _set_read_handler(self, reader):
-        self._handle_read = reader
-        self._handle_read()
-
-    def send_message(self, message):
-        # only support for text so far
-        msg_len = len(message)
-        if msg_len > 0xffff:
-            self._outbuffer += MSG_DOUBLE % (struct.pack("!Q", msg_len), message)
-        elif msg_len > 125:
-            self._outbuffer += MSG_LONG % (struct.pack("!H", msg_len), message)
+                self.handle_close()
+                return
+            pos = cur + 2
+            if data_length == 126:
+                if end - pos < INT16:
+                    break
+                data_length = struct.unpack_from("!H", buf, pos)[0]
+                pos += INT16
+            elif data_length == 127:
+                if end - pos < INT64:
+                    break
+                data_length = struct.unpack_from("!Q", buf, pos)[0]
+                pos += INT64
+            if end - pos < MASK_SIZE + data_length:
+                break
+            mask = buffer(buf, pos, MASK_SIZE)[:]
+            pos += MASK_SIZE
+            data = buffer(buf, pos, data_length)[:]
+            cur = pos + data_length
+            self._handle_frame(unmask(data, mask))
+            if not self.connected:
+                return
+        if cur == end:
+            del buf[:]
+            cur = 0
+        elif cur > COMPACT_SIZE:
+            del buf[0:cur]
+            cur = 0
+        self._buf_cur = cur
+
+    def _handle_frame(self, data):
+        opcode = self._opcode
+        if opcode == OPCODE_PING:
+            # control frames can come between the fragments of a message
+            self._write_control(frame_head(OPCODE_PONG, len(data)) + data)
+        elif opcode == OPCODE_PONG:
+            pass
+        elif opcode == OPCODE_CONTINUATION:
+            if self._message_opcode == NOT_SET:
+                self.handle_close()
+                return
+            self._fragments.append(data)
+            if self._fin:
+                message = "".join(self._fragments)
+                self._fragments = []
+                opcode = self._message_opcode
+                self._message_opcode = NOT_SET
+                self._dispatch_message(opcode, message, self._message_rsv1)
+        elif self._message_opcode != NOT_SET:
+            # a new message before the last one is complete
+            self.handle_close()
+        elif self._fin:
+            self._dispatch_message(opcode, data, self._rsv1)
+        else:
+            self._message_opcode = opcode
+            self._message_rsv1 = self._rsv1
+            self._fragments = [data]
+
+    def _dispatch_message(self, opcode, message, is_compressed):
+        if is_compressed:
+            message = self._deflate.decompress(message)
+        if opcode == OPCODE_BINARY:
+            self.handle_binary_message(message)
         else:
-            self._outbuffer += MSG_SHORT % (struct.pack("!B", msg_len), message)
-        self.handle_write()
+            self.handle_message(message)
+
+    def send_message(self, message, binary=False):
+        """Send a text or binary message. If the message is bigger than
+        frame_size it is queued and sent in a first frame and continuation
+        frames, one frame per write, see handle_write."""
+        opcode = binary and OPCODE_BINARY or OPCODE_TEXT
+        if self.frame_size and len(message) > self.frame_size:
+            # compressed when the first frame is sent, the messages must
+            # be compressed in the order they are sent
+            self._out_messages.append([opcode, message, 0])
+            self._out_size += len(message)
+        else:
+            is_compressed = self._is_compressed(message)
+            if is_compressed:
+                message = self._deflate.compress(message)
+            self._write(frame_head(opcode, len(message), True, is_compressed))
+            self._write(message)
+        self.messages_out += 1
+        if not self.cork:
+            self.handle_write()
+
+    def _is_compressed(self, message):
+        return bool(self._deflate) and len(message) >= self._deflate.min_size
+
+    def _write(self, data):
+        self._out_frames.append(data)
+        self._out_size += len(data)
+
+    def _write_control(self, data):
+        self._out_control.append(data)
+        self._out_size += len(data)
+
+    def _next_fragment(self):
+        """Return the next frame of the first queued big message"""
+        item = self._out_messages[0]
+        opcode, message, pos = item
+        frame_size = self.frame_size
+        if pos:
+            opcode = OPCODE_CONTINUATION
+            # only the first frame of a message has the rsv1 bit
+            is_compressed = False
+        else:
+            is_compressed = self._is_compressed(message)
+            if is_compressed:
+                size = len(message)
+                message = item[1] = self._deflate.compress(message)
+                self._out_size += len(message) - size
+        chunk = message[pos:pos + frame_size]
+        pos += len(chunk)
+        is_last = pos >= len(message)
+        if is_last:
+            self._out_messages.popleft()
+        else:
+            item[2] = pos
+        self._out_size -= len(chunk)
+        return frame_head(opcode, len(chunk), is_last, is_compressed) + chunk
+
+    def pending_size(self):
+        """Return the size of the output which is not yet sent"""
+        return len(self._outbuffer) - self._out_pos + self._out_size
+
+    def get_stats(self):
+        """Return the write and compression stats of the connection"""
+        stats = {"messages_out": self.messages_out,
+                 "send_count": self.send_count,
+                 "deflate": bool(self._deflate)}
+        deflate = self._deflate
+        if not deflate:
+            return stats
+        stats.update({
+                "window_bits": deflate.window_bits,
+                "raw_size": deflate.raw_size,
+                "compressed_size": deflate.compressed_size,
+                "ratio": deflate.raw_size and
+                         float(deflate.compressed_size) / deflate.raw_size or 1.0,
+                "deflate_time": deflate.time})
+        return stats
 
     def handle_message(self, message):
         # implement in a subclass
         pass
 
+    def handle_binary_message(self, message):
+        # implement in a subclass, by default binary messages are
+        # handled like text messages
+        self.handle_message(message)
+
     # ============================================================
     # Implementations of the asyncore.dispatcher class methods
     # ============================================================
 
     def handle_read(self):
-        m = self.recv(BUFFERSIZE)
-        self._inbuffer += array('B', m)
-        self._handle_read()
+        self._inbuffer += self.recv(BUFFERSIZE)
+        self._read_frames()
 
     def writable(self):
-        return bool(self._outbuffer)
+        return bool(self._outbuffer or self._out_frames or
+                    self._out_control or self._out_messages)
 
     def handle_write(self):
-        sent = self.send(self._outbuffer)
-        if sent: self._outbuffer = self._outbuffer[sent:]
+        frames = self._out_control
+        self._out_control = []
+        # the fragments of a message can only be interleaved with control
+        # frames, the other messages wait until its last frame is sent
+        if not (self._out_messages and self._out_messages[0][2]):
+            frames.extend(self._out_frames)
+            self._out_frames = []
+        for frame in frames:
+            self._out_size -= len(frame)
+        if self._out_messages and self._out_pos == len(self._outbuffer):
+            # one fragment of a big message per write, the single frame
+            # messages queued meanwhile go before the next big message
+            frames.append(self._next_fragment())
+        if frames:
+            # coalesce all queued frames in one write
+            frames.insert(0, self._outbuffer[self._out_pos:])
+            self._outbuffer = "".join(frames)
+            self._out_pos = 0
+        if not self._outbuffer:
+            return
+        sent = self.send(buffer(self._outbuffer, self._out_pos))
+        self.send_count += 1
+        if sent:
+            self._out_pos += sent
+            if self._out_pos == len(self._outbuffer):
+                self._outbuffer = ""
+                self._out_pos = 0
 
     def handle_close(self):
         self.close()
@@ -157,7 +448,7 @@ class TestWebSocket13(WebSocket13):
 
     def handle_message(self, message):
         self.send_message("message received: %s" % message)
-        print "\r", message,
+        logger.info("test web socket message: %s" % message)
 
 class TestWebSocket13HighLoad(WebSocket13):
 
@@ -167,8 +458,95 @@ class TestWebSocket13HighLoad(WebSocket13):
     def writable(self):
         self.send_message('["ecmascript-debugger",17,0,0,[14,1118563,0,"timeout"]]')
         self.send_message('["ecmascript-debugger",18,0,0,[14,1118563,"completed"]]')
-        return bool(self._outbuffer)
+        return WebSocket13.writable(self)
 
     def handle_close(self):
         self.del_channel()
         self.close()
+
+def _read_server_frames(data):
+    """Return the (fin, opcode, payload) tuples of unmasked server frames"""
+    frames = []
+    pos = 0
+    while pos < len(data):
+        byte, length = struct.unpack_from("!BB", data, pos)
+        pos += 2
+        if length == 126:
+            length = struct.unpack_from("!H", data, pos)[0]
+            pos += 2
+        elif length == 127:
+            length = struct.unpack_from("!Q", data, pos)[0]
+            pos += 8
+        frames.append((bool(byte & 0x80), byte & 0x0f, data[pos:pos + length]))
+        pos += length
+    return frames
+
+if __name__ == "__main__":
+    # self-test of the order of the frames: big messages are sent one
+    # fragment per write, a small message sent after a big message which
+    # is not yet started goes before it, a pong goes between the fragments
+    import socket
+    server_sock, client_sock = socket.socketpair()
+    web_socket = WebSocket13(server_sock, {"Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ=="},
+                             "", "/test")
+    web_socket.frame_size = 1000
+    web_socket.cork = True
+    web_socket.handle_write()
+    client_sock.recv(BUFFERSIZE)
+    web_socket.send_message("a" * 5000)
+    web_socket.send_message("event 1")
+    web_socket.handle_write()
+    # a ping from the client while the big message is being sent
+    client_sock.sendall("\x89\x84" + "\x00" * 4 + "ping")
+    web_socket.handle_read()
+    web_socket.send_message("event 2")
+    web_socket.send_message("b" * 3000)
+    web_socket.send_message("event 3")
+    writes = 2
+    while web_socket.pending_size():
+        web_socket.handle_write()
+        writes += 1
+    web_socket.close()
+    data = ""
+    while True:
+        chunk = client_sock.recv(BUFFERSIZE)
+        if not chunk:
+            break
+        data += chunk
+    client_sock.close()
+    order = [(fin and "fin" or "...", payload[0:8]) for fin, opcode, payload
+             in _read_server_frames(data)]
+    print "%s writes: %s" % (writes, order)
+    assert order == [("fin", "event 1"), ("...", "a" * 8), ("fin", "ping"),
+                     ("...", "a" * 8), ("...", "a" * 8), ("...", "a" * 8),
+                     ("fin", "a" * 8), ("fin", "event 2"), ("fin", "event 3"),
+                     ("...", "b" * 8), ("...", "b" * 8), ("fin", "b" * 8)]
+
+    # benchmark of the unmasking of client frames,
+    # the former XOR per byte against unmask
+    import os
+    import timeit
+    def per_byte(data, mask):
+        buf = array("B", data)
+        mask = array("B", mask)
+        r = xrange(len(buf))
+        return array("B", (buf[i] ^ mask[i % 4] for i in r)).tostring()
+    def translate(data, mask):
+        global numpy
+        numpy, saved = None, numpy
+        try:
+            return unmask(data, mask)
+        finally:
+            numpy = saved
+    funcs = [per_byte, translate]
+    if numpy:
+        funcs.append(unmask)
+    mask = os.urandom(4)
+    for size in [100, 1000, 10000, 100000, 1000000, 10000000]:
+        data = os.urandom(size)
+        expected = per_byte(data, mask)
+        for func in funcs:
+            assert func(data, mask) == expected
+            count = max(1, 1000000 / size)
+            t = min(timeit.repeat(lambda: func(data, mask), number=count, repeat=3))
+            print "%-12s %9s bytes %12.1f us" % (func.__name__, size, t / count * 1000000)
@@ -0,0 +1,307 @@
+"""Headless load generator for the WebSocket endpoints.
+
+Opens a number of concurrent WebSocket clients and reports the throughput
+and the latency as JSON, e.g.
+
+    python wsloadtest.py --clients 20 --size 1000 --duration 10 localhost 8002
+
+The path decides what the clients send:
+
+    /test-web-sock-13             the echo endpoint, each message is
+                                  "<id> " padded to --size
+    /test-web-sock-13-high-load   the clients only receive
+    /stp-1-channel                STP/1 commands in the JSON envelope,
+                                  the tag of the response is the id,
+                                  see --command
+
+With --rate 0 each client keeps --window messages in flight and sends the
+next one as soon as a response arrives, else each client sends --rate
+messages per second.
+"""
+
+import os
+import json
+import socket
+import struct
+import base64
+import asyncore
+import argparse
+from time import time
+from websocket13 import frame_head, unmask, OPCODE_TEXT, OPCODE_BINARY
+from websocket13 import OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG
+from common import CRLF, BUFFERSIZE
+
+HANDSHAKE = CRLF.join(["GET %s HTTP/1.1",
+                       "Host: %s:%s",
+                       "Upgrade: websocket",
+                       "Connection: Upgrade",
+                       "Sec-WebSocket-Key: %s",
+                       "Sec-WebSocket-Version: 13",
+                       "%s"]) + CRLF
+ECHO_PREFIX = "message received: "
+STP_1_CHANNEL = "/stp-1-channel"
+HIGH_LOAD = "/test-web-sock-13-high-load"
+DEFAULT_COMMAND = '["scope",10,0,%(tag)s,[]]'
+
+def percentiles(values):
+    """Return the count and the percentiles in ms of latencies in s,
+    the values are None if there are no latencies"""
+    values = sorted(values)
+    def percentile(p):
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, int(len(values) * p / 100.0))] * 1000, 3)
+    return {"count": len(values),
+            "min": percentile(0),
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p99": percentile(99),
+            "max": round(values[-1] * 1000, 3) if values else None,
+            "mean": round(sum(values) / len(values) * 1000, 3) if values else None}
+
+class Stats(object):
+
+    def __init__(self):
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.latencies = []
+
+    def report(self, duration, client_count):
+        return {"clients": client_count,
+                "duration": round(duration, 3),
+                "messages_sent": self.messages_sent,
+                "messages_received": self.messages_received,
+                "messages_per_s": round(self.messages_received / duration, 1),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "bytes_per_s": round(self.bytes_received / duration, 1),
+                "errors": self.errors,
+                "latency_ms": percentiles(self.latencies)}
+
+class LoadClient(asyncore.dispatcher):
+    """A WebSocket client which sends messages and matches the responses
+    by an id to measure the latency"""
+
+    def __init__(self, args, stats):
+        asyncore.dispatcher.__init__(self)
+        self.args = args
+        self.stats = stats
+        self.is_sending = not args.path == HIGH_LOAD
+        self.is_open = False
+        self.in_buffer = bytearray()
+        self.out_buffer = ""
+        self.fragments = []
+        self.pending = {}
+        self.next_id = 1
+        self.next_send = 0
+        self.padding = "x" * args.size
+        protocol = args.protocol and \
+                   "Sec-WebSocket-Protocol: %s%s" % (args.protocol, CRLF) or ""
+        self.out_buffer = HANDSHAKE % (args.path, args.host, args.port,
+                                       base64.b64encode(os.urandom(16)),
+                                       protocol)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((args.host, args.port))
+
+    def make_message(self, msg_id):
+        if self.args.path == STP_1_CHANNEL:
+            return self.args.command % {"tag": msg_id}
+        message = "%s " % msg_id
+        return message + self.padding[len(message):]
+
+    def get_id(self, message):
+        try:
+            if self.args.path == STP_1_CHANNEL:
+                return json.loads(message)[3]
+            if message.startswith(ECHO_PREFIX):
+                return int(message[len(ECHO_PREFIX):].split(" ", 1)[0])
+        except (ValueError, IndexError, TypeError):
+            pass
+        return None
+
+    def send_frame(self, opcode, data):
+        mask = os.urandom(4)
+        head = frame_head(opcode, len(data))
+        # client frames are masked
+        head = head[0] + chr(ord(head[1]) | 0x80) + head[2:]
+        self.out_buffer += head + mask + unmask(data, mask)
+
+    def tick(self, now):
+        """Send the messages which are due"""
+        if not self.is_open or not self.is_sending:
+            return
+        if self.args.rate:
+            while self.next_send <= now:
+                self.send_next(now)
+                self.next_send += 1.0 / self.args.rate
+        else:
+            while len(self.pending) < self.args.window:
+                self.send_next(now)
+
+    def send_next(self, now):
+        msg_id = self.next_id
+        self.next_id += 1
+        message = self.make_message(msg_id)
+        self.pending[msg_id] = now
+        self.send_frame(self.args.binary and OPCODE_BINARY or OPCODE_TEXT, message)
+        self.stats.messages_sent += 1
+        self.stats.bytes_sent += len(message)
+
+    def handle_message(self, message):
+        now = time()
+        self.stats.messages_received += 1
+        self.stats.bytes_received += len(message)
+        sent = self.pending.pop(self.get_id(message), None)
+        if sent:
+            self.stats.latencies.append(now - sent)
+        if not self.args.rate:
+            self.tick(now)
+
+    def read_handshake(self):
+        pos = self.in_buffer.find(2 * CRLF)
+        if pos == -1:
+            return
+        status_line = str(self.in_buffer[0:self.in_buffer.find(CRLF)])
+        del self.in_buffer[0:pos + 4]
+        if not " 101 " in status_line:
+            self.stats.errors += 1
+            self.close()
+            return
+        self.is_open = True
+        self.next_send = time()
+        self.tick(self.next_send)
+
+    def read_frames(self):
+        buf = self.in_buffer
+        cur = 0
+        while len(buf) - cur >= 2:
+            fin = buf[cur] >> 7
+            opcode = buf[cur] & 0x0f
+            length = buf[cur + 1] & 0x7f
+            pos = cur + 2
+            if length == 126:
+                if len(buf) - pos < 2:
+                    break
+                length = struct.unpack_from("!H", buf, pos)[0]
+                pos += 2
+            elif length == 127:
+                if len(buf) - pos < 8:
+                    break
+                length = struct.unpack_from("!Q", buf, pos)[0]
+                pos += 8
+            if len(buf) - pos < length:
+                break
+            data = str(buf[pos:pos + length])
+            cur = pos + length
+            if opcode == OPCODE_CLOSE:
+                self.handle_close()
+                return
+            elif opcode == OPCODE_PING:
+                self.send_frame(OPCODE_PONG, data)
+            elif opcode == OPCODE_PONG:
+                pass
+            else:
+                self.fragments.append(data)
+                if fin:
+                    message = "".join(self.fragments)
+                    self.fragments = []
+                    self.handle_message(message)
+        del buf[0:cur]
+
+    # ============================================================
+    # Implementations of the asyncore.dispatcher class methods
+    # ============================================================
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        data = self.recv(BUFFERSIZE * 8)
+        if not data:
+            return
+        self.in_buffer += data
+        if not self.is_open:
+            self.read_handshake()
+        if self.is_open:
+            self.read_frames()
+
+    def writable(self):
+        return bool(self.out_buffer) or not self.connected
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+
+    def handle_error(self):
+        self.stats.errors += 1
+        self.close()
+
+    def handle_close(self):
+        self.is_open = False
+        self.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="""
+        Load generator for the WebSocket endpoints of dragonkeeper.
+        Prints the results as JSON.""")
+    parser.add_argument("host", nargs="?", default="localhost")
+    parser.add_argument("port", nargs="?", type=int, default=8002)
+    parser.add_argument("--path",
+                        default="/test-web-sock-13",
+                        help="WebSocket endpoint (default: %(default)s)")
+    parser.add_argument("-c", "--clients",
+                        type=int,
+                        default=10,
+                        help="number of concurrent clients (default: %(default)s)")
+    parser.add_argument("-s", "--size",
+                        type=int,
+                        default=100,
+                        help="size of the messages in bytes (default: %(default)s)")
+    parser.add_argument("-r", "--rate",
+                        type=float,
+                        default=0,
+                        help="messages per second and client, 0 to send the next "
+                             "message when a response arrives (default: %(default)s)")
+    parser.add_argument("-w", "--window",
+                        type=int,
+                        default=1,
+                        help="messages in flight per client with --rate 0 (default: %(default)s)")
+    parser.add_argument("-d", "--duration",
+                        type=float,
+                        default=5,
+                        help="duration of the test in seconds (default: %(default)s)")
+    parser.add_argument("--binary",
+                        action="store_true",
+                        default=False,
+                        help="send binary messages")
+    parser.add_argument("--protocol",
+                        default="",
+                        help="WebSocket subprotocol to request")
+    parser.add_argument("--command",
+                        default=DEFAULT_COMMAND,
+                        help="STP/1 command for /stp-1-channel, %%(tag)s is "
+                             "replaced by the id (default: %(default)s)")
+    return parser.parse_args()
+
+def run(args):
+    """Run the load test, return the report"""
+    stats = Stats()
+    clients = [LoadClient(args, stats) for i in range(args.clients)]
+    start = time()
+    end = start + args.duration
+    now = start
+    while now < end and asyncore.socket_map:
+        asyncore.loop(timeout=0.001, count=1)
+        now = time()
+        for client in clients:
+            client.tick(now)
+    duration = time() - start
+    for client in clients:
+        client.close()
+    return stats.report(duration, args.clients)
+
+if __name__ == "__main__":
+    print json.dumps(run(_parse_args()), indent=2, sort_keys=True)